@@ -20,7 +20,13 @@ from .server import start_server
   type=str)
 @click.option('--port', help='The port number of the web-server', type=int, default=5432)
 @click.option('--skip_load', help='Skip loading the data.', type=bool, is_flag=True, default=False)
-def start(project_path: str, host: str, port: int, skip_load: bool) -> None:
+@click.option(
+  '--skip_preload',
+  help='Skip preloading the embedding indices in the background.',
+  type=bool,
+  is_flag=True,
+  default=False)
+def start(project_path: str, host: str, port: int, skip_load: bool, skip_preload: bool) -> None:
   """Starts the Lilac web server."""
   project_path = project_path_from_args(project_path)
   if not dir_is_project(project_path):
@@ -31,7 +37,13 @@ def start(project_path: str, host: str, port: int, skip_load: bool) -> None:
     if value == 'n':
       exit()
 
-  start_server(host=host, port=port, open=True, project_path=project_path, skip_load=skip_load)
+  start_server(
+    host=host,
+    port=port,
+    open=True,
+    project_path=project_path,
+    skip_load=skip_load,
+    preload=not skip_preload)
 
 
 @click.command()
@@ -240,6 +240,23 @@ def get_dataset_config(config: Config, dataset_namespace: str,
   return None
 
 
+def get_dataset_embeddings(dataset_config: DatasetConfig) -> list[EmbeddingConfig]:
+  """Returns the embeddings of a dataset.
+
+  These are the embeddings in the config, or when none are set, the preferred embedding over every
+  media path.
+  """
+  if dataset_config.embeddings:
+    return list(dataset_config.embeddings)
+  settings = dataset_config.settings
+  if not settings or not settings.ui or not settings.preferred_embedding:
+    return []
+  return [
+    EmbeddingConfig(path=path, embedding=settings.preferred_embedding)
+    for path in settings.ui.media_paths or []
+  ]
+
+
 def read_config(config_path: str) -> Config:
   """Reads a config file.
 
@@ -0,0 +1,247 @@
+"""Mergeable sketches of leaf values, built while a column group is written to parquet."""
+import base64
+import math
+import os
+from collections import Counter
+from typing import Iterable, Optional, Union
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from pydantic import BaseModel, StrictBool, StrictFloat, StrictInt, StrictStr
+
+from ..schema import PATH_WILDCARD, ROWID, DataType, PathTuple, Schema, is_float, is_integer
+
+SKETCHES_FILE_SUFFIX = '.sketches.json'
+
+# Exact value counts are kept until a leaf has more distinct values than this.
+MAX_SKETCH_VALUE_COUNTS = 10_000
+# Longer strings are never counted exactly, only hashed into the HyperLogLog.
+MAX_SKETCH_VALUE_LENGTH = 250
+# The HyperLogLog uses 2^12 registers, which gives ~1.6% error on the distinct count.
+HLL_PRECISION = 12
+
+# NOTE: The strict types keep pydantic from coercing values, e.g. `1` to `'1'`.
+SketchValue = Union[StrictStr, StrictBool, StrictInt, StrictFloat]
+
+
+class LeafSketch(BaseModel):
+  """A mergeable summary of the values of a single leaf."""
+  path: PathTuple
+  dtype: DataType
+  # The number of non-null values, including NaNs.
+  count: int = 0
+  nan_count: int = 0
+  # Defined for numeric leafs, ignoring NaNs.
+  min_val: Optional[float] = None
+  max_val: Optional[float] = None
+  # Defined for string leafs.
+  text_length_sum: int = 0
+  # Exact counts of each distinct value, or None when there are too many distinct values.
+  value_counts: Optional[list[tuple[SketchValue, int]]] = []
+  # Base64 encoded HyperLogLog registers. Only defined when `value_counts` is None.
+  hll_registers: Optional[str] = None
+
+
+class ColumnSketches(BaseModel):
+  """The sketches of all the leafs in a parquet file."""
+  sketches: list[LeafSketch]
+
+
+def sketchable_leafs(schema: Schema) -> dict[PathTuple, DataType]:
+  """Returns the leafs of the schema that can be sketched, with their dtypes."""
+  result: dict[PathTuple, DataType] = {}
+  for path, field in schema.leafs.items():
+    if path == (ROWID,) or not field.dtype or field.fields:
+      continue
+    if field.dtype in (DataType.STRING, DataType.BOOLEAN) or is_integer(field.dtype) or is_float(
+        field.dtype):
+      result[path] = field.dtype
+  return result
+
+
+def sketches_filepath(parquet_filepath: str) -> str:
+  """Returns the path of the sketches file that describes a parquet file."""
+  return os.path.splitext(parquet_filepath)[0] + SKETCHES_FILE_SUFFIX
+
+
+class ColumnSketchBuilder:
+  """Builds the sketches of all the sketchable leafs from a stream of Arrow record batches."""
+
+  def __init__(self, schema: Schema):
+    self._leafs = sketchable_leafs(schema)
+    self._sketches = {
+      path: LeafSketch(path=path, dtype=dtype) for path, dtype in self._leafs.items()
+    }
+    self._value_counts: dict[PathTuple,
+                             Optional[Counter]] = {path: Counter() for path in self._leafs}
+    self._registers: dict[PathTuple, Optional[np.ndarray]] = {path: None for path in self._leafs}
+
+  def add_batch(self, batch: pa.RecordBatch) -> None:
+    """Add the values of a record batch to the sketches."""
+    for path, dtype in self._leafs.items():
+      sketch = self._sketches[path]
+      values = pc.drop_null(_leaf_array(batch, path))
+      sketch.count += len(values)
+      if not len(values):
+        continue
+      if dtype == DataType.STRING:
+        sketch.text_length_sum += pc.sum(pc.utf8_length(values)).as_py()
+      elif dtype != DataType.BOOLEAN:
+        if is_float(dtype):
+          is_nan = pc.is_nan(values)
+          sketch.nan_count += pc.sum(is_nan).as_py()
+          values = pc.filter(values, pc.invert(is_nan))
+          if not len(values):
+            continue
+        min_max = pc.min_max(values)
+        min_val, max_val = min_max['min'].as_py(), min_max['max'].as_py()
+        if sketch.min_val is None or min_val < sketch.min_val:
+          sketch.min_val = min_val
+        if sketch.max_val is None or max_val > sketch.max_val:
+          sketch.max_val = max_val
+      self._add_distinct(path, dtype, values)
+
+  def _add_distinct(self, path: PathTuple, dtype: DataType, values: pa.Array) -> None:
+    counts = self._value_counts[path]
+    if counts is not None:
+      has_long_values = (
+        dtype == DataType.STRING and
+        pc.max(pc.utf8_length(values)).as_py() > MAX_SKETCH_VALUE_LENGTH)
+      if not has_long_values:
+        value_counts = pc.value_counts(values)
+        counts.update(
+          dict(
+            zip(value_counts.field('values').to_pylist(),
+                value_counts.field('counts').to_pylist())))
+        if len(counts) <= MAX_SKETCH_VALUE_COUNTS:
+          return
+      # Too many distinct values. Switch to the HyperLogLog.
+      self._value_counts[path] = None
+      self._registers[path] = _hll_registers(counts.keys())
+    registers = self._registers[path]
+    assert registers is not None
+    _hll_add(registers, _hash_values(values.to_numpy(zero_copy_only=False)))
+
+  def build(self) -> ColumnSketches:
+    """Returns the sketches of the items added so far."""
+    sketches: list[LeafSketch] = []
+    for path, sketch in self._sketches.items():
+      sketch = sketch.copy()
+      counts = self._value_counts[path]
+      registers = self._registers[path]
+      if counts is not None:
+        sketch.value_counts = list(counts.items())
+      elif registers is not None:
+        sketch.value_counts = None
+        sketch.hll_registers = _encode_registers(registers)
+      sketches.append(sketch)
+    return ColumnSketches(sketches=sketches)
+
+
+def merge_sketches(sketches: Iterable[LeafSketch]) -> Optional[LeafSketch]:
+  """Merge the sketches of the same leaf, e.g. from several shards."""
+  result: Optional[LeafSketch] = None
+  counts: Optional[Counter] = Counter()
+  registers = np.zeros(1 << HLL_PRECISION, dtype=np.uint8)
+  for sketch in sketches:
+    if result is None:
+      result = sketch.copy(update={'value_counts': None, 'hll_registers': None})
+    else:
+      result.count += sketch.count
+      result.nan_count += sketch.nan_count
+      result.text_length_sum += sketch.text_length_sum
+      if sketch.min_val is not None:
+        result.min_val = sketch.min_val if result.min_val is None else min(
+          result.min_val, sketch.min_val)
+      if sketch.max_val is not None:
+        result.max_val = sketch.max_val if result.max_val is None else max(
+          result.max_val, sketch.max_val)
+
+    if sketch.value_counts is not None:
+      if counts is not None:
+        for value, count in sketch.value_counts:
+          counts[value] += count
+      else:
+        np.maximum(registers, _hll_registers(value for value, _ in sketch.value_counts), registers)
+    if sketch.hll_registers is not None:
+      np.maximum(registers, _decode_registers(sketch.hll_registers), registers)
+    if counts is not None and (sketch.hll_registers is not None or
+                               len(counts) > MAX_SKETCH_VALUE_COUNTS):
+      np.maximum(registers, _hll_registers(counts.keys()), registers)
+      counts = None
+
+  if result is None:
+    return None
+  if counts is not None:
+    result.value_counts = list(counts.items())
+  else:
+    result.value_counts = None
+    result.hll_registers = _encode_registers(registers)
+  return result
+
+
+def sketch_count_distinct(sketch: LeafSketch) -> int:
+  """Returns the approximate number of distinct values, counting NaN as a single value."""
+  num_nan = 1 if sketch.nan_count else 0
+  if sketch.value_counts is not None:
+    return len(sketch.value_counts) + num_nan
+  if sketch.hll_registers is None:
+    return num_nan
+  registers = _decode_registers(sketch.hll_registers)
+  num_registers = len(registers)
+  alpha = 0.7213 / (1 + 1.079 / num_registers)
+  estimate = alpha * num_registers**2 / np.sum(np.power(2.0, -registers.astype(np.float64)))
+  num_zeros = int(np.count_nonzero(registers == 0))
+  if estimate <= 2.5 * num_registers and num_zeros:
+    # Use linear counting for small cardinalities.
+    estimate = num_registers * math.log(num_registers / num_zeros)
+  return round(estimate) + num_nan
+
+
+def _leaf_array(batch: pa.RecordBatch, path: PathTuple) -> pa.Array:
+  """Returns the values of a leaf in a record batch, flattening the repeated fields."""
+  array = batch.column(batch.schema.get_field_index(path[0]))
+  for key in path[1:]:
+    if key == PATH_WILDCARD:
+      array = pc.list_flatten(array)
+    else:
+      array = pc.struct_field(array, [array.type.get_field_index(key)])
+  return array
+
+
+def _hash_values(values: np.ndarray) -> np.ndarray:
+  """Returns the 64 bit hashes of the values. Equal values of different widths hash the same."""
+  if values.dtype.kind in 'iu':
+    values = values.astype(np.int64)
+  elif values.dtype.kind == 'f':
+    values = values.astype(np.float64)
+  elif values.dtype.kind in 'US':
+    values = values.astype(object)
+  return pd.util.hash_array(values)
+
+
+def _hll_add(registers: np.ndarray, hashes: np.ndarray) -> None:
+  rest_bits = 64 - HLL_PRECISION
+  indices = (hashes >> np.uint64(rest_bits)).astype(np.intp)
+  rest = hashes & np.uint64((1 << rest_bits) - 1)
+  # The rest has fewer bits than the float mantissa, so its exponent is exactly its bit length.
+  _, bit_lengths = np.frexp(rest.astype(np.float64))
+  np.maximum.at(registers, indices, (rest_bits - bit_lengths + 1).astype(np.uint8))
+
+
+def _hll_registers(values: Iterable[SketchValue]) -> np.ndarray:
+  registers = np.zeros(1 << HLL_PRECISION, dtype=np.uint8)
+  values_array = np.array(list(values))
+  if len(values_array):
+    _hll_add(registers, _hash_values(values_array))
+  return registers
+
+
+def _encode_registers(registers: np.ndarray) -> str:
+  return base64.b64encode(registers.tobytes()).decode('ascii')
+
+
+def _decode_registers(encoded: str) -> np.ndarray:
+  return np.frombuffer(base64.b64decode(encoded), dtype=np.uint8).copy()
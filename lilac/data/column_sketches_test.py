@@ -0,0 +1,136 @@
+"""Tests for the column sketches."""
+
+import numpy as np
+import pyarrow as pa
+from pytest_mock import MockerFixture
+
+from ..schema import ROWID, Item, Schema, schema, schema_to_arrow_schema
+from . import column_sketches
+from .column_sketches import (
+  ColumnSketchBuilder,
+  ColumnSketches,
+  LeafSketch,
+  merge_sketches,
+  sketch_count_distinct,
+)
+
+
+def _build(data_schema: Schema, *batches: list[Item]) -> ColumnSketches:
+  builder = ColumnSketchBuilder(data_schema)
+  arrow_schema = schema_to_arrow_schema(data_schema)
+  for items in batches:
+    builder.add_batch(pa.RecordBatch.from_pylist(items, schema=arrow_schema))
+  return builder.build()
+
+
+def test_sketch_leafs() -> None:
+  data_schema = schema({
+    ROWID: 'string',
+    'name': 'string',
+    'active': 'boolean',
+    'addresses': [{
+      'zips': ['int32']
+    }],
+    'score': 'float32',
+    'date': 'timestamp'
+  })
+  # The items are split in two batches.
+  column_sketches = _build(
+    data_schema,
+    [{
+      'name': 'a',
+      'active': True,
+      'addresses': [{
+        'zips': [5, 8]
+      }],
+      'score': 1.0
+    }, {
+      'name': 'bb',
+      'active': False,
+      'addresses': [{
+        'zips': [3]
+      }, {
+        'zips': [8]
+      }]
+    }],
+    [{
+      'name': 'bb',
+      'addresses': [],
+      'score': np.float32('nan')
+    }],
+  )
+
+  sketches = {sketch.path: sketch for sketch in column_sketches.sketches}
+  # Rowids and temporal leafs are not sketched.
+  assert list(sketches.keys()) == [('name',), ('active',), ('score',),
+                                   ('addresses', '*', 'zips', '*')]
+  assert sketches[('name',)] == LeafSketch(
+    path=('name',), dtype='string', count=3, text_length_sum=5, value_counts=[('a', 1), ('bb', 2)])
+  assert sketches[('active',)] == LeafSketch(
+    path=('active',), dtype='boolean', count=2, value_counts=[(True, 1), (False, 1)])
+  assert sketches[('score',)] == LeafSketch(
+    path=('score',),
+    dtype='float32',
+    count=2,
+    nan_count=1,
+    min_val=1.0,
+    max_val=1.0,
+    value_counts=[(1.0, 1)])
+  zips_sketch = sketches[('addresses', '*', 'zips', '*')]
+  assert zips_sketch == LeafSketch(
+    path=('addresses', '*', 'zips', '*'),
+    dtype='int32',
+    count=4,
+    min_val=3,
+    max_val=8,
+    value_counts=[(5, 1), (8, 2), (3, 1)])
+
+  assert sketch_count_distinct(sketches[('score',)]) == 2
+  assert sketch_count_distinct(zips_sketch) == 3
+
+
+def test_merge_sketches() -> None:
+  shard1 = _build(schema({'num': 'int32'}), [{'num': num} for num in [1, 2, 3]])
+  shard2 = _build(schema({'num': 'int32'}), [{'num': num} for num in [3, 4]])
+
+  merged = merge_sketches([shard1.sketches[0], shard2.sketches[0]])
+  assert merged == LeafSketch(
+    path=('num',),
+    dtype='int32',
+    count=5,
+    min_val=1,
+    max_val=4,
+    value_counts=[(1, 1), (2, 1), (3, 2), (4, 1)])
+
+
+def test_many_distinct_values(mocker: MockerFixture) -> None:
+  mocker.patch.object(column_sketches, 'MAX_SKETCH_VALUE_COUNTS', 100)
+
+  num_schema = schema({'num': 'int32'})
+  # The first shard switches to the HyperLogLog in its second batch.
+  shard1 = _build(num_schema, [{
+    'num': num
+  } for num in range(50)], [{
+    'num': num
+  } for num in range(50, 1000)])
+  shard2 = _build(num_schema, [{'num': num} for num in range(500, 1500)])
+  shard3 = _build(num_schema, [{'num': num} for num in range(10)])
+
+  sketch1 = shard1.sketches[0]
+  assert sketch1.value_counts is None
+  assert abs(sketch_count_distinct(sketch1) - 1000) < 50
+
+  merged = merge_sketches([sketch1, shard2.sketches[0], shard3.sketches[0]])
+  assert merged
+  assert merged.count == 2010
+  assert merged.value_counts is None
+  assert abs(sketch_count_distinct(merged) - 1500) < 75
+
+
+def test_long_strings_are_not_counted(mocker: MockerFixture) -> None:
+  mocker.patch.object(column_sketches, 'MAX_SKETCH_VALUE_LENGTH', 3)
+
+  [sketch] = _build(schema({'text': 'string'}), [{'text': 'ab'}, {'text': 'abcd'}]).sketches
+  assert sketch.count == 2
+  assert sketch.value_counts is None
+  assert sketch_count_distinct(sketch) == 2
@@ -8,7 +8,9 @@ from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from typing import Any, Iterator, Literal, Optional, Sequence, Union
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
 from pydantic import (
   BaseModel,
   StrictBool,
@@ -39,6 +41,7 @@ from ..schema import (
   DataType,
   ImageInfo,
   Path,
+  PathKey,
   PathTuple,
   Schema,
   normalize_path,
@@ -58,10 +61,15 @@ MAX_TEXT_LEN_DISTINCT_COUNT = 250
 class SelectRowsResult:
   """The result of a select rows query."""
 
-  def __init__(self, df: pd.DataFrame, total_num_rows: int) -> None:
+  def __init__(self,
+               df: pd.DataFrame,
+               total_num_rows: int,
+               next_cursor: Optional[str] = None) -> None:
     """Initialize the result."""
     self._df = df
     self.total_num_rows = total_num_rows
+    # Passed back to `select_rows` to fetch the next page. None when this is the last page.
+    self.next_cursor = next_cursor
 
   def __iter__(self) -> Iterator:
     return (row.to_dict() for _, row in self._df.iterrows())
@@ -71,6 +79,20 @@ class SelectRowsResult:
     return self._df
 
 
+class SelectRowsArrowResult:
+  """The result of a select rows query, as an Arrow table."""
+
+  def __init__(self,
+               table: pa.Table,
+               total_num_rows: int,
+               next_cursor: Optional[str] = None) -> None:
+    """Initialize the result."""
+    self.table = table
+    self.total_num_rows = total_num_rows
+    # Passed back to `select_rows_arrow` to fetch the next page. None when this is the last page.
+    self.next_cursor = next_cursor
+
+
 class StatsResult(BaseModel):
   """The result of a stats() query."""
   path: PathTuple
@@ -350,6 +372,11 @@ class Dataset(abc.ABC):
     signal = get_signal_by_type(embedding, TextEmbeddingSignal)()
     self.compute_signal(signal, path, task_step_id)
 
+  @abc.abstractmethod
+  def preload_embedding(self, embedding: str, path: Path) -> None:
+    """Load the index of a computed embedding, so the first search over it is fast."""
+    pass
+
   def compute_concept(self,
                       namespace: str,
                       concept_name: str,
@@ -403,6 +430,7 @@ class Dataset(abc.ABC):
                   sort_order: Optional[SortOrder] = SortOrder.DESC,
                   limit: Optional[int] = 100,
                   offset: Optional[int] = 0,
+                  cursor: Optional[str] = None,
                   task_step_id: Optional[TaskStepId] = None,
                   resolve_span: bool = False,
                   combine_columns: bool = False,
@@ -425,6 +453,9 @@ class Dataset(abc.ABC):
       sort_order: The sort order.
       limit: The maximum number of rows to return.
       offset: The offset to start returning rows from.
+      cursor: The `next_cursor` of the previous page of the same query. The page starts right after
+        the last row of the previous page, without skipping rows, so deep pages are as fast as the
+        first. When defined, `offset` is ignored.
       task_step_id: The TaskManager `task_step_id` for this process run. This is used to update the
         progress.
       resolve_span: Whether to resolve the span of the row.
@@ -438,6 +469,62 @@ class Dataset(abc.ABC):
     """
     pass
 
+  @abc.abstractmethod
+  def select_rows_arrow(self,
+                        columns: Optional[Sequence[ColumnId]] = None,
+                        searches: Optional[Sequence[Search]] = None,
+                        filters: Optional[Sequence[FilterLike]] = None,
+                        sort_by: Optional[Sequence[Path]] = None,
+                        sort_order: Optional[SortOrder] = SortOrder.DESC,
+                        limit: Optional[int] = 100,
+                        offset: Optional[int] = 0,
+                        cursor: Optional[str] = None,
+                        combine_columns: bool = False,
+                        user: Optional[UserInfo] = None) -> SelectRowsArrowResult:
+    """Like `select_rows`, but returns the rows as an Arrow table.
+
+    The columns are typed by the schema of the selection, so a column has the same type in every
+    page, even when its values are all missing. See `select_rows` for the arguments.
+    """
+    pass
+
+  @abc.abstractmethod
+  def select_rows_iter(self,
+                       columns: Optional[Sequence[ColumnId]] = None,
+                       searches: Optional[Sequence[Search]] = None,
+                       filters: Optional[Sequence[FilterLike]] = None,
+                       sort_by: Optional[Sequence[Path]] = None,
+                       sort_order: Optional[SortOrder] = SortOrder.DESC,
+                       limit: Optional[int] = None,
+                       offset: Optional[int] = 0,
+                       resolve_span: bool = False,
+                       combine_columns: bool = False,
+                       user: Optional[UserInfo] = None,
+                       batch_size: int = 10_000) -> Iterator[pd.DataFrame]:
+    """Like `select_rows`, but streams the rows in batches to bound memory.
+
+    UDFs are computed one batch at a time, so this should be used when selecting all the rows of a
+    large dataset. When rows are filtered or sorted by a UDF, all the rows are needed to apply the
+    filter or sort, so the result is returned as a single batch.
+
+    Args:
+      columns: The columns to select. See `select_rows`.
+      searches: The searches to apply to the query.
+      filters: The filters to apply to the query.
+      sort_by: An ordered list of what to sort by. See `select_rows`.
+      sort_order: The sort order.
+      limit: The maximum number of rows to return.
+      offset: The offset to start returning rows from.
+      resolve_span: Whether to resolve the span of the row.
+      combine_columns: Whether to combine columns into a single object.
+      user: The authenticated user, if auth is enabled and the user is logged in.
+      batch_size: The approximate number of rows in each batch.
+
+    Returns
+      An iterator of data frames, one per batch.
+    """
+    pass
+
   @abc.abstractmethod
   def select_rows_schema(self,
                          columns: Optional[Sequence[ColumnId]] = None,
@@ -460,6 +547,30 @@ class Dataset(abc.ABC):
     """
     pass
 
+  def warm_stats(self, schema: Schema) -> None:
+    """Compute the stats of the leafs of a schema ahead of time, so the first page load is fast.
+
+    Warming is best-effort: stats that fail here are computed lazily when they are requested.
+    """
+    pass
+
+  @abc.abstractmethod
+  def vector_topk_batch(self, embedding: str, path: Path, queries: np.ndarray,
+                        k: int) -> list[list[tuple[PathKey, float]]]:
+    """Return the k items of a field that are most similar to each query vector.
+
+    Args:
+      embedding: The name of the embedding computed over the field.
+      path: The path of the field.
+      queries: The query vectors, in the space of the embedding. This should be a 2D matrix with one
+        query per row.
+      k: The number of results to return for each query.
+
+    Returns
+      A list of (path key, score) tuples for each query. The first part of a path key is the rowid.
+    """
+    pass
+
   @abc.abstractmethod
   def media(self, item_id: str, leaf_path: Path) -> MediaResult:
     """Return the media for a leaf path.
@@ -1,21 +1,26 @@
 """The DuckDB implementation of the dataset database."""
+import base64
 import functools
 import gc
-import glob
+import hashlib
+import itertools
+import json
 import math
 import os
 import pathlib
 import re
 import shutil
 import threading
+from datetime import date, datetime
 from typing import Any, Iterable, Iterator, Optional, Sequence, Union, cast
 
 import duckdb
 import numpy as np
 import pandas as pd
+import pyarrow as pa
 import yaml
 from pandas.api.types import is_object_dtype
-from pydantic import BaseModel, validator
+from pydantic import BaseModel, StrictBool, StrictFloat, StrictInt, StrictStr, validator
 from typing_extensions import override
 
 from ..auth import UserInfo
@@ -27,6 +32,7 @@ from ..config import (
   SignalConfig,
   get_dataset_config,
 )
+from ..embeddings.vector_index_cache import get_vector_index_cache
 from ..embeddings.vector_store import VectorDBIndex
 from ..env import data_path, env
 from ..project import (
@@ -58,6 +64,7 @@ from ..schema import (
   is_ordinal,
   is_temporal,
   normalize_path,
+  schema_to_arrow_schema,
   signal_type_supports_dtype,
 )
 from ..signal import Signal, TextEmbeddingSignal, VectorSignal, get_signal_by_type, resolve_signal
@@ -68,6 +75,13 @@ from ..signals.substring_search import SubstringSignal
 from ..tasks import TaskStepId, progress
 from ..utils import DebugTimer, get_dataset_output_dir, log, open_file
 from . import dataset
+from .column_sketches import (
+  ColumnSketches,
+  LeafSketch,
+  merge_sketches,
+  sketch_count_distinct,
+  sketches_filepath,
+)
 from .dataset import (
   BINARY_OPS,
   LIST_OPS,
@@ -90,6 +104,7 @@ from .dataset import (
   Search,
   SearchResultInfo,
   SelectGroupsResult,
+  SelectRowsArrowResult,
   SelectRowsResult,
   SelectRowsSchemaResult,
   SelectRowsSchemaUDF,
@@ -102,9 +117,12 @@ from .dataset import (
   make_parquet_id,
 )
 from .dataset_utils import (
+  DatasetGeneration,
+  bump_dataset_generation,
   count_primitives,
   create_signal_schema,
   flatten_keys,
+  get_dataset_generation,
   merge_schemas,
   schema_contains_path,
   sparse_to_dense_compute,
@@ -116,8 +134,34 @@ from .dataset_utils import (
 SIGNAL_MANIFEST_FILENAME = 'signal_manifest.json'
 DATASET_SETTINGS_FILENAME = 'settings.json'
 SOURCE_VIEW_NAME = 'source'
+# The persistent DuckDB catalog lives in a hidden directory inside the dataset directory.
+DUCKDB_CACHE_DIR = '.duckdb'
+DUCKDB_CACHE_FILENAME = 'catalog.db'
+CATALOG_STATE_TABLE = 'lilac_catalog_state'
+# When signal column groups are spliced into a table `t`, the table is renamed to this, and `t`
+# becomes a view that joins it with a table for each spliced column group, named with the prefix.
+SPLICED_BASE_TABLE = '__spliced_base__'
+SPLICED_TABLE_PREFIX = '__spliced__/'
+# The most spliced column groups before `t` is rebuilt as a single table.
+MAX_SPLICED_COLUMN_GROUPS = 8
+# Stats are persisted next to the parquet files of the column group they describe.
+STATS_FILENAME = 'stats.json'
 
 NUM_AUTO_BINS = 15
+# The number of rows per batch when streaming rows with `select_rows_iter`.
+SELECT_ROWS_BATCH_SIZE = 10_000
+# A hidden column with the sort key and position of each row, used to build the next page cursor.
+CURSOR_COLUMN = '__cursor__'
+# The top k rowids of a vector search are registered as a relation, ranked by their position.
+TOPK_ROWIDS_VIEW = '__topk_rowids__'
+TOPK_POSITION_COLUMN = '__topk_position__'
+TOPK_SCORE_COLUMN = '__topk_score__'
+# The rowids of an existing vector index, anti-joined with the dataset to find the new rows.
+INDEXED_ROWIDS_VIEW = '__indexed_rowids__'
+# `in` filters with more values are registered as a relation instead of being inlined in the query.
+IN_FILTER_MAX_LITERALS = 1000
+# Numbers the relations registered for large `in` filters, so they have unique names.
+_in_filter_ids = itertools.count()
 
 BINARY_OP_TO_SQL: dict[BinaryOp, str] = {
   'equals': '=',
@@ -144,6 +188,25 @@ class DuckDBSearchUDFs(BaseModel):
   sorts: list[tuple[PathTuple, SortOrder]]
 
 
+class ColumnGroupStats(BaseModel):
+  """The stats of the leafs in a column group, valid for a single fingerprint of the group."""
+  fingerprint: str
+  stats: list[StatsResult] = []
+
+
+class SelectRowsCursor(BaseModel):
+  """The position after the last row of a page, passed back to `select_rows` as an opaque string."""
+  # The sort key and the position of the last row, to seek past it. The position is the physical
+  # rowid of the table, or the `__rowid__` column when `t` is a view.
+  sort_value: Optional[Union[StrictBool, StrictInt, StrictFloat, StrictStr]] = None
+  sort_datetime: Optional[datetime] = None
+  row: Optional[Union[StrictInt, StrictStr]] = None
+  # The number of rows to skip, for queries that can't seek, e.g. when sorting by a UDF.
+  offset: Optional[int] = None
+  # A hash of the sorts, filters and searches of the query that returned the cursor.
+  query: Optional[str] = None
+
+
 class DatasetDuckDB(Dataset):
   """The DuckDB implementation of the dataset database."""
 
@@ -155,14 +218,30 @@ class DatasetDuckDB(Dataset):
     # TODO: Infer the manifest from the parquet files so this is lighter weight.
     self._source_manifest = read_source_manifest(self.dataset_path)
     self._signal_manifests: list[SignalManifest] = []
-    self.con = duckdb.connect(database=':memory:')
+    # Maps a column group to its directory, and to the fingerprint of its files.
+    self._column_group_dirs: dict[str, str] = {}
+    self._column_group_fingerprints: dict[str, str] = {}
+    self._view_or_table = 'TABLE'
+    self._persist = bool(int(env('DUCKDB_PERSIST', 0) or 0))
+    if self._persist:
+      # Keep the joined table on disk so it survives restarts and is only rebuilt when the
+      # manifests change.
+      cache_dir = os.path.join(self.dataset_path, DUCKDB_CACHE_DIR)
+      os.makedirs(cache_dir, exist_ok=True)
+      self.con = duckdb.connect(database=os.path.join(cache_dir, DUCKDB_CACHE_FILENAME))
+    else:
+      self.con = duckdb.connect(database=':memory:')
 
-    # Maps a path and embedding to the vector index. This is lazily generated as needed.
-    self._vector_indices: dict[tuple[PathKey, str], VectorDBIndex] = {}
     self.vector_store = vector_store
     self._manifest_lock = threading.Lock()
     self._config_lock = threading.Lock()
-    self._vector_index_lock = threading.Lock()
+    # Maps a column group to the stats of its leafs. This is lazily read from disk as needed.
+    self._stats: dict[str, ColumnGroupStats] = {}
+    self._stats_lock = threading.Lock()
+
+    if get_dataset_generation(self.dataset_path) is None:
+      # Datasets written before the generation journal existed start one now.
+      bump_dataset_generation(self.dataset_path, 'open')
 
     # Create a join table from all the parquet files.
     manifest = self.manifest()
@@ -186,6 +265,7 @@ class DatasetDuckDB(Dataset):
   def delete(self) -> None:
     """Deletes the dataset."""
     self.con.close()
+    get_vector_index_cache().remove(self.dataset_path)
     shutil.rmtree(self.dataset_path, ignore_errors=True)
 
   def _create_view(self, view_name: str, files: list[str]) -> None:
@@ -193,18 +273,17 @@ class DatasetDuckDB(Dataset):
       CREATE OR REPLACE VIEW {_escape_col_name(view_name)} AS (SELECT * FROM read_parquet({files}));
     """)
 
-  # NOTE: This is cached, but when the latest mtime of any file in the dataset directory changes
-  # the results are invalidated.
+  # NOTE: This is cached, but when the generation of the dataset changes the results are
+  # invalidated.
   @functools.cache
-  def _recompute_joint_table(self, latest_mtime_micro_sec: int) -> DatasetManifest:
-    del latest_mtime_micro_sec  # This is used as the cache key.
-    merged_schema = self._source_manifest.data_schema.copy(deep=True)
+  def _recompute_joint_table(self, generation: DatasetGeneration) -> DatasetManifest:
+    del generation  # This is used as the cache key.
     self._signal_manifests = []
-    # Make a joined view of all the column groups.
-    self._create_view(SOURCE_VIEW_NAME,
-                      [os.path.join(self.dataset_path, f) for f in self._source_manifest.files])
+    self._column_group_dirs = {SOURCE_VIEW_NAME: self.dataset_path}
+    source_files = [os.path.join(self.dataset_path, f) for f in self._source_manifest.files]
 
-    # Add the signal column groups.
+    # Read the signal column groups.
+    signal_files_by_id: dict[str, list[str]] = {}
     for root, _, files in os.walk(self.dataset_path):
       for file in files:
         if not file.endswith(SIGNAL_MANIFEST_FILENAME):
@@ -213,13 +292,46 @@ class DatasetDuckDB(Dataset):
         with open_file(os.path.join(root, file)) as f:
           signal_manifest = SignalManifest.parse_raw(f.read())
         self._signal_manifests.append(signal_manifest)
-        signal_files = [os.path.join(root, f) for f in signal_manifest.files]
-        if signal_files:
-          self._create_view(signal_manifest.parquet_id, signal_files)
+        self._column_group_dirs[signal_manifest.parquet_id] = root
+        signal_files_by_id[signal_manifest.parquet_id] = [
+          os.path.join(root, f) for f in signal_manifest.files
+        ]
 
     merged_schema = merge_schemas([self._source_manifest.data_schema] +
                                   [m.data_schema for m in self._signal_manifests])
 
+    view_or_table = 'TABLE'
+    use_views = env('DUCKDB_USE_VIEWS', 0) or 0
+    if int(use_views):
+      view_or_table = 'VIEW'
+
+    fingerprints = _column_group_fingerprints(view_or_table, source_files, self._signal_manifests,
+                                              signal_files_by_id)
+    self._view_or_table = self._sync_joint_table(view_or_table, fingerprints, source_files,
+                                                 signal_files_by_id)
+    self._column_group_fingerprints = fingerprints
+
+    # Get the total size of the table.
+    size_query = 'SELECT COUNT() as count FROM t'
+    size_query_result = cast(Any, self._query(size_query)[0])
+    num_items = cast(int, size_query_result[0])
+
+    return DatasetManifest(
+      namespace=self.namespace,
+      dataset_name=self.dataset_name,
+      data_schema=merged_schema,
+      num_items=num_items,
+      source=self._source_manifest.source)
+
+  def _create_joint_table(self, view_or_table: str, source_files: list[str],
+                          signal_files_by_id: dict[str, list[str]]) -> None:
+    """Create the joint table `t` from the source and signal column groups."""
+    # Make a joined view of all the column groups.
+    self._create_view(SOURCE_VIEW_NAME, source_files)
+    for manifest in self._signal_manifests:
+      if manifest.files:
+        self._create_view(manifest.parquet_id, signal_files_by_id[manifest.parquet_id])
+
     # The logic below generates the following example query:
     # CREATE OR REPLACE VIEW t AS (
     #   SELECT
@@ -239,34 +351,139 @@ class DatasetDuckDB(Dataset):
       for manifest in self._signal_manifests
       if manifest.files
     ])
-    view_or_table = 'TABLE'
-    use_views = env('DUCKDB_USE_VIEWS', 0) or 0
-    if int(use_views):
-      view_or_table = 'VIEW'
+    # A persisted catalog can hold `t` as the other kind, e.g. after toggling `DUCKDB_USE_VIEWS`.
+    table_type = self._table_type()
+    if table_type:
+      self.con.execute(f"DROP {'VIEW' if table_type == 'VIEW' else 'TABLE'} t")
+    for table in [SPLICED_BASE_TABLE, *self._spliced_tables()]:
+      self.con.execute(f'DROP TABLE IF EXISTS {_escape_col_name(table)}')
     sql_cmd = f"""CREATE OR REPLACE {view_or_table} t AS (SELECT {select_sql} FROM {join_sql})"""
     self.con.execute(sql_cmd)
 
-    # Get the total size of the table.
-    size_query = 'SELECT COUNT() as count FROM t'
-    size_query_result = cast(Any, self._query(size_query)[0])
-    num_items = cast(int, size_query_result[0])
+  def _sync_joint_table(self, view_or_table: str, fingerprints: dict[str, str],
+                        source_files: list[str], signal_files_by_id: dict[str, list[str]]) -> str:
+    """Bring the joint table `t` in sync with the column groups on disk.
 
-    return DatasetManifest(
-      namespace=self.namespace,
-      dataset_name=self.dataset_name,
-      data_schema=merged_schema,
-      num_items=num_items,
-      source=self._source_manifest.source)
+    When only signal column groups were added, removed or rewritten since the last build, the
+    columns of the table are not rewritten. Removed columns are dropped, and added column groups
+    are spliced in: each is read into a table of its own, the table `t` is renamed to
+    `SPLICED_BASE_TABLE`, and `t` becomes a view that joins them.
+
+    Returns whether `t` is a 'TABLE' or a 'VIEW'.
+    """
+    previous = self._read_catalog_state()
+    base_table = self._materialized_table()
+    if previous == fingerprints:
+      return 'TABLE' if base_table == 't' else 'VIEW'
+
+    base_columns = self._table_columns(base_table) if base_table else set()
+    spliced = [
+      manifest for manifest in self._signal_manifests
+      if manifest.files and (manifest.parquet_id not in base_columns or
+                             previous.get(manifest.parquet_id) != fingerprints[manifest.parquet_id])
+    ]
+    can_splice = (
+      view_or_table == 'TABLE' and previous and base_table and
+      previous.get(SOURCE_VIEW_NAME) == fingerprints[SOURCE_VIEW_NAME] and
+      len(spliced) <= MAX_SPLICED_COLUMN_GROUPS)
+    if not can_splice:
+      self._create_joint_table(view_or_table, source_files, signal_files_by_id)
+      self._write_catalog_state(fingerprints)
+      return view_or_table
+    base_table = cast(str, base_table)
+
+    for parquet_id, fingerprint in previous.items():
+      if fingerprints.get(parquet_id) == fingerprint:
+        continue
+      with DebugTimer(f'Dropping column group "{parquet_id}" from the joint table'):
+        if parquet_id in base_columns:
+          self.con.execute(f'ALTER TABLE {base_table} DROP COLUMN {_escape_col_name(parquet_id)}')
+        self.con.execute(f'DROP VIEW IF EXISTS {_escape_col_name(parquet_id)}')
+        self.con.execute(
+          f'DROP TABLE IF EXISTS {_escape_col_name(SPLICED_TABLE_PREFIX + parquet_id)}')
+    for manifest in spliced:
+      if previous.get(manifest.parquet_id) == fingerprints[manifest.parquet_id]:
+        continue
+      with DebugTimer(f'Adding column group "{manifest.parquet_id}" to the joint table'):
+        # Only the files of the added column group are read.
+        table = _escape_col_name(SPLICED_TABLE_PREFIX + manifest.parquet_id)
+        root_column = _escape_col_name(_root_column(manifest))
+        self.con.execute(f"""
+          CREATE OR REPLACE TABLE {table} AS (
+            SELECT {ROWID}, {root_column} AS {_escape_col_name(manifest.parquet_id)}
+            FROM read_parquet({signal_files_by_id[manifest.parquet_id]})
+          )
+        """)
+
+    if base_table == 't':
+      self.con.execute(f'ALTER TABLE t RENAME TO {SPLICED_BASE_TABLE}')
+    # The example query for 2 spliced column groups:
+    # CREATE OR REPLACE VIEW t AS (
+    #   SELECT __spliced_base__.*, "__spliced__/parquet_id1"."parquet_id1", ...
+    #   FROM __spliced_base__ LEFT JOIN "__spliced__/parquet_id1" USING (__rowid__) LEFT JOIN ...
+    # );
+    spliced_tables = [
+      _escape_col_name(SPLICED_TABLE_PREFIX + manifest.parquet_id) for manifest in spliced
+    ]
+    select_sql = ', '.join([f'{SPLICED_BASE_TABLE}.*'] + [
+      f'{table}.{_escape_col_name(manifest.parquet_id)}'
+      for table, manifest in zip(spliced_tables, spliced)
+    ])
+    join_sql = ' '.join([SPLICED_BASE_TABLE] +
+                        [f'LEFT JOIN {table} USING ({ROWID})' for table in spliced_tables])
+    self.con.execute(f'CREATE OR REPLACE VIEW t AS (SELECT {select_sql} FROM {join_sql})')
+    self._write_catalog_state(fingerprints)
+    return 'VIEW'
+
+  def _materialized_table(self) -> Optional[str]:
+    """Returns the table that holds the materialized columns of `t`, or None if `t` is a view."""
+    table_type = self._table_type()
+    if table_type == 'BASE TABLE':
+      return 't'
+    row = self.con.execute('SELECT 1 FROM information_schema.tables WHERE table_name = ?',
+                           [SPLICED_BASE_TABLE]).fetchone()
+    return SPLICED_BASE_TABLE if table_type == 'VIEW' and row else None
+
+  def _spliced_tables(self) -> list[str]:
+    rows = self.con.execute(
+      'SELECT table_name FROM information_schema.tables WHERE starts_with(table_name, ?)',
+      [SPLICED_TABLE_PREFIX]).fetchall()
+    return [row[0] for row in rows]
+
+  def _table_columns(self, table: str) -> set[str]:
+    return {row[0] for row in self.con.execute(f'DESCRIBE {table}').fetchall()}
+
+  def _table_type(self) -> Optional[str]:
+    """Returns the type of the joint table `t`, or None if it does not exist yet."""
+    row = self.con.execute(
+      "SELECT table_type FROM information_schema.tables WHERE table_name = 't'").fetchone()
+    return row[0] if row else None
+
+  def _read_catalog_state(self) -> dict[str, str]:
+    """Read the fingerprints of the column groups the joint table was built from."""
+    self.con.execute(f"""
+      CREATE TABLE IF NOT EXISTS {CATALOG_STATE_TABLE} (column_group VARCHAR, fingerprint VARCHAR)
+    """)
+    rows = self.con.execute(
+      f'SELECT column_group, fingerprint FROM {CATALOG_STATE_TABLE}').fetchall()
+    return dict(rows)
+
+  def _write_catalog_state(self, fingerprints: dict[str, str]) -> None:
+    self.con.execute(f'DELETE FROM {CATALOG_STATE_TABLE}')
+    self.con.executemany(f'INSERT INTO {CATALOG_STATE_TABLE} VALUES (?, ?)',
+                         list(fingerprints.items()))
 
   @override
   def manifest(self) -> DatasetManifest:
-    # Use the latest modification time of all files under the dataset path as the cache key for
-    # re-computing the manifest and the joined view.
+    # Use the dataset generation as the cache key for re-computing the manifest and the joined view.
+    # Writers bump the generation, so this is a single stat call.
     with self._manifest_lock:
-      all_dataset_files = glob.iglob(os.path.join(self.dataset_path, '**'), recursive=True)
-      latest_mtime = max(map(os.path.getmtime, all_dataset_files))
-      latest_mtime_micro_sec = int(latest_mtime * 1e6)
-      return self._recompute_joint_table(latest_mtime_micro_sec)
+      generation = get_dataset_generation(self.dataset_path)
+      if generation is None:
+        # The journal was removed from under us, e.g. by an external tool. Start a new one.
+        bump_dataset_generation(self.dataset_path, 'reset')
+        generation = cast(DatasetGeneration, get_dataset_generation(self.dataset_path))
+      return self._recompute_joint_table(generation)
 
   def count(self, filters: Optional[list[FilterLike]] = None) -> int:
     """Count the number of rows."""
@@ -275,34 +492,27 @@ class DatasetDuckDB(Dataset):
   def _get_vector_db_index(self, embedding: str, path: PathTuple) -> VectorDBIndex:
     # Refresh the manifest to make sure we have the latest signal manifests.
     self.manifest()
-    index_key = (path, embedding)
-    with self._vector_index_lock:
-      if index_key in self._vector_indices:
-        return self._vector_indices[index_key]
-
-      manifests = [
-        m for m in self._signal_manifests if schema_contains_path(m.data_schema, path) and
-        m.vector_store and m.signal.name == embedding
-      ]
-      if not manifests:
-        raise ValueError(f'No embedding found for path {path}.')
-      if len(manifests) > 1:
-        raise ValueError(f'Multiple embeddings found for path {path}. Got: {manifests}')
-      manifest = manifests[0]
-      if not manifest.vector_store:
-        raise ValueError(f'Signal manifest for path {path} is not an embedding. '
-                         f'Got signal manifest: {manifest}')
-
-      base_path = os.path.join(self.dataset_path, _signal_dir(manifest.enriched_path),
-                               manifest.signal.name)
-      path_id = f'{self.namespace}/{self.dataset_name}:{path}'
-      with DebugTimer(f'Loading vector store "{manifest.vector_store}" for {path_id}'
-                      f' with embedding "{embedding}"'):
-        vector_index = VectorDBIndex(manifest.vector_store)
-        vector_index.load(base_path)
-      # Cache the vector index.
-      self._vector_indices[index_key] = vector_index
-      return vector_index
+    manifests = [
+      m for m in self._signal_manifests
+      if schema_contains_path(m.data_schema, path) and m.vector_store and m.signal.name == embedding
+    ]
+    if not manifests:
+      raise ValueError(f'No embedding found for path {path}.')
+    if len(manifests) > 1:
+      raise ValueError(f'Multiple embeddings found for path {path}. Got: {manifests}')
+    manifest = manifests[0]
+    if not manifest.vector_store:
+      raise ValueError(f'Signal manifest for path {path} is not an embedding. '
+                       f'Got signal manifest: {manifest}')
+
+    base_path = os.path.join(self.dataset_path, _signal_dir(manifest.enriched_path),
+                             manifest.signal.name)
+    # Indices are cached across datasets, so a server keeps the recently used indices loaded.
+    return get_vector_index_cache().get(base_path, manifest.vector_store)
+
+  @override
+  def preload_embedding(self, embedding: str, path: Path) -> None:
+    self._get_vector_db_index(embedding, normalize_path(path))
 
   @override
   def compute_signal(self,
@@ -328,21 +538,25 @@ class DatasetDuckDB(Dataset):
     manifest = self.manifest()
 
     signal_col = Column(path=source_path, alias='value', signal_udf=signal)
-    select_rows_result = self.select_rows([ROWID, signal_col],
-                                          task_step_id=task_step_id,
-                                          resolve_span=True)
-    df = select_rows_result.df()
-    values = df['value']
-
     enriched_path = _col_destination_path(signal_col, is_computed_signal=True)
     spec = _split_path_into_subpaths_of_lists(enriched_path)
     output_dir = os.path.join(self.dataset_path, _signal_dir(enriched_path))
     signal_schema = create_signal_schema(signal, source_path, manifest.data_schema)
-    enriched_signal_items = cast(Iterable[Item], wrap_in_dicts(values, spec))
-    for rowid, item in zip(df[ROWID], enriched_signal_items):
-      item[ROWID] = rowid
 
-    enriched_signal_items = list(enriched_signal_items)
+    def _enriched_signal_items() -> Iterator[Item]:
+      # Stream the rows so memory is bounded by the batch size, not the size of the dataset.
+      for df in self.select_rows_iter([ROWID, signal_col], resolve_span=True):
+        items = cast(Iterable[Item], wrap_in_dicts(df['value'], spec))
+        for rowid, item in zip(df[ROWID], items):
+          item[ROWID] = rowid
+          yield item
+
+    path_id = f'{self.namespace}/{self.dataset_name}:{source_path}'
+    enriched_signal_items = progress(
+      _enriched_signal_items(),
+      task_step_id=task_step_id,
+      estimated_len=manifest.num_items,
+      step_description=f'Computing {signal.key()} on {path_id}')
     parquet_filename, _ = write_items_to_parquet(
       items=enriched_signal_items,
       output_dir=output_dir,
@@ -360,6 +574,9 @@ class DatasetDuckDB(Dataset):
     signal_manifest_filepath = os.path.join(output_dir, SIGNAL_MANIFEST_FILENAME)
     with open_file(signal_manifest_filepath, 'w') as f:
       f.write(signal_manifest.json(exclude_none=True, indent=2))
+    bump_dataset_generation(self.dataset_path, f'compute_signal {signal_manifest.parquet_id}')
+    # Compute the stats of the new leafs eagerly so they are ready for the next page load.
+    self._warm_stats(signal_manifest.parquet_id)
 
     log(f'Wrote signal output to {output_dir}')
 
@@ -379,21 +596,46 @@ class DatasetDuckDB(Dataset):
 
     signal = get_signal_by_type(embedding, TextEmbeddingSignal)()
     signal_col = Column(path=source_path, alias='value', signal_udf=signal)
-    select_rows_result = self.select_rows([ROWID, signal_col],
-                                          task_step_id=task_step_id,
-                                          resolve_span=True)
-    df = select_rows_result.df()
-    values = df['value']
-
     enriched_path = _col_destination_path(signal_col, is_computed_signal=True)
     output_dir = os.path.join(self.dataset_path, _signal_dir(enriched_path))
     signal_schema = create_signal_schema(signal, source_path, manifest.data_schema)
 
-    write_embeddings_to_disk(
-      vector_store=self.vector_store, rowids=df[ROWID], signal_items=values, output_dir=output_dir)
-
-    del select_rows_result, df, values
-    gc.collect()
+    # When the embedding was already computed, only embed the rows that are not in the index yet.
+    vector_index = self._load_computed_vector_index(output_dir, signal)
+    filters: list[FilterLike] = []
+    num_items = manifest.num_items
+    if vector_index is not None:
+      path_keys = vector_index.path_keys()
+      deleted_rowids, new_rowids = self._diff_indexed_rowids(
+        dict.fromkeys(cast(str, path_key[0]) for path_key in path_keys))
+      vector_index.delete([path_key for path_key in path_keys if path_key[0] in deleted_rowids])
+      filters = [(ROWID, 'in', new_rowids)]
+      num_items = len(new_rowids)
+
+    if num_items:
+      # Stream the rows so only the embedding matrix, and not every row, is held in memory.
+      rowid_batches, value_batches = itertools.tee(
+        self.select_rows_iter([ROWID, signal_col], filters=filters, resolve_span=True))
+      rowids = (rowid for df in rowid_batches for rowid in df[ROWID])
+      path_id = f'{self.namespace}/{self.dataset_name}:{source_path}'
+      values = progress((value for df in value_batches for value in df['value']),
+                        task_step_id=task_step_id,
+                        estimated_len=num_items,
+                        step_description=f'Computing {signal.key()} on {path_id}')
+
+      write_embeddings_to_disk(
+        vector_store=self.vector_store,
+        rowids=rowids,
+        signal_items=values,
+        output_dir=output_dir,
+        vector_index=vector_index)
+
+      del rowid_batches, value_batches, rowids, values
+      gc.collect()
+    elif vector_index is not None:
+      vector_index.save(output_dir)
+
+    get_vector_index_cache().remove(output_dir)
 
     signal_manifest = SignalManifest(
       files=[],
@@ -406,9 +648,43 @@ class DatasetDuckDB(Dataset):
 
     with open_file(signal_manifest_filepath, 'w') as f:
       f.write(signal_manifest.json(exclude_none=True, indent=2))
+    bump_dataset_generation(self.dataset_path, f'compute_embedding {signal_manifest.parquet_id}')
 
     log(f'Wrote embedding index to {output_dir}')
 
+  def _diff_indexed_rowids(self, indexed_rowids: Iterable[str]) -> tuple[set[str], list[str]]:
+    """Returns the indexed rowids that are not in the dataset, and the rows that are not indexed.
+
+    The indexed rowids are registered as a relation and anti-joined with the dataset, so the rowids
+    of the dataset are never loaded in Python nor inlined in a query.
+    """
+    con = self.con.cursor()
+    try:
+      con.register(INDEXED_ROWIDS_VIEW,
+                   pa.table({ROWID: pa.array(list(indexed_rowids), type=pa.string())}))
+      deleted_rowids = con.execute(
+        f'SELECT {ROWID} FROM {INDEXED_ROWIDS_VIEW} ANTI JOIN t USING ({ROWID})').arrow()
+      new_rowids = con.execute(
+        f'SELECT {ROWID} FROM t ANTI JOIN {INDEXED_ROWIDS_VIEW} USING ({ROWID})').arrow()
+    finally:
+      con.close()
+    return set(deleted_rowids[ROWID].to_pylist()), new_rowids[ROWID].to_pylist()
+
+  def _load_computed_vector_index(self, output_dir: str,
+                                  signal: TextEmbeddingSignal) -> Optional[VectorDBIndex]:
+    """Load the vector index of an embedding that was already computed, if it can be extended."""
+    signal_manifest_filepath = os.path.join(output_dir, SIGNAL_MANIFEST_FILENAME)
+    if not os.path.exists(signal_manifest_filepath):
+      return None
+    with open_file(signal_manifest_filepath) as f:
+      signal_manifest = SignalManifest.parse_raw(f.read())
+    if (signal_manifest.vector_store != self.vector_store or
+        signal_manifest.signal.dict() != signal.dict()):
+      return None
+    vector_index = VectorDBIndex(self.vector_store)
+    vector_index.load(output_dir)
+    return vector_index
+
   @override
   def delete_signal(self, signal_path: Path) -> None:
     signal_path = normalize_path(signal_path)
@@ -427,7 +703,9 @@ class DatasetDuckDB(Dataset):
                                  SignalConfig(path=source_path, signal=resolve_signal(signal)))
 
     output_dir = os.path.join(self.dataset_path, _signal_dir(signal_path))
+    get_vector_index_cache().remove(output_dir)
     shutil.rmtree(output_dir, ignore_errors=True)
+    bump_dataset_generation(self.dataset_path, f'delete_signal {".".join(signal_path)}')
 
   def _validate_filters(self, filters: Sequence[Filter], col_aliases: dict[str, PathTuple],
                         manifest: DatasetManifest) -> None:
@@ -546,7 +824,6 @@ class DatasetDuckDB(Dataset):
       raise ValueError(f'Unable to sort by path {path}. The field has no value.')
 
   @override
-  @functools.cache  # Cache stats for leaf paths since we ask on every dataset page refresh.
   def stats(self, leaf_path: Path) -> StatsResult:
     if not leaf_path:
       raise ValueError('leaf_path must be provided')
@@ -561,13 +838,80 @@ class DatasetDuckDB(Dataset):
     if not leaf.dtype:
       raise ValueError(f'Leaf "{path}" not found in dataset')
 
-    duckdb_path = self._leaf_path_to_duckdb_path(path, manifest.data_schema)
+    ((parquet_id, duckdb_path),) = self._column_to_duckdb_paths(
+      Column(path), manifest.data_schema, combine_columns=False, select_leaf=True)
+    # Stats of a signal leaf can depend on the source text via spans, so both are in the key.
+    fingerprint = ' '.join([
+      self._column_group_fingerprints.get(SOURCE_VIEW_NAME, ''),
+      self._column_group_fingerprints.get(parquet_id, '')
+    ])
+    cached_stats = self._get_cached_stats(parquet_id, fingerprint, path)
+    if cached_stats:
+      return cached_stats
+
+    result = self._sketch_stats(parquet_id, path, manifest)
+    if not result:
+      result = self._compute_stats(path, leaf.dtype, duckdb_path, manifest)
+    self._put_cached_stats(parquet_id, fingerprint, result)
+    return result
+
+  def _sketch_stats(self, parquet_id: str, path: PathTuple,
+                    manifest: DatasetManifest) -> Optional[StatsResult]:
+    """Returns the stats of a leaf from the sketches written with its parquet files, if any."""
+    column_group_dir = self._column_group_dirs.get(parquet_id)
+    files: list[str] = []
+    if parquet_id == SOURCE_VIEW_NAME:
+      files = self._source_manifest.files
+    else:
+      files = next((m.files for m in self._signal_manifests if m.parquet_id == parquet_id), [])
+    if not column_group_dir or not files:
+      return None
+
+    leaf_sketches: list[LeafSketch] = []
+    for filename in files:
+      filepath = sketches_filepath(os.path.join(column_group_dir, filename))
+      if not os.path.exists(filepath):
+        # Parquet files written before sketches existed.
+        return None
+      with open_file(filepath) as f:
+        column_sketches = ColumnSketches.parse_raw(f.read())
+      leaf_sketch = next((s for s in column_sketches.sketches if s.path == path), None)
+      if not leaf_sketch:
+        return None
+      leaf_sketches.append(leaf_sketch)
+    sketch = merge_sketches(leaf_sketches)
+    if not sketch:
+      return None
+
+    avg_text_length: Optional[int] = None
+    if sketch.dtype == DataType.STRING and sketch.count:
+      avg_text_length = int(sketch.text_length_sum / sketch.count)
+
+    if avg_text_length and avg_text_length > MAX_TEXT_LEN_DISTINCT_COUNT:
+      # Assume that every text field is unique.
+      approx_count_distinct = manifest.num_items
+    elif sketch.dtype == DataType.BOOLEAN:
+      approx_count_distinct = 2
+    else:
+      approx_count_distinct = sketch_count_distinct(sketch)
+
+    result = StatsResult(
+      path=path,
+      total_count=sketch.count,
+      approx_count_distinct=approx_count_distinct,
+      avg_text_length=avg_text_length)
+    if is_ordinal(sketch.dtype):
+      result.min_val, result.max_val = sketch.min_val, sketch.max_val
+    return result
+
+  def _compute_stats(self, path: PathTuple, dtype: DataType, duckdb_path: PathTuple,
+                     manifest: DatasetManifest) -> StatsResult:
     inner_select = _select_sql(
       duckdb_path, flatten=True, unnest=True, span_from=self._get_span_from(path, manifest))
 
     # Compute the average length of text fields.
     avg_text_length: Optional[int] = None
-    if leaf.dtype in (DataType.STRING, DataType.STRING_SPAN):
+    if dtype in (DataType.STRING, DataType.STRING_SPAN):
       avg_length_query = f"""
         SELECT avg(length(val))
         FROM (SELECT {inner_select} AS val FROM t) USING SAMPLE {SAMPLE_AVG_TEXT_LENGTH};
@@ -583,7 +927,7 @@ class DatasetDuckDB(Dataset):
     if avg_text_length and avg_text_length > MAX_TEXT_LEN_DISTINCT_COUNT:
       # Assume that every text field is unique.
       approx_count_distinct = manifest.num_items
-    elif leaf.dtype == DataType.BOOLEAN:
+    elif dtype == DataType.BOOLEAN:
       approx_count_distinct = 2
     else:
       sample_size = TOO_MANY_DISTINCT
@@ -605,17 +949,73 @@ class DatasetDuckDB(Dataset):
       avg_text_length=avg_text_length)
 
     # Compute min/max values for ordinal leafs, without sampling the data.
-    if is_ordinal(leaf.dtype):
+    if is_ordinal(dtype):
       min_max_query = f"""
         SELECT MIN(val) AS minVal, MAX(val) AS maxVal
         FROM (SELECT {inner_select} as val FROM t)
-        {'WHERE NOT isnan(val)' if is_float(leaf.dtype) else ''}
+        {'WHERE NOT isnan(val)' if is_float(dtype) else ''}
       """
       row = self._query(min_max_query)[0]
       result.min_val, result.max_val = row
 
     return result
 
+  def _get_cached_stats(self, parquet_id: str, fingerprint: str,
+                        path: PathTuple) -> Optional[StatsResult]:
+    with self._stats_lock:
+      group_stats = self._stats.get(parquet_id)
+      if not group_stats or group_stats.fingerprint != fingerprint:
+        group_stats = self._read_stats(parquet_id)
+        if not group_stats or group_stats.fingerprint != fingerprint:
+          # The column group changed since the stats were computed.
+          group_stats = ColumnGroupStats(fingerprint=fingerprint)
+        self._stats[parquet_id] = group_stats
+      for stats in group_stats.stats:
+        if stats.path == path:
+          return stats.copy()
+    return None
+
+  def _put_cached_stats(self, parquet_id: str, fingerprint: str, result: StatsResult) -> None:
+    with self._stats_lock:
+      group_stats = self._stats.get(parquet_id)
+      if not group_stats or group_stats.fingerprint != fingerprint:
+        # The column group changed while the stats were computed.
+        return
+      group_stats.stats = [s for s in group_stats.stats if s.path != result.path] + [result]
+      stats_dir = self._column_group_dirs.get(parquet_id)
+      if not stats_dir or not os.path.exists(stats_dir):
+        return
+      with open_file(os.path.join(stats_dir, STATS_FILENAME), 'w') as f:
+        f.write(group_stats.json())
+
+  def _read_stats(self, parquet_id: str) -> Optional[ColumnGroupStats]:
+    stats_dir = self._column_group_dirs.get(parquet_id)
+    if not stats_dir:
+      return None
+    stats_filepath = os.path.join(stats_dir, STATS_FILENAME)
+    if not os.path.exists(stats_filepath):
+      return None
+    with open_file(stats_filepath) as f:
+      return ColumnGroupStats.parse_raw(f.read())
+
+  def _warm_stats(self, parquet_id: str) -> None:
+    """Compute the stats of all the leafs in a signal column group."""
+    self.manifest()
+    for m in self._signal_manifests:
+      if m.parquet_id == parquet_id and m.files:
+        self.warm_stats(m.data_schema)
+
+  @override
+  def warm_stats(self, schema: Schema) -> None:
+    for path, field in schema.leafs.items():
+      if path == (ROWID,) or field.dtype in (DataType.EMBEDDING, DataType.NULL):
+        continue
+      try:
+        self.stats(path)
+      except duckdb.Error as e:
+        # Stats are still computed lazily when they are requested.
+        log(f'Failed to compute stats for "{path}": {e}')
+
   @override
   def select_groups(
       self,
@@ -686,7 +1086,8 @@ class DatasetDuckDB(Dataset):
       duckdb_path, flatten=True, unnest=True, span_from=self._get_span_from(path, manifest))
 
     filters, _ = self._normalize_filters(filters, col_aliases={}, udf_aliases={}, manifest=manifest)
-    filter_queries = self._create_where(manifest, filters, searches=[])
+    con = self.con.cursor()
+    filter_queries = self._create_where(manifest, filters, searches=[], con=con)
 
     where_query = ''
     if filter_queries:
@@ -699,7 +1100,10 @@ class DatasetDuckDB(Dataset):
       ORDER BY {sort_by.value} {sort_order.value}
       {limit_query}
     """
-    df = self._query_df(query)
+    try:
+      df = _replace_nan_with_none(con.execute(query).df())
+    finally:
+      con.close()
     counts = list(df.itertuples(index=False, name=None))
     if is_temporal(leaf.dtype):
       # Replace any NaT with None and pd.Timestamp to native datetime objects.
@@ -792,18 +1196,127 @@ class DatasetDuckDB(Dataset):
                   sort_order: Optional[SortOrder] = SortOrder.DESC,
                   limit: Optional[int] = None,
                   offset: Optional[int] = 0,
+                  cursor: Optional[str] = None,
                   task_step_id: Optional[TaskStepId] = None,
                   resolve_span: bool = False,
                   combine_columns: bool = False,
                   user: Optional[UserInfo] = None) -> SelectRowsResult:
+    ((df, total_num_rows, next_cursor),) = list(
+      self._select_rows_batches(
+        columns,
+        searches,
+        filters,
+        sort_by,
+        sort_order,
+        limit,
+        offset,
+        cursor,
+        task_step_id,
+        resolve_span,
+        combine_columns,
+        user,
+        batch_size=None))
+    return SelectRowsResult(cast(pd.DataFrame, df), total_num_rows, next_cursor)
+
+  @override
+  def select_rows_arrow(self,
+                        columns: Optional[Sequence[ColumnId]] = None,
+                        searches: Optional[Sequence[Search]] = None,
+                        filters: Optional[Sequence[FilterLike]] = None,
+                        sort_by: Optional[Sequence[Path]] = None,
+                        sort_order: Optional[SortOrder] = SortOrder.DESC,
+                        limit: Optional[int] = 100,
+                        offset: Optional[int] = 0,
+                        cursor: Optional[str] = None,
+                        combine_columns: bool = False,
+                        user: Optional[UserInfo] = None) -> SelectRowsArrowResult:
+    ((table, total_num_rows, next_cursor),) = list(
+      self._select_rows_batches(
+        columns,
+        searches,
+        filters,
+        sort_by,
+        sort_order,
+        limit,
+        offset,
+        cursor,
+        None,
+        False,
+        combine_columns,
+        user,
+        batch_size=None,
+        arrow=True))
+    return SelectRowsArrowResult(cast(pa.Table, table), total_num_rows, next_cursor)
+
+  @override
+  def select_rows_iter(self,
+                       columns: Optional[Sequence[ColumnId]] = None,
+                       searches: Optional[Sequence[Search]] = None,
+                       filters: Optional[Sequence[FilterLike]] = None,
+                       sort_by: Optional[Sequence[Path]] = None,
+                       sort_order: Optional[SortOrder] = SortOrder.DESC,
+                       limit: Optional[int] = None,
+                       offset: Optional[int] = 0,
+                       resolve_span: bool = False,
+                       combine_columns: bool = False,
+                       user: Optional[UserInfo] = None,
+                       batch_size: int = SELECT_ROWS_BATCH_SIZE) -> Iterator[pd.DataFrame]:
+    for df, _, _ in self._select_rows_batches(
+        columns,
+        searches,
+        filters,
+        sort_by,
+        sort_order,
+        limit,
+        offset,
+        None,
+        None,
+        resolve_span,
+        combine_columns,
+        user,
+        batch_size=batch_size):
+      yield cast(pd.DataFrame, df)
+
+  def _select_rows_batches(
+      self,
+      columns: Optional[Sequence[ColumnId]],
+      searches: Optional[Sequence[Search]],
+      filters: Optional[Sequence[FilterLike]],
+      sort_by: Optional[Sequence[Path]],
+      sort_order: Optional[SortOrder],
+      limit: Optional[int],
+      offset: Optional[int],
+      cursor: Optional[str],
+      task_step_id: Optional[TaskStepId],
+      resolve_span: bool,
+      combine_columns: bool,
+      user: Optional[UserInfo],
+      batch_size: Optional[int],
+      arrow: bool = False) -> Iterator[tuple[Union[pd.DataFrame, pa.Table], int, Optional[str]]]:
+    """Yields batches of the selected rows, with the number of matching rows and the next cursor.
+
+    When `batch_size` is None, or when rows are filtered or sorted by a UDF, a single batch is
+    yielded with all the rows. When `arrow` is True, the batches are Arrow tables.
+    """
     manifest = self.manifest()
     cols = self._normalize_columns(columns, manifest.data_schema, combine_columns)
     offset = offset or 0
+    page_cursor = _decode_cursor(cursor) if cursor else None
+    seek_cursor = page_cursor
+    if seek_cursor and seek_cursor.offset is not None:
+      offset = seek_cursor.offset
+      seek_cursor = None
+    elif seek_cursor:
+      offset = 0
+    page_offset = offset
     schema = manifest.data_schema
 
-    if combine_columns:
-      schema = self.select_rows_schema(
+    combined_schema: Optional[Schema] = None
+    if combine_columns or arrow:
+      combined_schema = self.select_rows_schema(
         columns, sort_by, sort_order, searches, combine_columns=True).data_schema
+    if combine_columns:
+      schema = cast(Schema, combined_schema)
 
     self._validate_columns(cols, manifest.data_schema, schema)
     self._normalize_searches(searches, manifest)
@@ -848,13 +1361,19 @@ class DatasetDuckDB(Dataset):
     # Filtering and searching.
     where_query = ''
     filters, udf_filters = self._normalize_filters(filters, col_aliases, udf_aliases, manifest)
-    filter_queries = self._create_where(manifest, filters, searches)
-    if filter_queries:
-      where_query = f"WHERE {' AND '.join(filter_queries)}"
-
+    query_fingerprint = _query_fingerprint(sort_by, sort_order, [*filters, *udf_filters], searches)
+    if page_cursor and page_cursor.query != query_fingerprint:
+      raise ValueError('The cursor does not match the query. Cursors can only be used with the '
+                       'query that returned them.')
     total_num_rows = manifest.num_items
     con = self.con.cursor()
+    filter_queries = self._create_where(manifest, filters, searches, con)
+    if filter_queries:
+      where_query = f"WHERE {' AND '.join(filter_queries)}"
 
+    from_query = 't'
+    # Whether the rows are joined with the ranked top k rowids of a vector search.
+    topk_ranked = False
     topk_udf_col = self._topk_udf_to_sort_by(udf_columns, sort_by, limit, sort_order)
     if topk_udf_col:
       path_keys: Optional[list[PathKey]] = None
@@ -876,14 +1395,26 @@ class DatasetDuckDB(Dataset):
         with DebugTimer(f'Computing topk on {path_id} with embedding "{topk_signal.embedding}" '
                         f'and vector store "{vector_index._vector_store.name}"'):
           topk = topk_signal.vector_compute_topk(k, vector_index, path_keys)
-        topk_rowids = list(dict.fromkeys([cast(str, rowid) for (rowid, *_), _ in topk]))
+        # The score of a row is the score of its best span, which comes first.
+        topk_scores: dict[str, Optional[float]] = {}
+        for (rowid, *_), score in topk:
+          topk_scores.setdefault(cast(str, rowid), score)
+        topk_rowids = list(topk_scores)
         # Update the offset to account for the number of unique rowids.
         offset = len(dict.fromkeys([cast(str, rowid) for (rowid, *_), _ in topk[:offset]]))
 
-        # Ignore all the other filters and filter DuckDB results only by the top k rowids.
-        rowid_filter = Filter(path=(ROWID,), op='in', value=topk_rowids)
-        filter_query = self._create_where(manifest, [rowid_filter])[0]
-        where_query = f'WHERE {filter_query}'
+        # Ignore all the other filters and join DuckDB results only with the top k rowids. The
+        # rowids are registered as a relation instead of being inlined in the query, so a large k
+        # doesn't need to be parsed, and their position keeps the ranking.
+        topk_table = pa.table({
+          ROWID: pa.array(topk_rowids, type=pa.string()),
+          TOPK_POSITION_COLUMN: pa.array(range(len(topk_rowids)), type=pa.int64()),
+          TOPK_SCORE_COLUMN: pa.array(list(topk_scores.values()), type=pa.float64())
+        })
+        con.register(TOPK_ROWIDS_VIEW, topk_table)
+        from_query = f't JOIN {TOPK_ROWIDS_VIEW} USING ({ROWID})'
+        topk_ranked = True
+        where_query = ''
 
     # Map a final column name to a list of temporary namespaced column names that need to be merged.
     columns_to_merge: dict[str, dict[str, Column]] = {}
@@ -955,10 +1486,41 @@ class DatasetDuckDB(Dataset):
       else:
         sort_sql_before_udf.append(sort_sql)
 
+    # Keyset pagination seeks past the last row of the previous page instead of skipping rows. This
+    # needs a single sort key computed by DuckDB, and the position of the row to break ties. When
+    # rows are not sorted, a table returns them in the order of their position.
+    row_sql = ROWID if self._view_or_table == 'VIEW' else 't.rowid'
+    can_seek = (not topk_udf_col and not sort_sql_after_udf and not udf_filters and
+                (len(sort_sql_before_udf) == 1 or
+                 (not sort_sql_before_udf and self._view_or_table == 'TABLE')))
+    seek_sort_sql = sort_sql_before_udf[0] if can_seek and sort_sql_before_udf else None
+
+    page_where_query = where_query
+    seek_params: list[Any] = []
+    if seek_cursor:
+      if not can_seek:
+        raise ValueError('The cursor does not match the query. Cursors can only be used with the '
+                         'query that returned them.')
+      seek_sql, seek_params = _seek_sql(seek_sort_sql, row_sql, sort_order, seek_cursor)
+      page_where_query = f'{where_query} AND {seek_sql}' if where_query else f'WHERE {seek_sql}'
+
+    if can_seek and limit:
+      cursor_fields = f"'row': {row_sql}"
+      if seek_sort_sql:
+        cursor_fields = f"'sort': {seek_sort_sql}, {cursor_fields}"
+      select_queries.append(f'{{{cursor_fields}}} AS {_escape_string_literal(CURSOR_COLUMN)}')
+
     order_query = ''
-    if sort_sql_before_udf:
+    if topk_ranked:
+      # Rows with the same score are sorted by the remaining sort keys, then by their rank.
+      order_sqls = [f'{TOPK_SCORE_COLUMN} DESC']
+      order_sqls.extend(f'{sql} {cast(SortOrder, sort_order).value}' for sql in sort_sql_before_udf)
+      order_query = f'ORDER BY {", ".join(order_sqls)}, {TOPK_POSITION_COLUMN}'
+    elif sort_sql_before_udf:
       order_query = (f'ORDER BY {", ".join(sort_sql_before_udf)} '
                      f'{cast(SortOrder, sort_order).value}')
+      if seek_sort_sql:
+        order_query += f', {row_sql}'
 
     limit_query = ''
     if limit:
@@ -973,16 +1535,192 @@ class DatasetDuckDB(Dataset):
       total_num_rows = cast(tuple,
                             con.execute(f'SELECT COUNT(*) FROM t {where_query}').fetchone())[0]
 
-    # Fetch the data from DuckDB.
-    df = con.execute(f"""
-      SELECT {', '.join(select_queries)} FROM t
-      {where_query}
+    if temp_rowid_selected:
+      del columns_to_merge[ROWID]
+
+    # The UDFs look up their inputs in `columns_to_merge`, so the combined columns are separate.
+    final_columns_to_merge = columns_to_merge
+    if combine_columns:
+      all_columns: dict[str, Column] = {}
+      for col_dict in columns_to_merge.values():
+        all_columns.update(col_dict)
+      final_columns_to_merge = {'*': all_columns}
+
+    query = f"""
+      SELECT {', '.join(select_queries)} FROM {from_query}
+      {page_where_query}
       {order_query}
       {limit_query}
-    """).df()
-    df = _replace_nan_with_none(df)
+    """
+    udf_filter_queries = self._create_where(manifest, udf_filters, con=con) if udf_filters else []
+    udf_sort_query = ''
+    if sort_sql_after_udf and not topk_ranked:
+      if not sort_order:
+        raise ValueError('`sort_order` is required when `sort_by` is specified.')
+      udf_sort_query = f'{", ".join(sort_sql_after_udf)} {sort_order.value}'
+
+    if arrow and not udf_columns and not combine_columns and all(
+        list(temp_columns) == [final_col_name]
+        for final_col_name, temp_columns in columns_to_merge.items()):
+      # The rows need no processing in Python, so the Arrow result of DuckDB is returned as is.
+      try:
+        table = con.execute(query, seek_params).arrow()
+      finally:
+        con.close()
+      table_cursor: Optional[SelectRowsCursor] = None
+      if CURSOR_COLUMN in table.column_names:
+        if limit and table.num_rows == limit:
+          table_cursor = _cursor_after_row(
+            table.column(CURSOR_COLUMN)[-1].as_py(), query_fingerprint)
+        table = table.drop([CURSOR_COLUMN])
+      if not can_seek and limit and table.num_rows == limit:
+        table_cursor = SelectRowsCursor(offset=page_offset + limit, query=query_fingerprint)
+      yield table, total_num_rows, _encode_cursor(table_cursor) if table_cursor else None
+      return
+
+    if arrow:
+      # The rows are processed in Python, so the table is typed by the schema of the selection. A
+      # column is typed by the destination path of its selection, or by the field it combines into.
+      arrow_schema = schema_to_arrow_schema(cast(Schema, combined_schema))
+      column_paths: dict[str, PathTuple] = {
+        final_col_name: (final_col_name,) if combine_columns else _col_destination_path(
+          next(iter(temp_columns.values())))
+        for final_col_name, temp_columns in columns_to_merge.items()
+      }
+
+    # Sorting on UDF outputs with a limit only keeps the top rows of each batch. Otherwise,
+    # filtering and sorting on UDF outputs needs all the rows, so it can't be streamed.
+    topk_after_udf = bool(udf_sort_query and limit)
+    if not topk_after_udf and (batch_size is None or udf_filters or sort_sql_after_udf):
+      dfs: Iterable[pd.DataFrame] = [con.execute(query, seek_params).df()]
+    elif not topk_after_udf:
+      dfs = _fetch_df_batches(con.execute(query, seek_params), cast(int, batch_size))
+      # Progress is reported by the caller since each batch only sees part of the data.
+      task_step_id = None
 
-    # Run UDFs on the transformed columns.
+    for udf_col in udf_columns:
+      cast(Signal, udf_col.signal_udf).setup()
+
+    try:
+      if topk_after_udf:
+        # The rows are streamed from a separate cursor, since running the top-k queries on the
+        # cursor of the result would invalidate it.
+        result_con = self.con.cursor()
+        try:
+          top_df, num_filtered_rows = self._topk_after_udfs(
+            con, result_con.execute(query, seek_params), udf_columns, columns_to_merge,
+            temp_column_to_offset_column, ' AND '.join(udf_filter_queries), udf_sort_query,
+            cast(int, limit) + offset, total_num_rows, task_step_id)
+        finally:
+          result_con.close()
+        if udf_filter_queries:
+          total_num_rows = num_filtered_rows
+        dfs = [top_df]
+
+      for df in dfs:
+        next_cursor: Optional[SelectRowsCursor] = None
+        if CURSOR_COLUMN in df:
+          # The cursor is read before NaNs are replaced, so a NaN sort key is not mistaken for NULL.
+          if limit and len(df) == limit:
+            next_cursor = _cursor_after_row(df[CURSOR_COLUMN].iloc[-1], query_fingerprint)
+          del df[CURSOR_COLUMN]
+        df = _replace_nan_with_none(df)
+        if not topk_after_udf:
+          self._compute_udfs(df, udf_columns, columns_to_merge, temp_column_to_offset_column,
+                             task_step_id)
+
+        if not df.empty and (udf_filters or sort_sql_after_udf):
+          # Re-upload the udf outputs to duckdb so we can filter/sort on them.
+          rel = con.from_df(df)
+
+          if udf_filters and not topk_after_udf:
+            if udf_filter_queries:
+              rel = rel.filter(' AND '.join(udf_filter_queries))
+              total_num_rows = cast(tuple, rel.count('*').fetchone())[0]
+
+          if udf_sort_query:
+            rel = rel.order(udf_sort_query)
+
+          if limit:
+            rel = rel.limit(limit, offset)
+
+          df = _replace_nan_with_none(rel.df())
+
+        if temp_rowid_selected:
+          del df[ROWID]
+
+        for offset_column, _ in temp_column_to_offset_column.values():
+          del df[offset_column]
+
+        if not can_seek and limit and len(df) == limit:
+          next_cursor = SelectRowsCursor(offset=page_offset + limit, query=query_fingerprint)
+
+        df = _merge_columns(df, final_columns_to_merge, combine_columns)
+        encoded_cursor = _encode_cursor(next_cursor) if next_cursor else None
+        if arrow:
+          yield _df_to_arrow_table(df, arrow_schema, column_paths), total_num_rows, encoded_cursor
+        else:
+          yield df, total_num_rows, encoded_cursor
+    finally:
+      # Runs when the generator is closed early too, e.g. when a paged caller stops reading.
+      for udf_col in udf_columns:
+        cast(Signal, udf_col.signal_udf).teardown()
+      con.close()
+
+  def _topk_after_udfs(self, con: duckdb.DuckDBPyConnection, result: duckdb.DuckDBPyConnection,
+                       udf_columns: list[Column], columns_to_merge: dict[str, dict[str, Column]],
+                       temp_column_to_offset_column: dict[str, tuple[str, Field]],
+                       udf_filter_query: str, udf_sort_query: str, k: int, estimated_len: int,
+                       task_step_id: Optional[TaskStepId]) -> tuple[pd.DataFrame, int]:
+    """Computes the UDFs one batch at a time, keeping only the top `k` rows sorted by their outputs.
+
+    Returns the top rows, and the number of rows that pass the UDF filter.
+    """
+    # Progress is reported once over the whole stream, since each batch only sees part of the rows.
+    progress_rows: Optional[Iterator[int]] = None
+    if task_step_id is not None:
+      signal_keys = ', '.join(cast(Signal, udf_col.signal_udf).key() for udf_col in udf_columns)
+      progress_rows = progress(
+        iter(range(estimated_len)),
+        task_step_id=task_step_id,
+        estimated_len=estimated_len,
+        step_description=f'Computing {signal_keys} on {self.namespace}/{self.dataset_name}')
+
+    vectors_per_chunk = max(1, SELECT_ROWS_BATCH_SIZE // duckdb.__standard_vector_size__)
+    top_df: Optional[pd.DataFrame] = None
+    num_filtered_rows = 0
+    while True:
+      df = result.fetch_df_chunk(vectors_per_chunk)
+      if df.empty and top_df is not None:
+        break
+      df = _replace_nan_with_none(df)
+      self._compute_udfs(df, udf_columns, columns_to_merge, temp_column_to_offset_column, None)
+      if progress_rows is not None:
+        _advance(progress_rows, len(df))
+      if df.empty:
+        # The query returned no rows.
+        top_df = df
+        break
+
+      rel = con.from_df(df)
+      if udf_filter_query:
+        rel = rel.filter(udf_filter_query)
+        num_filtered_rows += cast(tuple, rel.count('*').fetchone())[0]
+      df = rel.order(udf_sort_query).limit(k).df()
+      if top_df is not None:
+        candidates_df = pd.concat([top_df, df], ignore_index=True)
+        df = con.from_df(candidates_df).order(udf_sort_query).limit(k).df()
+      top_df = df
+    if progress_rows is not None:
+      # Completes the progress when the rows were fewer than estimated.
+      _advance(progress_rows, estimated_len)
+    return top_df, num_filtered_rows
+
+  def _compute_udfs(self, df: pd.DataFrame, udf_columns: list[Column],
+                    columns_to_merge: dict[str, dict[str, Column]],
+                    temp_column_to_offset_column: dict[str, tuple[str, Field]],
+                    task_step_id: Optional[TaskStepId]) -> None:
+    """Run the UDFs on the transformed columns, replacing their inputs in `df` with the outputs."""
     for udf_col in udf_columns:
       signal = cast(Signal, udf_col.signal_udf)
       signal_alias = udf_col.alias or _unique_alias(udf_col)
@@ -997,8 +1735,6 @@ class DatasetDuckDB(Dataset):
 
       path_id = f'{self.namespace}/{self.dataset_name}:{udf_col.path}'
       with DebugTimer(f'Computing signal "{signal.name}" on {path_id}'):
-        signal.setup()
-
         step_description = f'Computing {signal.key()} on {path_id}'
 
         if isinstance(signal, VectorSignal):
@@ -1043,68 +1779,6 @@ class DatasetDuckDB(Dataset):
 
           df[signal_column] = deep_unflatten(signal_out_list, input)
 
-        signal.teardown()
-
-    if not df.empty and (udf_filters or sort_sql_after_udf):
-      # Re-upload the udf outputs to duckdb so we can filter/sort on them.
-      rel = con.from_df(df)
-
-      if udf_filters:
-        udf_filter_queries = self._create_where(manifest, udf_filters)
-        if udf_filter_queries:
-          rel = rel.filter(' AND '.join(udf_filter_queries))
-          total_num_rows = cast(tuple, rel.count('*').fetchone())[0]
-
-      if sort_sql_after_udf:
-        if not sort_order:
-          raise ValueError('`sort_order` is required when `sort_by` is specified.')
-        rel = rel.order(f'{", ".join(sort_sql_after_udf)} {sort_order.value}')
-
-      if limit:
-        rel = rel.limit(limit, offset)
-
-      df = _replace_nan_with_none(rel.df())
-
-    if temp_rowid_selected:
-      del df[ROWID]
-      del columns_to_merge[ROWID]
-
-    if combine_columns:
-      all_columns: dict[str, Column] = {}
-      for col_dict in columns_to_merge.values():
-        all_columns.update(col_dict)
-      columns_to_merge = {'*': all_columns}
-
-    for offset_column, _ in temp_column_to_offset_column.values():
-      del df[offset_column]
-
-    for final_col_name, temp_columns in columns_to_merge.items():
-      for temp_col_name, column in temp_columns.items():
-        if combine_columns:
-          dest_path = _col_destination_path(column)
-          spec = _split_path_into_subpaths_of_lists(dest_path)
-          df[temp_col_name] = wrap_in_dicts(df[temp_col_name], spec)
-
-        # If the temp col name is the same as the final name, we can skip merging. This happens when
-        # we select a source leaf column.
-        if temp_col_name == final_col_name:
-          continue
-
-        if final_col_name not in df:
-          df[final_col_name] = df[temp_col_name]
-        else:
-          df[final_col_name] = merge_series(df[final_col_name], df[temp_col_name])
-        del df[temp_col_name]
-
-    con.close()
-
-    if combine_columns:
-      # Since we aliased every column to `*`, the object with have only '*' as the key. We need to
-      # elevate the all the columns under '*'.
-      df = pd.DataFrame.from_records(df['*'])
-
-    return SelectRowsResult(df, total_num_rows)
-
   @override
   def select_rows_schema(self,
                          columns: Optional[Sequence[ColumnId]] = None,
@@ -1153,6 +1827,16 @@ class DatasetDuckDB(Dataset):
     return SelectRowsSchemaResult(
       data_schema=new_schema, udfs=udfs, search_results=search_results, sorts=sort_results or None)
 
+  @override
+  def vector_topk_batch(self, embedding: str, path: Path, queries: np.ndarray,
+                        k: int) -> list[list[tuple[PathKey, float]]]:
+    path = normalize_path(path)
+    vector_index = self._get_vector_db_index(embedding, path)
+    path_id = f'{self.namespace}/{self.dataset_name}:{path}'
+    with DebugTimer(f'Computing topk for {len(queries)} queries on {path_id} with embedding '
+                    f'"{embedding}"'):
+      return vector_index.topk_batch(queries, k)
+
   @override
   def media(self, item_id: str, leaf_path: Path) -> MediaResult:
     raise NotImplementedError('Media is not yet supported for the DuckDB implementation.')
@@ -1325,7 +2009,12 @@ class DatasetDuckDB(Dataset):
   def _create_where(self,
                     manifest: DatasetManifest,
                     filters: list[Filter],
-                    searches: Optional[Sequence[Search]] = []) -> list[str]:
+                    searches: Optional[Sequence[Search]] = [],
+                    con: Optional[duckdb.DuckDBPyConnection] = None) -> list[str]:
+    """Returns the SQL predicates of the filters and searches.
+
+    When `con` is defined, the values of large `in` filters are registered on it as a relation.
+    """
     if not filters and not searches:
       return []
     searches = searches or []
@@ -1386,8 +2075,12 @@ class DatasetDuckDB(Dataset):
           filter_list_val = cast(FeatureListValue, f.value)
           if not isinstance(filter_list_val, list):
             raise ValueError('filter with array value can only use the IN comparison')
-          wrapped_filter_val = [f"'{part}'" for part in filter_list_val]
-          filter_val = f'({", ".join(wrapped_filter_val)})'
+          if con is not None and len(filter_list_val) > IN_FILTER_MAX_LITERALS:
+            view_name = f'__in_filter_{next(_in_filter_ids)}__'
+            con.register(view_name, pa.table({'value': pa.array(filter_list_val, pa.string())}))
+            filter_val = f'(SELECT value FROM {view_name})'
+          else:
+            filter_val = f'({", ".join(_escape_string_literal(part) for part in filter_list_val)})'
           filter_query = f'{select_str} IN {filter_val}'
         else:
           raise ValueError(f'List op: {f.op} is not yet supported')
@@ -1484,6 +2177,128 @@ class DatasetDuckDB(Dataset):
     log(f'Dataset exported to {filepath}')
 
 
+def _encode_cursor(cursor: SelectRowsCursor) -> str:
+  return base64.urlsafe_b64encode(cursor.json(exclude_none=True).encode('utf-8')).decode('ascii')
+
+
+def _decode_cursor(cursor: str) -> SelectRowsCursor:
+  try:
+    return SelectRowsCursor.parse_raw(base64.urlsafe_b64decode(cursor.encode('ascii')))
+  except ValueError as e:
+    raise ValueError(f'Invalid cursor: "{cursor}".') from e
+
+
+def _query_fingerprint(sort_by: Sequence[PathTuple], sort_order: Optional[SortOrder],
+                       filters: Sequence[Filter], searches: Optional[Sequence[Search]]) -> str:
+  """Returns a short hash of the parts of a query that decide which rows a cursor points to."""
+  parts = [
+    list(sort_by), sort_order.value if sort_order else None, [f.json() for f in filters],
+    [search.json() for search in searches or []]
+  ]
+  return hashlib.sha256(json.dumps(parts).encode('utf-8')).hexdigest()[:16]
+
+
+def _cursor_after_row(row: dict[str, Any], query: str) -> SelectRowsCursor:
+  """Returns the cursor that seeks past a row, given the value of its `CURSOR_COLUMN`."""
+  sort_value = row.get('sort')
+  if isinstance(sort_value, np.generic):
+    sort_value = sort_value.item()
+  if isinstance(sort_value, date) and not isinstance(sort_value, datetime):
+    sort_value = datetime.combine(sort_value, datetime.min.time())
+  if isinstance(sort_value, datetime):
+    return SelectRowsCursor(sort_datetime=sort_value, row=row['row'], query=query)
+  return SelectRowsCursor(sort_value=sort_value, row=row['row'], query=query)
+
+
+def _seek_sql(sort_sql: Optional[str], row_sql: str, sort_order: Optional[SortOrder],
+              cursor: SelectRowsCursor) -> tuple[str, list[Any]]:
+  """Returns the predicate, and its parameters, that selects the rows after the cursor."""
+  if not sort_sql:
+    return f'{row_sql} > ?', [cursor.row]
+  sort_value = cursor.sort_datetime if cursor.sort_datetime is not None else cursor.sort_value
+  # NULLs are sorted last, in both orders.
+  if sort_value is None:
+    return f'({sort_sql} IS NULL AND {row_sql} > ?)', [cursor.row]
+  op = '<' if sort_order == SortOrder.DESC else '>'
+  return (f'({sort_sql} {op} ? OR ({sort_sql} = ? AND {row_sql} > ?) OR {sort_sql} IS NULL)',
+          [sort_value, sort_value, cursor.row])
+
+
+def _df_to_arrow_table(df: pd.DataFrame, arrow_schema: pa.Schema,
+                       column_paths: dict[str, PathTuple]) -> pa.Table:
+  """Converts the selected rows to an Arrow table, with the types of the columns in the schema."""
+  arrays: list[pa.Array] = []
+  for name in df.columns:
+    # Columns that are not in the schema, e.g. the rowid, are typed from their values.
+    arrow_type = _arrow_type_at_path(arrow_schema, column_paths.get(name, (name,)))
+    arrays.append(pa.array(df[name], type=arrow_type, from_pandas=True))
+  return pa.Table.from_arrays(arrays, names=list(df.columns))
+
+
+def _arrow_type_at_path(arrow_schema: pa.Schema, path: PathTuple) -> Optional[pa.DataType]:
+  """Returns the type of the values at a path, with a list for every repeated field on the way."""
+  if path[0] not in arrow_schema.names:
+    return None
+  arrow_type = arrow_schema.field(path[0]).type
+  num_lists = 0
+  for part in path[1:]:
+    # Repeated fields are unnested whether or not the path has a wildcard.
+    while pa.types.is_list(arrow_type):
+      arrow_type = arrow_type.value_type
+      num_lists += 1
+    if part == PATH_WILDCARD:
+      continue
+    if not pa.types.is_struct(arrow_type) or arrow_type.get_field_index(part) < 0:
+      return None
+    arrow_type = arrow_type.field(part).type
+  for _ in range(num_lists):
+    arrow_type = pa.list_(arrow_type)
+  return arrow_type
+
+
+def _fetch_df_batches(result: duckdb.DuckDBPyConnection, batch_size: int) -> Iterator[pd.DataFrame]:
+  """Fetches a query result as data frames of roughly `batch_size` rows."""
+  vectors_per_chunk = max(1, batch_size // duckdb.__standard_vector_size__)
+  while True:
+    df = result.fetch_df_chunk(vectors_per_chunk)
+    if df.empty:
+      return
+    yield df
+
+
+def _advance(it: Iterator[Any], n: int) -> None:
+  """Advances an iterator by `n` items, or until it is exhausted."""
+  next(itertools.islice(it, n, n), None)
+
+
+def _merge_columns(df: pd.DataFrame, columns_to_merge: dict[str, dict[str, Column]],
+                   combine_columns: bool) -> pd.DataFrame:
+  """Merge the temporary namespaced columns into their final columns."""
+  for final_col_name, temp_columns in columns_to_merge.items():
+    for temp_col_name, column in temp_columns.items():
+      if combine_columns:
+        dest_path = _col_destination_path(column)
+        spec = _split_path_into_subpaths_of_lists(dest_path)
+        df[temp_col_name] = wrap_in_dicts(df[temp_col_name], spec)
+
+      # If the temp col name is the same as the final name, we can skip merging. This happens when
+      # we select a source leaf column.
+      if temp_col_name == final_col_name:
+        continue
+
+      if final_col_name not in df:
+        df[final_col_name] = df[temp_col_name]
+      else:
+        df[final_col_name] = merge_series(df[final_col_name], df[temp_col_name])
+      del df[temp_col_name]
+
+  if combine_columns:
+    # Since we aliased every column to `*`, the object with have only '*' as the key. We need to
+    # elevate the all the columns under '*'.
+    df = pd.DataFrame.from_records(df['*'])
+  return df
+
+
 def _escape_string_literal(string: str) -> str:
   string = string.replace("'", "''")
   return f"'{string}'"
@@ -1741,6 +2556,29 @@ def _root_column(manifest: SignalManifest) -> str:
   return next(filter(lambda field: field != ROWID, manifest.data_schema.fields.keys()))
 
 
+def _column_group_fingerprints(view_or_table: str, source_files: list[str],
+                               signal_manifests: list[SignalManifest],
+                               signal_files_by_id: dict[str, list[str]]) -> dict[str, str]:
+  """Returns a fingerprint for each column group that makes up the joint table.
+
+  A fingerprint changes when its manifest is edited, or when any of the parquet files it points to
+  is rewritten. The source fingerprint also covers whether `t` is a view or a table.
+  """
+  fingerprints = {SOURCE_VIEW_NAME: _files_fingerprint([view_or_table], source_files)}
+  for manifest in signal_manifests:
+    if manifest.files:
+      fingerprints[manifest.parquet_id] = _files_fingerprint(
+        [manifest.json(exclude_none=True)], signal_files_by_id[manifest.parquet_id])
+  return fingerprints
+
+
+def _files_fingerprint(parts: list[Any], filepaths: list[str]) -> str:
+  for filepath in filepaths:
+    stat = os.stat(filepath)
+    parts.append((filepath, stat.st_size, stat.st_mtime_ns))
+  return hashlib.sha256(json.dumps(parts).encode('utf-8')).hexdigest()
+
+
 def _derived_from_path(path: PathTuple, schema: Schema) -> PathTuple:
   # Find the closest parent of `path` that is a signal root.
   for i in reversed(range(len(path))):
@@ -0,0 +1,477 @@
+"""Tests for DuckDB-specific behavior of the dataset, like the persistent catalog."""
+
+import os
+from typing import Any, Generator, Iterable, Optional, cast
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pytest
+from pytest_mock import MockerFixture
+from typing_extensions import override
+
+from ..embeddings.vector_store import VectorDBIndex
+from ..schema import ROWID, VALUE_KEY, Field, Item, RichData, field, lilac_embedding, schema
+from ..signal import TextEmbeddingSignal, TextSignal, clear_signal_registry, register_signal
+from . import dataset_duckdb
+from .dataset import Column, Dataset, FilterLike, SortOrder, StatsResult
+from .dataset_duckdb import (
+  DUCKDB_CACHE_DIR,
+  DUCKDB_CACHE_FILENAME,
+  SPLICED_BASE_TABLE,
+  STATS_FILENAME,
+  DatasetDuckDB,
+)
+from .dataset_test_utils import TEST_DATASET_NAME, TEST_NAMESPACE, TestDataMaker, enriched_item
+
+SIMPLE_ITEMS: list[Item] = [{'str': 'a'}, {'str': 'bb'}, {'str': 'ccc'}]
+
+
+class LengthSignal(TextSignal):
+  name = 'length_signal'
+
+  @override
+  def fields(self) -> Field:
+    return field('int32')
+
+  @override
+  def compute(self, data: Iterable[RichData]) -> Iterable[Optional[Item]]:
+    for text_content in data:
+      yield len(text_content)
+
+
+class UpperSignal(TextSignal):
+  name = 'upper_signal'
+
+  @override
+  def fields(self) -> Field:
+    return field('string')
+
+  @override
+  def compute(self, data: Iterable[RichData]) -> Iterable[Optional[Item]]:
+    for text_content in data:
+      yield cast(str, text_content).upper()
+
+
+class LengthEmbedding(TextEmbeddingSignal):
+  name = 'length_embedding'
+
+  @override
+  def compute(self, data: Iterable[RichData]) -> Iterable[Item]:
+    for text_content in data:
+      yield [lilac_embedding(0, len(text_content), np.array([1.0, len(text_content)]))]
+
+
+@pytest.fixture(scope='module', autouse=True)
+def setup_teardown() -> Iterable[None]:
+  # Setup.
+  clear_signal_registry()
+  register_signal(LengthSignal)
+  register_signal(UpperSignal)
+  register_signal(LengthEmbedding)
+
+  # Unit test runs.
+  yield
+
+  # Teardown.
+  clear_signal_registry()
+
+
+def test_persistent_catalog_is_reused(make_test_data: TestDataMaker, mocker: MockerFixture) -> None:
+  mocker.patch.dict(os.environ, {'DUCKDB_PERSIST': '1'})
+  dataset = make_test_data(SIMPLE_ITEMS)
+  assert isinstance(dataset, DatasetDuckDB)
+  assert os.path.exists(os.path.join(dataset.dataset_path, DUCKDB_CACHE_DIR, DUCKDB_CACHE_FILENAME))
+  assert dataset.manifest().num_items == 3
+
+  # Re-opening the dataset reuses the persisted table.
+  create_joint_table = mocker.spy(DatasetDuckDB, '_create_joint_table')
+  reopened = DatasetDuckDB(TEST_NAMESPACE, TEST_DATASET_NAME)
+  assert reopened.manifest().num_items == 3
+  assert create_joint_table.call_count == 0
+  assert list(reopened.select_rows(['str'])) == [{'str': 'a'}, {'str': 'bb'}, {'str': 'ccc'}]
+
+  # Adding a signal changes the manifests, which updates the persisted table.
+  reopened.compute_signal(LengthSignal(), 'str')
+  reopened = DatasetDuckDB(TEST_NAMESPACE, TEST_DATASET_NAME)
+  assert list(reopened.select_rows(['str'], combine_columns=True)) == [{
+    'str': enriched_item('a', {'length_signal': 1})
+  }, {
+    'str': enriched_item('bb', {'length_signal': 2})
+  }, {
+    'str': enriched_item('ccc', {'length_signal': 3})
+  }]
+  assert create_joint_table.call_count == 0
+
+
+def test_in_memory_catalog_by_default(make_test_data: TestDataMaker) -> None:
+  dataset = make_test_data(SIMPLE_ITEMS)
+  assert isinstance(dataset, DatasetDuckDB)
+  assert not os.path.exists(os.path.join(dataset.dataset_path, DUCKDB_CACHE_DIR))
+
+
+def test_signal_columns_are_updated_incrementally(make_test_data: TestDataMaker,
+                                                  mocker: MockerFixture) -> None:
+  dataset = make_test_data(SIMPLE_ITEMS)
+  dataset.compute_signal(LengthSignal(), 'str')
+  dataset.manifest()
+
+  create_joint_table = mocker.spy(DatasetDuckDB, '_create_joint_table')
+  dataset.compute_signal(UpperSignal(), 'str')
+  assert list(dataset.select_rows(['str'], combine_columns=True)) == [{
+    'str': enriched_item('a', {
+      'length_signal': 1,
+      'upper_signal': 'A'
+    })
+  }, {
+    'str': enriched_item('bb', {
+      'length_signal': 2,
+      'upper_signal': 'BB'
+    })
+  }, {
+    'str': enriched_item('ccc', {
+      'length_signal': 3,
+      'upper_signal': 'CCC'
+    })
+  }]
+
+  dataset.delete_signal(('str', 'length_signal'))
+  assert list(dataset.select_rows(['str'], combine_columns=True)) == [{
+    'str': enriched_item('a', {'upper_signal': 'A'})
+  }, {
+    'str': enriched_item('bb', {'upper_signal': 'BB'})
+  }, {
+    'str': enriched_item('ccc', {'upper_signal': 'CCC'})
+  }]
+  assert isinstance(dataset, DatasetDuckDB)
+  columns = [row[0] for row in dataset.con.execute('DESCRIBE t').fetchall()]
+  assert 'str.length_signal' not in columns
+
+  # Only the changed column groups were touched.
+  assert create_joint_table.call_count == 0
+
+
+def test_added_signals_are_spliced_without_rewriting_the_table(make_test_data: TestDataMaker,
+                                                               mocker: MockerFixture) -> None:
+  dataset = make_test_data(SIMPLE_ITEMS)
+  assert isinstance(dataset, DatasetDuckDB)
+  base_columns = [row[0] for row in dataset.con.execute('DESCRIBE t').fetchall()]
+
+  dataset.compute_signal(LengthSignal(), 'str')
+  dataset.compute_signal(UpperSignal(), 'str')
+  dataset.manifest()
+  # The table keeps its columns, and `t` joins it with the new column groups.
+  assert dataset.con.execute(
+    "SELECT table_type FROM information_schema.tables WHERE table_name = 't'").fetchone() == (
+      'VIEW',)
+  assert [row[0] for row in dataset.con.execute(f'DESCRIBE {SPLICED_BASE_TABLE}').fetchall()
+         ] == base_columns
+  assert list(dataset.select_rows(['str.upper_signal'])) == [{
+    'str.upper_signal': 'A'
+  }, {
+    'str.upper_signal': 'BB'
+  }, {
+    'str.upper_signal': 'CCC'
+  }]
+
+  # Too many spliced column groups rebuild the table.
+  mocker.patch.object(dataset_duckdb, 'MAX_SPLICED_COLUMN_GROUPS', 0)
+  create_joint_table = mocker.spy(DatasetDuckDB, '_create_joint_table')
+  dataset.delete_signal(('str', 'length_signal'))
+  dataset.manifest()
+  assert create_joint_table.call_count == 1
+  assert dataset.con.execute(
+    "SELECT table_type FROM information_schema.tables WHERE table_name = 't'").fetchone() == (
+      'BASE TABLE',)
+  assert list(dataset.select_rows(['str.upper_signal'])) == [{
+    'str.upper_signal': 'A'
+  }, {
+    'str.upper_signal': 'BB'
+  }, {
+    'str.upper_signal': 'CCC'
+  }]
+
+
+def test_manifest_is_cached_by_generation(make_test_data: TestDataMaker,
+                                          mocker: MockerFixture) -> None:
+  dataset = make_test_data(SIMPLE_ITEMS)
+  assert isinstance(dataset, DatasetDuckDB)
+  dataset.manifest()
+
+  walk = mocker.spy(os, 'walk')
+  dataset.manifest()
+  dataset.select_rows(['str'])
+  assert walk.call_count == 0
+
+  # Writers bump the generation, which invalidates the cached manifest.
+  dataset.compute_signal(LengthSignal(), 'str')
+  assert dataset.manifest().data_schema.has_field(('str', 'length_signal'))
+  assert walk.call_count == 1
+
+  dataset.delete_signal(('str', 'length_signal'))
+  assert not dataset.manifest().data_schema.has_field(('str', 'length_signal'))
+  assert walk.call_count == 2
+
+
+def test_stats_are_persisted(make_test_data: TestDataMaker, mocker: MockerFixture) -> None:
+  dataset = make_test_data(SIMPLE_ITEMS)
+  assert isinstance(dataset, DatasetDuckDB)
+  expected_stats = StatsResult(
+    path=('str',), total_count=3, approx_count_distinct=3, avg_text_length=2)
+  assert dataset.stats('str') == expected_stats
+  assert os.path.exists(os.path.join(dataset.dataset_path, STATS_FILENAME))
+
+  # Re-opening the dataset reads the stats from disk.
+  sketch_stats = mocker.spy(DatasetDuckDB, '_sketch_stats')
+  reopened = DatasetDuckDB(TEST_NAMESPACE, TEST_DATASET_NAME)
+  assert reopened.stats('str') == expected_stats
+  assert sketch_stats.call_count == 0
+
+
+def test_signal_stats_are_computed_eagerly(make_test_data: TestDataMaker,
+                                           mocker: MockerFixture) -> None:
+  dataset = make_test_data(SIMPLE_ITEMS)
+  dataset.compute_signal(LengthSignal(), 'str')
+
+  sketch_stats = mocker.spy(DatasetDuckDB, '_sketch_stats')
+  assert dataset.stats('str.length_signal') == StatsResult(
+    path=('str', 'length_signal'), total_count=3, approx_count_distinct=3, min_val=1, max_val=3)
+  assert sketch_stats.call_count == 0
+
+  # Re-computing the signal invalidates its stats, and fills them again.
+  dataset.compute_signal(LengthSignal(), 'str')
+  assert sketch_stats.call_count == 1
+  dataset.stats('str.length_signal')
+  assert sketch_stats.call_count == 1
+
+
+def test_stats_from_sketches(make_test_data: TestDataMaker, mocker: MockerFixture) -> None:
+  compute_stats = mocker.spy(DatasetDuckDB, '_compute_stats')
+  dataset = make_test_data([{'str': 'a', 'int': 1}, {'str': 'bb', 'int': 5}, {'str': 'bb'}])
+
+  assert dataset.stats('str') == StatsResult(
+    path=('str',), total_count=3, approx_count_distinct=2, avg_text_length=1)
+  assert dataset.stats('int') == StatsResult(
+    path=('int',), total_count=2, approx_count_distinct=2, min_val=1, max_val=5)
+  # The sketches were written with the parquet file, so the data was never scanned.
+  assert compute_stats.call_count == 0
+
+
+def test_select_rows_iter(make_test_data: TestDataMaker) -> None:
+  items: list[Item] = [{'str': 'a' * (i % 7)} for i in range(5000)]
+  dataset = make_test_data(items)
+  signal_col = Column('str', signal_udf=LengthSignal())
+
+  batches = list(dataset.select_rows_iter(['str', signal_col], batch_size=2048))
+  assert [len(df) for df in batches] == [2048, 2048, 904]
+
+  expected_df = dataset.select_rows(['str', signal_col]).df()
+  pd.testing.assert_frame_equal(pd.concat(batches, ignore_index=True), expected_df)
+
+
+def test_select_rows_iter_tears_down_when_closed_early(make_test_data: TestDataMaker,
+                                                       mocker: MockerFixture) -> None:
+  dataset = make_test_data([{'str': 'a' * (i % 7)} for i in range(5000)])
+  teardown_mock = mocker.spy(LengthSignal, 'teardown')
+
+  batches = cast(
+    Generator,
+    dataset.select_rows_iter(['str', Column('str', signal_udf=LengthSignal())], batch_size=2048))
+  assert len(next(batches)) == 2048
+  assert teardown_mock.call_count == 0
+  batches.close()
+  assert teardown_mock.call_count == 1
+
+
+def _select_pages(dataset: Dataset, page_size: int, **kwargs: Any) -> list[list[Item]]:
+  """Select all the rows, following the cursors page by page."""
+  pages: list[list[Item]] = []
+  cursor: Optional[str] = None
+  while True:
+    res = dataset.select_rows(limit=page_size, cursor=cursor, **kwargs)
+    pages.append(list(res))
+    cursor = res.next_cursor
+    if not cursor:
+      return pages
+
+
+@pytest.mark.parametrize('sort_order', [SortOrder.ASC, SortOrder.DESC])
+def test_select_rows_cursor(make_test_data: TestDataMaker, sort_order: SortOrder) -> None:
+  items: list[Item] = [{'id': i, 'num': i % 4 if i % 5 != 4 else None} for i in range(23)]
+  dataset = make_test_data(items, schema=schema({'id': 'int32', 'num': 'int32'}))
+
+  for sort_by in [None, ['num']]:
+    expected = list(dataset.select_rows(['id'], sort_by=sort_by, sort_order=sort_order, limit=None))
+    pages = _select_pages(dataset, 5, columns=['id'], sort_by=sort_by, sort_order=sort_order)
+    assert [len(page) for page in pages] == [5, 5, 5, 5, 3]
+    assert [row for page in pages for row in page] == expected
+
+  # Filters are applied to every page.
+  filters: list[FilterLike] = [('num', 'greater', 0)]
+  expected = list(dataset.select_rows(['id'], filters=filters, sort_by=['num'], limit=None))
+  pages = _select_pages(dataset, 4, columns=['id'], filters=filters, sort_by=['num'])
+  assert [row for page in pages for row in page] == expected
+
+
+def test_select_rows_cursor_from_another_query(make_test_data: TestDataMaker) -> None:
+  dataset = make_test_data(SIMPLE_ITEMS)
+  res = dataset.select_rows(['str'], sort_by=['str'], limit=2)
+  assert res.next_cursor
+
+  signal_col = Column('str', signal_udf=LengthSignal(), alias='len')
+  with pytest.raises(ValueError, match='does not match the query'):
+    dataset.select_rows(['str', signal_col], sort_by=['len'], limit=2, cursor=res.next_cursor)
+
+  # Queries that can both seek still need the same sort and filters.
+  with pytest.raises(ValueError, match='does not match the query'):
+    dataset.select_rows(['str'],
+                        sort_by=['str'],
+                        sort_order=SortOrder.ASC,
+                        limit=2,
+                        cursor=res.next_cursor)
+  with pytest.raises(ValueError, match='does not match the query'):
+    dataset.select_rows(['str'],
+                        sort_by=['str'],
+                        filters=[('str', 'not_equal', 'a')],
+                        limit=2,
+                        cursor=res.next_cursor)
+
+  with pytest.raises(ValueError, match='Invalid cursor'):
+    dataset.select_rows(['str'], sort_by=['str'], limit=2, cursor='not-a-cursor')
+
+
+def test_select_rows_cursor_sorted_by_udf(make_test_data: TestDataMaker) -> None:
+  dataset = make_test_data([{'str': 'a' * (i % 7 + 1)} for i in range(10)])
+  signal_col = Column('str', signal_udf=LengthSignal(), alias='len')
+
+  expected = list(dataset.select_rows(['str', signal_col], sort_by=['len'], limit=None))
+  pages = _select_pages(dataset, 4, columns=['str', signal_col], sort_by=['len'])
+  assert [row for page in pages for row in page] == expected
+
+
+def test_select_rows_sorted_by_udf_keeps_topk(make_test_data: TestDataMaker,
+                                              mocker: MockerFixture) -> None:
+  items: list[Item] = [{'str': 'a' * ((i * 7) % 11)} for i in range(5000)]
+  dataset = make_test_data(items)
+  signal_col = Column('str', signal_udf=LengthSignal(), alias='len')
+  all_rows = list(dataset.select_rows(['str', signal_col], sort_by=['len'], limit=None))
+
+  mocker.patch.object(dataset_duckdb, 'SELECT_ROWS_BATCH_SIZE', 2048)
+  compute_udfs = mocker.spy(DatasetDuckDB, '_compute_udfs')
+  concat_lengths: list[int] = []
+  concat = pd.concat
+
+  def recording_concat(*args: Any, **kwargs: Any) -> Any:
+    result = concat(*args, **kwargs)
+    concat_lengths.append(len(result))
+    return result
+
+  mocker.patch.object(pd, 'concat', side_effect=recording_concat)
+  progress = mocker.spy(dataset_duckdb, 'progress')
+  res = dataset.select_rows(['str', signal_col],
+                            sort_by=['len'],
+                            limit=3,
+                            offset=2,
+                            task_step_id=('', 0))
+  # The top rows match a full sort.
+  assert list(res) == all_rows[2:5]
+  assert res.total_num_rows == 5000
+
+  # The UDF is computed one batch at a time, never over the whole table, and only the top
+  # `limit + offset` rows are kept between batches.
+  batch_sizes = [len(call.args[1]) for call in compute_udfs.call_args_list]
+  assert sum(batch_sizes) == 5000 and max(batch_sizes) <= 2048
+  assert concat_lengths and max(concat_lengths) <= 2 * 5
+  # Progress is reported once, over every row.
+  assert [call.kwargs['estimated_len'] for call in progress.call_args_list] == [5000]
+
+
+@pytest.mark.parametrize('vector_store', ['numpy', 'hnsw'])
+def test_compute_embedding_only_embeds_new_rows(make_test_data: TestDataMaker,
+                                                mocker: MockerFixture, vector_store: str) -> None:
+  dataset = cast(DatasetDuckDB, make_test_data(SIMPLE_ITEMS))
+  dataset.vector_store = vector_store
+  dataset.compute_embedding('length_embedding', 'str')
+  rowids = {row[ROWID]: row['str'] for row in dataset.select_rows([ROWID, 'str'])}
+
+  # Simulate a row that was added to the dataset after its embedding was computed.
+  output_dir = os.path.join(dataset.dataset_path, 'str', 'length_embedding')
+  vector_index = VectorDBIndex(vector_store)
+  vector_index.load(output_dir)
+  new_rowid = next(rowid for rowid, text in rowids.items() if text == 'bb')
+  vector_index.delete([(new_rowid,)])
+  vector_index.save(output_dir)
+  vector_index = dataset._get_vector_db_index('length_embedding', ('str',))
+  assert vector_index.get_vector_store().size() == 2
+
+  embedded_texts: list[RichData] = []
+  compute = LengthEmbedding.compute
+
+  def _compute(self: LengthEmbedding, data: Iterable[RichData]) -> Iterable[Item]:
+    data = list(data)
+    embedded_texts.extend(data)
+    return compute(self, data)
+
+  mocker.patch.object(LengthEmbedding, 'compute', _compute)
+  dataset.compute_embedding('length_embedding', 'str')
+  assert embedded_texts == ['bb']
+
+  vector_index = dataset._get_vector_db_index('length_embedding', ('str',))
+  assert sorted(vector_index.path_keys()) == sorted((rowid,) for rowid in rowids)
+  [[span_vector]] = list(vector_index.get([(new_rowid,)]))
+  np.testing.assert_array_equal(span_vector['vector'], [1.0, 2.0])
+
+  # Nothing is embedded when every row is in the index.
+  embedded_texts.clear()
+  dataset.compute_embedding('length_embedding', 'str')
+  assert embedded_texts == []
+
+
+def test_vector_topk_batch(make_test_data: TestDataMaker) -> None:
+  dataset = make_test_data(SIMPLE_ITEMS)
+  dataset.compute_embedding('length_embedding', 'str')
+  rowid_texts = {row[ROWID]: row['str'] for row in dataset.select_rows([ROWID, 'str'])}
+
+  results = dataset.vector_topk_batch('length_embedding', 'str', np.array([[0, 1], [1, -1]]), k=2)
+
+  topk_texts = [[rowid_texts[rowid] for (rowid, *_), _ in topk] for topk in results]
+  assert topk_texts == [['ccc', 'bb'], ['a', 'bb']]
+  assert [[score for _, score in topk] for topk in results] == [[3, 2], [0, -1]]
+
+
+def test_select_rows_arrow(make_test_data: TestDataMaker, mocker: MockerFixture) -> None:
+  dataset = make_test_data([{'str': 'a', 'int': 1}, {'str': 'bb', 'int': 2}, {'str': 'ccc'}])
+  df_to_arrow_table = mocker.spy(dataset_duckdb, '_df_to_arrow_table')
+
+  # Plain columns are returned from DuckDB as is, named by their aliases.
+  res = dataset.select_rows_arrow(['str', Column('int', alias='my.int')], limit=2)
+  assert res.table.to_pylist() == [{'str': 'a', 'my.int': 1}, {'str': 'bb', 'my.int': 2}]
+  assert res.table.schema.field('my.int').type == pa.int32()
+  assert res.total_num_rows == 3
+  assert res.next_cursor
+  assert df_to_arrow_table.call_count == 0
+
+  # UDF columns are computed in Python, and typed by the path of their selection.
+  udf = Column('str', alias='len.str', signal_udf=LengthSignal())
+  res = dataset.select_rows_arrow([Column('int', alias='my.int'), udf],
+                                  filters=[('int', 'equals', 3)])
+  assert res.table.num_rows == 0
+  assert res.table.schema.field('my.int').type == pa.int32()
+  assert res.table.schema.field('len.str').type == pa.int32()
+  assert df_to_arrow_table.call_count == 1
+
+  # Combined columns are typed by the field they combine into.
+  res = dataset.select_rows_arrow(['int', 'str', udf], combine_columns=True)
+  assert res.table.schema.field('int').type == pa.int32()
+  assert res.table.schema.field('str').type == pa.struct([('length_signal', pa.int32()),
+                                                          (VALUE_KEY, pa.string())])
+  assert res.table.to_pylist() == [{
+    'int': 1,
+    'str': enriched_item('a', {'length_signal': 1})
+  }, {
+    'int': 2,
+    'str': enriched_item('bb', {'length_signal': 2})
+  }, {
+    'int': None,
+    'str': enriched_item('ccc', {'length_signal': 3})
+  }]
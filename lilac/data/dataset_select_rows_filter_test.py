@@ -4,6 +4,7 @@ import pytest
 
 from ..schema import ROWID, Item, schema
 from .dataset import BinaryFilterTuple, ListFilterTuple, UnaryFilterTuple
+from .dataset_duckdb import IN_FILTER_MAX_LITERALS
 from .dataset_test_utils import TestDataMaker
 
 TEST_DATA: list[Item] = [{
@@ -145,6 +146,20 @@ def test_filter_by_list_of_ids(make_test_data: TestDataMaker) -> None:
   }]
 
 
+def test_filter_by_long_list_of_ids(make_test_data: TestDataMaker) -> None:
+  dataset = make_test_data(TEST_DATA)
+
+  # The values are joined as a relation instead of being inlined in the query.
+  ids = ['1', '2', *(f'missing_{i}' for i in range(IN_FILTER_MAX_LITERALS))]
+  filter: ListFilterTuple = (ROWID, 'in', ids)
+  result = dataset.select_rows([ROWID], filters=[filter])
+  assert list(result) == [{ROWID: '1'}, {ROWID: '2'}]
+  assert result.total_num_rows == 2
+
+  groups = dataset.select_groups('str', filters=[filter])
+  assert sorted(groups.counts) == [('a', 1), ('b', 1)]
+
+
 def test_filter_by_exists(make_test_data: TestDataMaker) -> None:
   items: list[Item] = [{
     'name': 'A',
@@ -4,6 +4,7 @@ from typing import Iterable, Optional, Sequence, cast
 
 import numpy as np
 import pytest
+from pytest_mock import MockerFixture
 from typing_extensions import override
 
 from ..embeddings.vector_store import VectorDBIndex
@@ -27,6 +28,7 @@ from ..signal import (
   register_signal,
 )
 from .dataset import Column, SortOrder
+from .dataset_duckdb import DatasetDuckDB
 from .dataset_test_utils import TestDataMaker, enriched_item
 
 
@@ -732,6 +734,47 @@ def test_sort_by_topk_embedding_udf(make_test_data: TestDataMaker) -> None:
   }]
 
 
+def test_sort_by_topk_udf_with_offset(make_test_data: TestDataMaker, mocker: MockerFixture) -> None:
+  dataset = make_test_data([{'scores': '8_1'}, {'scores': '3_5'}, {'scores': '9_7'}])
+  dataset.compute_signal(TopKEmbedding(), 'scores')
+  create_where = mocker.spy(DatasetDuckDB, '_create_where')
+
+  signal = TopKSignal(embedding='topk_embedding')
+  text_udf = Column('scores', signal_udf=signal, alias='udf')
+  result = dataset.select_rows(['scores', text_udf],
+                               sort_by=['udf'],
+                               sort_order=SortOrder.DESC,
+                               limit=2,
+                               offset=1)
+  assert [row['scores'] for row in result] == ['8_1', '3_5']
+
+  # The top k rowids are joined as a relation, not inlined in the query as an `IN` filter.
+  filters = [f for call in create_where.call_args_list for f in call.args[2]]
+  assert not any(f.op == 'in' for f in filters)
+
+
+def test_sort_by_topk_udf_then_by_column(make_test_data: TestDataMaker) -> None:
+  dataset = make_test_data([{
+    'scores': '5_1',
+    'id': 1
+  }, {
+    'scores': '9_7',
+    'id': 2
+  }, {
+    'scores': '5_2',
+    'id': 3
+  }])
+  dataset.compute_signal(TopKEmbedding(), 'scores')
+
+  text_udf = Column('scores', signal_udf=TopKSignal(embedding='topk_embedding'), alias='udf')
+  result = dataset.select_rows(['id', text_udf],
+                               sort_by=['udf', 'id'],
+                               sort_order=SortOrder.DESC,
+                               limit=3)
+  # The rows with the same top score are sorted by `id`.
+  assert [row['id'] for row in result] == [2, 3, 1]
+
+
 def test_sort_by_topk_udf_with_filter(make_test_data: TestDataMaker) -> None:
   dataset = make_test_data([{
     'scores': '8_1',
@@ -6,6 +6,7 @@ import math
 import os
 import pprint
 import secrets
+import time
 from collections.abc import Iterable
 from typing import Any, Callable, Iterator, Optional, Sequence, TypeVar, Union, cast
 
@@ -36,6 +37,37 @@ from ..schema import (
 )
 from ..signal import Signal
 from ..utils import is_primitive, log, open_file
+from .column_sketches import ColumnSketchBuilder, sketches_filepath
+
+# Append-only journal of writes to a dataset. Its size acts as the dataset generation.
+DATASET_GENERATION_FILENAME = '.generation'
+
+DatasetGeneration = tuple[int, int]
+
+
+def bump_dataset_generation(dataset_path: str, change: str) -> None:
+  """Record a change to the files of a dataset, bumping its generation.
+
+  Writers call this after they finish writing parquet files or manifests, so readers can detect
+  changes with a single stat call instead of scanning the dataset directory.
+
+  Args:
+    dataset_path: The output directory of the dataset.
+    change: A short human readable description of the change.
+  """
+  os.makedirs(dataset_path, exist_ok=True)
+  # A single small append is atomic, so concurrent writers never lose a bump.
+  with open(os.path.join(dataset_path, DATASET_GENERATION_FILENAME), 'a', encoding='utf-8') as f:
+    f.write(f'{time.time_ns()} {change}\n')
+
+
+def get_dataset_generation(dataset_path: str) -> Optional[DatasetGeneration]:
+  """Return the current generation of a dataset, or None if the dataset has no journal."""
+  try:
+    stat = os.stat(os.path.join(dataset_path, DATASET_GENERATION_FILENAME))
+  except FileNotFoundError:
+    return None
+  return (stat.st_size, stat.st_mtime_ns)
 
 
 def _replace_embeddings_with_none(input: Union[Item, Item]) -> Union[Item, Item]:
@@ -157,40 +189,50 @@ def create_signal_schema(signal: Signal, source_path: PathTuple, current_schema:
   return schema(enriched_schema.fields.copy())
 
 
-def write_embeddings_to_disk(vector_store: str, rowids: Iterable[str], signal_items: Iterable[Item],
-                             output_dir: str) -> None:
-  """Write a set of embeddings to disk."""
+def write_embeddings_to_disk(vector_store: str,
+                             rowids: Iterable[str],
+                             signal_items: Iterable[Item],
+                             output_dir: str,
+                             vector_index: Optional[VectorDBIndex] = None) -> None:
+  """Write a set of embeddings to disk.
+
+  When `vector_index` is given, the embeddings are upserted into it, and only the new embeddings are
+  written.
+  """
 
   def embedding_predicate(input: Any) -> bool:
     return (isinstance(input, list) and len(input) > 0 and isinstance(input[0], dict) and
             EMBEDDING_KEY in input[0])
 
-  path_keys = flatten_keys(rowids, signal_items, is_primitive_predicate=embedding_predicate)
-  all_embeddings = cast(Iterable[Item],
-                        deep_flatten(signal_items, is_primitive_predicate=embedding_predicate))
-
   embedding_vectors: list[np.ndarray] = []
   all_spans: list[tuple[PathKey, list[tuple[int, int]]]] = []
-  for path_key, embeddings in zip(path_keys, all_embeddings):
-    if not path_key or not embeddings:
-      # Sparse embeddings may not have an embedding for every key.
-      continue
-
-    spans: list[tuple[int, int]] = []
-    for e in embeddings:
-      span = e[VALUE_KEY]
-      vector = e[EMBEDDING_KEY]
-      # We squeeze here because embedding functions can return outer dimensions of 1.
-      embedding_vectors.append(vector.reshape(-1))
-      spans.append((span[TEXT_SPAN_START_FEATURE], span[TEXT_SPAN_END_FEATURE]))
-    all_spans.append((path_key, spans))
+  # Consume the rows one at a time so `signal_items` can be a stream.
+  for rowid, signal_item in zip(rowids, signal_items):
+    path_keys = flatten_keys([rowid], [signal_item], is_primitive_predicate=embedding_predicate)
+    all_embeddings = cast(Iterable[Item],
+                          deep_flatten([signal_item], is_primitive_predicate=embedding_predicate))
+    for path_key, embeddings in zip(path_keys, all_embeddings):
+      if not path_key or not embeddings:
+        # Sparse embeddings may not have an embedding for every key.
+        continue
+
+      spans: list[tuple[int, int]] = []
+      for e in embeddings:
+        span = e[VALUE_KEY]
+        vector = e[EMBEDDING_KEY]
+        # We squeeze here because embedding functions can return outer dimensions of 1.
+        embedding_vectors.append(vector.reshape(-1))
+        spans.append((span[TEXT_SPAN_START_FEATURE], span[TEXT_SPAN_END_FEATURE]))
+      all_spans.append((path_key, spans))
   embedding_matrix = np.array(embedding_vectors, dtype=np.float32)
-  del path_keys, all_embeddings, embedding_vectors
+  del embedding_vectors
   gc.collect()
 
   # Write to disk.
-  vector_index = VectorDBIndex(vector_store)
-  vector_index.add(all_spans, embedding_matrix)
+  if vector_index is None:
+    vector_index = VectorDBIndex(vector_store)
+  if all_spans:
+    vector_index.add(all_spans, embedding_matrix)
   vector_index.save(output_dir)
 
   del vector_index
@@ -209,7 +251,9 @@ def write_items_to_parquet(items: Iterable[Item], output_dir: str, schema: Schem
   out_filename = parquet_filename(filename_prefix, shard_index, num_shards)
   filepath = os.path.join(output_dir, out_filename)
   f = open_file(filepath, mode='wb')
-  writer = ParquetWriter(schema)
+  # Sketch the leaf values while writing so stats don't need to scan the data.
+  sketch_builder = ColumnSketchBuilder(schema)
+  writer = ParquetWriter(schema, on_record_batch=sketch_builder.add_batch)
   writer.open(f)
   debug = env('DEBUG', False)
   num_items = 0
@@ -226,6 +270,8 @@ def write_items_to_parquet(items: Iterable[Item], output_dir: str, schema: Schem
     num_items += 1
   writer.close()
   f.close()
+  with open_file(sketches_filepath(filepath), 'w') as sketches_file:
+    sketches_file.write(sketch_builder.build().json())
   return out_filename, num_items
 
 
@@ -1,10 +1,17 @@
 """Tests for dataset utils."""
 
+import pathlib
 from typing import Iterable, Iterator
 
 from ..schema import PathTuple
 from ..utils import chunks
-from .dataset_utils import count_primitives, sparse_to_dense_compute, wrap_in_dicts
+from .dataset_utils import (
+  bump_dataset_generation,
+  count_primitives,
+  get_dataset_generation,
+  sparse_to_dense_compute,
+  wrap_in_dicts,
+)
 
 
 def test_count_nested() -> None:
@@ -143,3 +150,17 @@ def test_sparse_to_dense_compute_empty() -> None:
 
   out = sparse_to_dense_compute(sparse_input, func)
   assert list(out) == []
+
+
+def test_dataset_generation(tmp_path: pathlib.Path) -> None:
+  dataset_path = str(tmp_path / 'dataset')
+  assert get_dataset_generation(dataset_path) is None
+
+  bump_dataset_generation(dataset_path, 'process_source')
+  first = get_dataset_generation(dataset_path)
+  assert first is not None
+
+  assert get_dataset_generation(dataset_path) == first
+
+  bump_dataset_generation(dataset_path, 'compute_signal')
+  assert get_dataset_generation(dataset_path) != first
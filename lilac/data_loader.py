@@ -16,7 +16,7 @@ import pandas as pd
 
 from .config import DatasetConfig
 from .data.dataset import Dataset, SourceManifest, default_settings
-from .data.dataset_utils import write_items_to_parquet
+from .data.dataset_utils import bump_dataset_generation, write_items_to_parquet
 from .db_manager import get_dataset
 from .env import data_path
 from .project import add_project_dataset_config, update_project_dataset_settings
@@ -71,9 +71,13 @@ def process_source(base_dir: Union[str, pathlib.Path],
     files=filenames, data_schema=data_schema, images=None, source=config.source)
   with open_file(os.path.join(output_dir, MANIFEST_FILENAME), 'w') as f:
     f.write(manifest.json(indent=2, exclude_none=True))
+  bump_dataset_generation(output_dir, f'process_source {config.source.name}')
+
+  dataset = get_dataset(config.namespace, config.name)
+  # Compute the stats eagerly so the first page load doesn't scan the data.
+  dataset.warm_stats(data_schema)
 
   if not config.settings:
-    dataset = get_dataset(config.namespace, config.name)
     settings = default_settings(dataset)
     update_project_dataset_settings(config.namespace, config.name, settings)
 
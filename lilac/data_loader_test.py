@@ -5,12 +5,13 @@ import pathlib
 import uuid
 from typing import Iterable
 
+import duckdb
 from pytest_mock import MockerFixture
 from typing_extensions import override
 
 from .config import Config, DatasetConfig, DatasetSettings, DatasetUISettings
 from .data.dataset import SourceManifest
-from .data.dataset_duckdb import read_source_manifest
+from .data.dataset_duckdb import DatasetDuckDB, read_source_manifest
 from .data.dataset_utils import parquet_filename
 from .data_loader import process_source
 from .project import read_project_config
@@ -86,3 +87,20 @@ def test_data_loader(tmp_path: pathlib.Path, mocker: MockerFixture) -> None:
       # 'y' is the longest path, so should be set as the default setting.
       settings=DatasetSettings(ui=DatasetUISettings(media_paths=[('y',)])))
   ])
+
+
+def test_data_loader_stats_are_best_effort(tmp_path: pathlib.Path, mocker: MockerFixture) -> None:
+  mocker.patch.dict(os.environ, {'LILAC_DATA_PATH': str(tmp_path)})
+  stats_mock = mocker.patch.object(
+    DatasetDuckDB, 'stats', autospec=True, side_effect=duckdb.Error('out of memory'))
+
+  config = DatasetConfig(
+    namespace='test_namespace',
+    name='test_dataset',
+    source=TestSource(),
+    settings=DatasetSettings(ui=DatasetUISettings(media_paths=[('y',)])))
+  _, num_items = process_source(tmp_path, config)
+
+  assert num_items == 2
+  # Both leafs were warmed, and the failures didn't fail the load.
+  assert stats_mock.call_count == 2
@@ -7,10 +7,12 @@ from typing import Optional, Type, Union
 import yaml
 from pydantic import BaseModel
 
-from .config import DatasetConfig
+from .config import Config, DatasetConfig, get_dataset_embeddings
 from .data.dataset import Dataset
 from .data.dataset_duckdb import get_config_filepath
-from .utils import get_datasets_dir
+from .env import data_path
+from .signal import TextEmbeddingSignal, get_signal_by_type
+from .utils import get_dataset_output_dir, get_datasets_dir, log
 
 _DEFAULT_DATASET_CLS: Type[Dataset]
 
@@ -41,6 +43,36 @@ def remove_dataset_from_cache(namespace: str, dataset_name: str) -> None:
       del _CACHED_DATASETS[cache_key]
 
 
+def preload_embeddings(config: Config) -> None:
+  """Load the indices of the embeddings of every dataset in a project config.
+
+  The indices are kept in the vector index cache, and on-device embedding models start loading in
+  the background, so the first search over them is fast.
+  """
+  embedding_names: set[str] = set()
+  for dataset_config in config.datasets:
+    dataset_path = get_dataset_output_dir(data_path(), dataset_config.namespace,
+                                          dataset_config.name)
+    if not os.path.exists(dataset_path):
+      continue
+    dataset = get_dataset(dataset_config.namespace, dataset_config.name)
+    for embedding_config in get_dataset_embeddings(dataset_config):
+      embedding_names.add(embedding_config.embedding)
+      try:
+        dataset.preload_embedding(embedding_config.embedding, embedding_config.path)
+      except ValueError as e:
+        # The embedding has not been computed yet.
+        log(f'Skipping preloading {embedding_config.embedding} on {dataset_config.namespace}/'
+            f'{dataset_config.name}:{embedding_config.path}: {e}')
+
+  # Setting up an on-device embedding preloads its model, which is needed to embed search queries.
+  for embedding_name in sorted(embedding_names):
+    try:
+      get_signal_by_type(embedding_name, TextEmbeddingSignal)().setup()
+    except (ValueError, ImportError) as e:
+      log(f'Skipping preloading the model of {embedding_name}: {e}')
+
+
 class DatasetInfo(BaseModel):
   """Information about a dataset."""
   namespace: str
@@ -1,7 +1,6 @@
 """Cohere embeddings."""
-from typing import TYPE_CHECKING, Iterable, cast
+from typing import Any, Iterable, cast
 
-import numpy as np
 from typing_extensions import override
 
 from ..env import env
@@ -9,12 +8,21 @@ from ..schema import Item, RichData
 from ..signal import TextEmbeddingSignal
 from ..splitters.chunk_splitter import split_text
 from .embedding import compute_split_embeddings
-
-if TYPE_CHECKING:
-  from cohere import Client
+from .embedding_client import EmbeddingClient, HttpTransport, RateLimits, get_embedding_client
 
 NUM_PARALLEL_REQUESTS = 10
 COHERE_BATCH_SIZE = 96
+EMBED_URL = 'https://api.cohere.ai/v1/embed'
+# The rate limit of production keys. See https://docs.cohere.com/docs/going-live.
+REQUESTS_PER_MINUTE = 10_000
+
+
+def _make_body(texts: list[str]) -> Any:
+  return {'texts': texts, 'truncate': 'END'}
+
+
+def _parse_response(response: Any) -> list[list[float]]:
+  return response['embeddings']
 
 
 class Cohere(TextEmbeddingSignal):
@@ -31,29 +39,30 @@ class Cohere(TextEmbeddingSignal):
   name = 'cohere'
   display_name = 'Cohere Embeddings'
 
-  _model: 'Client'
+  _client: EmbeddingClient
 
   @override
   def setup(self) -> None:
-    """Validate that the api key and python package exists in environment."""
+    """Validate that the api key exists in environment."""
     api_key = env('COHERE_API_KEY')
     if not api_key:
       raise ValueError('`COHERE_API_KEY` environment variable not set.')
-    try:
-      import cohere
-      self._model = cohere.Client(api_key, max_retries=10)
-    except ImportError:
-      raise ImportError('Could not import the "cohere" python package. '
-                        'Please install it with `pip install cohere`.')
+    self._client = get_embedding_client(
+      self.name, api_key, lambda: HttpTransport(
+        EMBED_URL, _make_body, _parse_response, headers={'Authorization': f'Bearer {api_key}'}),
+      RateLimits(
+        requests_per_minute=REQUESTS_PER_MINUTE,
+        max_batch_size=COHERE_BATCH_SIZE,
+        max_concurrency=NUM_PARALLEL_REQUESTS))
 
   @override
   def compute(self, docs: Iterable[RichData]) -> Iterable[Item]:
     """Compute embeddings for the given documents."""
-
-    def embed_fn(texts: list[str]) -> list[np.ndarray]:
-      return self._model.embed(texts, truncate='END').embeddings
-
     docs = cast(Iterable[str], docs)
     split_fn = split_text if self._split else None
     yield from compute_split_embeddings(
-      docs, COHERE_BATCH_SIZE, embed_fn, split_fn, num_parallel_requests=NUM_PARALLEL_REQUESTS)
+      docs,
+      COHERE_BATCH_SIZE,
+      self._client.embed,
+      split_fn,
+      num_parallel_requests=NUM_PARALLEL_REQUESTS)
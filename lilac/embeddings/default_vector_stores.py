@@ -1,10 +1,17 @@
 """Registers all vector stores."""
 from .vector_store import register_vector_store
 from .vector_store_hnsw import HNSWVectorStore
+from .vector_store_ivfpq import IVFPQVectorStore
 from .vector_store_numpy import NumpyVectorStore
+from .vector_store_numpy_mmap import NumpyMmapVectorStore
+from .vector_store_quantized import Float16VectorStore, Int8VectorStore
 
 
 def register_default_vector_stores() -> None:
   """Register all the default vector stores."""
   register_vector_store(HNSWVectorStore)
   register_vector_store(NumpyVectorStore)
+  register_vector_store(NumpyMmapVectorStore)
+  register_vector_store(Float16VectorStore)
+  register_vector_store(Int8VectorStore)
+  register_vector_store(IVFPQVectorStore)
@@ -1,6 +1,19 @@
 """Embedding registry."""
-from concurrent.futures import ThreadPoolExecutor
-from typing import Callable, Generator, Iterable, Iterator, Optional, Union, cast
+import collections
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import (
+  Callable,
+  Generator,
+  Iterable,
+  Iterator,
+  NamedTuple,
+  Optional,
+  TypeVar,
+  Union,
+  cast,
+)
 
 import numpy as np
 from pydantic import StrictStr
@@ -17,13 +30,33 @@ from ..schema import (
   lilac_embedding,
 )
 from ..signal import TextEmbeddingSignal, get_signal_by_type
-from ..splitters.chunk_splitter import TextChunk
-from ..utils import chunks
+from ..splitters.chunk_splitter import CHUNK_OVERLAP, CHUNK_SIZE, TextChunk
+from ..utils import chunks, log
+from .embedding_cache import EmbeddingCache, get_embedding_cache
 
 EmbeddingId = Union[StrictStr, TextEmbeddingSignal]
 
 EmbedFn = Callable[[Iterable[RichData]], Iterator[list[SpanVector]]]
 
+# The number of threads that split documents into chunks.
+SPLIT_WORKERS = 4
+# The number of documents that are split ahead of the embedding stage.
+SPLIT_AHEAD_DOCS = 1024
+# The number of batches each embedding worker has queued, so a worker never waits on the split
+# stage between batches.
+EMBED_BATCHES_PER_WORKER = 2
+# Cached documents pass through the embedding stage between the chunks that are embedded. A batch
+# holds at most this many parts per chunk of the batch size, so a run of cached documents is handed
+# to the caller in bounded batches.
+MAX_BATCH_PARTS_PER_CHUNK = 4
+# When sorting chunks by length, the number of batches in the window of chunks that is sorted.
+LENGTH_SORT_WINDOW_BATCHES = 16
+# Calls with fewer documents don't log their stage throughput, e.g. embedding a search query.
+LOG_STATS_MIN_DOCS = 1000
+
+Tin = TypeVar('Tin')
+Tout = TypeVar('Tout')
+
 
 def get_embed_fn(embedding_name: str, split: bool) -> EmbedFn:
   """Return a function that returns the embedding matrix for the given embedding signal."""
@@ -47,13 +80,112 @@ def get_embed_fn(embedding_name: str, split: bool) -> EmbedFn:
   return _embed_fn
 
 
+class _StageStats:
+  """Counts the items a pipeline stage processed and the seconds its workers spent on them."""
+
+  def __init__(self, name: str) -> None:
+    self.name = name
+    self.items = 0
+    self.seconds = 0.0
+    self._lock = threading.Lock()
+
+  def timed(self, fn: Callable[[Tin], Tout], size: Callable[[Tin], int]) -> Callable[[Tin], Tout]:
+    """Wrap `fn` so its calls, of `size(arg)` items each, are counted in the stats."""
+
+    def _timed_fn(arg: Tin) -> Tout:
+      start = time.perf_counter()
+      result = fn(arg)
+      elapsed = time.perf_counter() - start
+      with self._lock:
+        self.items += size(arg)
+        self.seconds += elapsed
+      return result
+
+    return _timed_fn
+
+  def __str__(self) -> str:
+    items_per_sec = self.items / self.seconds if self.seconds else 0.0
+    return f'{self.name}: {self.items} in {self.seconds:.3f}s ({items_per_sec:.1f}/s per worker)'
+
+
+def _ordered_map(pool: ThreadPoolExecutor, fn: Callable[[Tin], Tout], items: Iterable[Tin],
+                 max_ahead: int) -> Generator[Tout, None, None]:
+  """Map `fn` over `items` in the pool, in order, with at most `max_ahead` calls in flight.
+
+  Unlike `pool.map`, the input is read lazily on the calling thread, so the queue between stages
+  stays bounded and the input iterator doesn't need to be thread-safe.
+  """
+  items_iter = iter(items)
+  futures: collections.deque[Future[Tout]] = collections.deque()
+  for item in items_iter:
+    futures.append(pool.submit(fn, item))
+    if len(futures) >= max_ahead:
+      break
+  while futures:
+    result = futures.popleft().result()
+    # Refill the queue before handing the result downstream, so the workers stay busy while the
+    # caller consumes it.
+    for item in items_iter:
+      futures.append(pool.submit(fn, item))
+      break
+    yield result
+
+
+def embedding_cache_namespace(embedding_name: str, model: str, split: bool) -> str:
+  """Return the namespace of the embeddings of a model in the embedding cache.
+
+  The namespace has everything the embeddings depend on besides the text, so a new model version
+  or split params never read stale embeddings.
+  """
+  split_params = f'split_text(size={CHUNK_SIZE},overlap={CHUNK_OVERLAP})' if split else 'no_split'
+  return f'{embedding_name}/{model}/{split_params}'
+
+
+class _DocPart(NamedTuple):
+  """A chunk of a document to embed, or the cached embeddings of the whole document."""
+  doc_index: int
+  cache_key: Optional[bytes]
+  chunk: Optional[TextChunk]
+  cached_items: Optional[list[Item]]
+
+
+def _batch_parts(parts: Iterable[_DocPart],
+                 batch_size: int) -> Generator[list[_DocPart], None, None]:
+  """Group the parts into batches with `batch_size` chunks to embed."""
+  batch: list[_DocPart] = []
+  num_chunks = 0
+  for part in parts:
+    batch.append(part)
+    if part.chunk is not None:
+      num_chunks += 1
+    if num_chunks == batch_size or len(batch) >= MAX_BATCH_PARTS_PER_CHUNK * batch_size:
+      yield batch
+      batch = []
+      num_chunks = 0
+  if batch:
+    yield batch
+
+
 def compute_split_embeddings(docs: Iterable[str],
                              batch_size: int,
                              embed_fn: Callable[[list[str]], list[np.ndarray]],
                              split_fn: Optional[Callable[[str], list[TextChunk]]] = None,
-                             num_parallel_requests: int = 1) -> Generator[Item, None, None]:
-  """Compute text embeddings in batches of chunks, using the provided splitter and embedding fn."""
-  pool = ThreadPoolExecutor()
+                             num_parallel_requests: int = 1,
+                             cache_namespace: Optional[str] = None,
+                             sort_by_length: bool = False) -> Generator[Item, None, None]:
+  """Compute text embeddings in batches of chunks, using the provided splitter and embedding fn.
+
+  Splitting, embedding and the caller's consumption of the results run as a pipeline: a pool of
+  split workers stays ahead of `num_parallel_requests` embedding workers, which stay ahead of the
+  caller. The queues between the stages are bounded.
+
+  When `cache_namespace` is set, see `embedding_cache_namespace`, documents in the embedding cache
+  are neither split nor embedded, and the embeddings of the other documents are added to it.
+
+  When `sort_by_length` is set, chunks are gathered in windows of `LENGTH_SORT_WINDOW_BATCHES`
+  batches and embedded in batches of similar length, so on-device models pad less. The number of
+  characters approximates the number of tokens. The results keep the order of the documents.
+  """
 
   def _splitter(doc: str) -> list[TextChunk]:
     if not doc:
@@ -64,47 +196,117 @@ def compute_split_embeddings(docs: Iterable[str],
       # Return a single chunk that spans the entire document.
       return [(doc, (0, len(doc)))]
 
+  cache = get_embedding_cache() if cache_namespace is not None else None
+
+  def _split_doc(indexed_doc: tuple[int, str]) -> list[_DocPart]:
+    doc_index, doc = indexed_doc
+    if not doc:
+      return []
+    cache_key: Optional[bytes] = None
+    if cache is not None and cache_namespace is not None:
+      cache_key = EmbeddingCache.key(cache_namespace, doc)
+      cached_items = cache.get(cache_key)
+      if cached_items is not None:
+        return [_DocPart(doc_index, cache_key, None, cached_items)]
+    return [_DocPart(doc_index, cache_key, chunk, None) for chunk in _splitter(doc)]
+
+  def _embed_batch(batch: list[_DocPart]) -> tuple[list[_DocPart], Optional[np.ndarray]]:
+    texts = [part.chunk[0] for part in batch if part.chunk is not None]
+    if not texts:
+      return batch, None
+    if not sort_by_length:
+      embeddings = embed_fn(texts)
+      return batch, cast(np.ndarray, normalize(np.array(embeddings, dtype=np.float32)))
+
+    order = np.argsort([len(text) for text in texts], kind='stable')
+    sorted_embeddings: list[np.ndarray] = []
+    for texts_batch in chunks([texts[i] for i in order], batch_size):
+      sorted_embeddings.extend(embed_fn(texts_batch))
+    matrix = np.empty((len(texts), len(sorted_embeddings[0])), dtype=np.float32)
+    matrix[order] = sorted_embeddings
+    return batch, cast(np.ndarray, normalize(matrix))
+
+  split_stats = _StageStats('split docs')
+  embed_stats = _StageStats('embed chunks')
+  split_pool = ThreadPoolExecutor(max_workers=SPLIT_WORKERS, thread_name_prefix='split')
+  embed_pool = ThreadPoolExecutor(max_workers=num_parallel_requests, thread_name_prefix='embed')
+
   num_docs = 0
+  num_cached_docs = 0
 
-  def _flat_split_batch_docs(docs: Iterable[str]) -> Generator[tuple[int, TextChunk], None, None]:
-    """Split a batch of documents into chunks and yield them."""
-    nonlocal num_docs
-    for i, doc in enumerate(docs):
+  def _flat_split_docs(docs: Iterable[str]) -> Generator[_DocPart, None, None]:
+    """Split the documents in the split pool and yield their parts, in order."""
+    nonlocal num_docs, num_cached_docs
+    split_docs = _ordered_map(split_pool, split_stats.timed(_split_doc, lambda _: 1),
+                              enumerate(docs), SPLIT_AHEAD_DOCS)
+    for doc_parts in split_docs:
       num_docs += 1
-      chunks = _splitter(doc)
-      for chunk in chunks:
-        yield (i, chunk)
+      if doc_parts and doc_parts[0].cached_items is not None:
+        num_cached_docs += 1
+      yield from doc_parts
 
-  doc_chunks = _flat_split_batch_docs(docs)
-  items_to_yield: Optional[list[Item]] = None
-  current_index = 0
+  def _num_chunks(batch: list[_DocPart]) -> int:
+    return sum(part.chunk is not None for part in batch)
 
-  mega_batch_size = batch_size * num_parallel_requests
+  window_size = batch_size * LENGTH_SORT_WINDOW_BATCHES if sort_by_length else batch_size
+  batches = _batch_parts(_flat_split_docs(docs), window_size)
+  embedded_batches = _ordered_map(embed_pool, embed_stats.timed(_embed_batch, _num_chunks), batches,
+                                  EMBED_BATCHES_PER_WORKER * num_parallel_requests)
 
-  for batch in chunks(doc_chunks, mega_batch_size):
-    texts = [text for _, (text, _) in batch]
-    embeddings: list[np.ndarray] = []
-
-    for x in list(pool.map(lambda x: embed_fn(x), chunks(texts, batch_size))):
-      embeddings.extend(x)
-    matrix = cast(np.ndarray, normalize(np.array(embeddings, dtype=np.float32)))
-    # np.split returns a shallow copy of each embedding so we don't increase the mem footprint.
-    embeddings_batch = cast(list[np.ndarray], np.split(matrix, matrix.shape[0]))
-    for (index, (_, (start, end))), embedding in zip(batch, embeddings_batch):
-      embedding = embedding.reshape(-1)
-      if index == current_index:
+  items_to_yield: Optional[list[Item]] = None
+  current_index = 0
+  # The cache key of the current document, if its embeddings were computed.
+  current_cache_key: Optional[bytes] = None
+  # The embedded documents that are not yet in the cache.
+  new_cache_docs: list[tuple[bytes, list[Item]]] = []
+  # The time the caller waited on the embedding stage. Near zero when the pipeline keeps up.
+  wait_seconds = 0.0
+  try:
+    while True:
+      wait_start = time.perf_counter()
+      next_batch = next(embedded_batches, None)
+      wait_seconds += time.perf_counter() - wait_start
+      if next_batch is None:
+        break
+      batch, matrix = next_batch
+      # np.split returns a shallow copy of each embedding so we don't increase the mem footprint.
+      embeddings = iter(np.split(matrix, matrix.shape[0]) if matrix is not None else [])
+      for part in batch:
+        if part.doc_index != current_index:
+          if current_cache_key is not None and items_to_yield:
+            new_cache_docs.append((current_cache_key, items_to_yield))
+          yield items_to_yield
+          current_index += 1
+          while current_index < part.doc_index:
+            yield None
+            current_index += 1
+          items_to_yield = None
+        current_cache_key = part.cache_key if part.cached_items is None else None
+        if part.cached_items is not None:
+          items_to_yield = part.cached_items
+          continue
+        assert part.chunk is not None
+        _, (start, end) = part.chunk
         if items_to_yield is None:
           items_to_yield = []
-        items_to_yield.append(lilac_embedding(start, end, embedding))
-      else:
-        yield items_to_yield
-        current_index += 1
-        while current_index < index:
-          yield None
-          current_index += 1
-        items_to_yield = [lilac_embedding(start, end, embedding)]
+        items_to_yield.append(lilac_embedding(start, end, next(embeddings).reshape(-1)))
+      if cache is not None and new_cache_docs:
+        cache.put(new_cache_docs)
+        new_cache_docs = []
+
+    if current_cache_key is not None and items_to_yield:
+      new_cache_docs.append((current_cache_key, items_to_yield))
+    while current_index < num_docs:
+      yield items_to_yield
+      items_to_yield = None
+      current_index += 1
+  finally:
+    # Don't leave queued work behind when the caller stops early.
+    split_pool.shutdown(wait=False, cancel_futures=True)
+    embed_pool.shutdown(wait=False, cancel_futures=True)
+    if cache is not None and new_cache_docs:
+      cache.put(new_cache_docs)
 
-  while current_index < num_docs:
-    yield items_to_yield
-    items_to_yield = None
-    current_index += 1
+  if num_docs >= LOG_STATS_MIN_DOCS:
+    log(f'Embedding pipeline for {num_docs} docs, {num_cached_docs} from the cache. {split_stats}. '
+        f'{embed_stats}. Waited {wait_seconds:.3f}s for embeddings.')
@@ -0,0 +1,284 @@
+"""A persistent, content-addressed cache of document embeddings."""
+
+import functools
+import hashlib
+import os
+import threading
+import time
+from typing import Optional
+
+import numpy as np
+
+from ..env import data_path, env
+from ..schema import (
+  EMBEDDING_KEY,
+  TEXT_SPAN_END_FEATURE,
+  TEXT_SPAN_START_FEATURE,
+  VALUE_KEY,
+  Item,
+  lilac_embedding,
+)
+from ..utils import get_lilac_cache_dir, log
+
+# The default disk budget of the cache, in GB. Overridden by the `EMBEDDING_CACHE_GB` environment
+# variable. A budget of 0 disables the cache.
+DEFAULT_CACHE_GB = 10
+# The size at which a segment is sealed and a new one is started. Eviction deletes whole segments.
+SEGMENT_BYTES = 256 * 1024**2
+
+_VECTORS_SUFFIX = '.vectors'
+_SPANS_SUFFIX = '.spans'
+_INDEX_SUFFIX = '.index'
+_KEY_BYTES = 16
+
+# A record in the index file of a segment. `vector_offset` is in float32 values, and `span_offset`
+# in spans. The rows of a document are contiguous in both files.
+_INDEX_DTYPE = np.dtype([('key', 'u1', (_KEY_BYTES,)), ('vector_offset', '<i8'),
+                         ('span_offset', '<i8'), ('num_rows', '<i4'), ('dim', '<i4')])
+# The keys of a segment are searched as fixed-size byte strings.
+_KEY_DTYPE = np.dtype(f'S{_KEY_BYTES}')
+
+# The location of a document: its segment, vector offset, span offset, rows and dimension.
+_Entry = tuple[str, int, int, int, int]
+
+
+class EmbeddingCache:
+  """Caches the embeddings of documents on disk, keyed by a hash of the document and its namespace.
+
+  The namespace identifies everything the embeddings depend on besides the text: the embedding, the
+  model version and the split params. Entries are appended to segments of three files: the float32
+  vectors, the int32 spans and an index of fixed-size records. The index is written last, so a
+  partially written entry is never read. Sealed segments are memory-mapped.
+
+  The index of a segment is read when a lookup first reaches it, from the newest segment to the
+  oldest, and kept as a sorted array of keys. Opening a large cache only lists its segments.
+
+  When the cache is over its budget, the oldest segments are deleted. Each instance appends to its
+  own segments, so processes sharing a cache directory never write to the same file. Entries written
+  by other processes are visible to instances created after them. A segment that another process
+  evicted is dropped, and its entries are misses.
+  """
+
+  def __init__(self, cache_dir: str, max_bytes: int, segment_bytes: int = SEGMENT_BYTES) -> None:
+    self.cache_dir = cache_dir
+    self.max_bytes = max_bytes
+    self.segment_bytes = segment_bytes
+    self._lock = threading.Lock()
+    # The segments from oldest to newest, with their size.
+    self._segment_sizes: dict[str, int] = {}
+    # The sorted keys and records of the segments whose index was read.
+    self._segment_indexes: dict[str, tuple[np.ndarray, np.ndarray]] = {}
+    # Maps the key of a document in the active segment to its location.
+    self._active_index: dict[bytes, _Entry] = {}
+    self._mmaps: dict[tuple[str, str], np.ndarray] = {}
+    self._active_segment: Optional[str] = None
+    self._load()
+
+  @staticmethod
+  def key(namespace: str, text: str) -> bytes:
+    """Return the cache key of a document."""
+    return hashlib.blake2b(f'{namespace}\0{text}'.encode(), digest_size=_KEY_BYTES).digest()
+
+  def get(self, key: bytes) -> Optional[list[Item]]:
+    """Return the embeddings of a document, or None if it is not in the cache."""
+    with self._lock:
+      entry = self._find(key)
+      if entry is None:
+        return None
+      segment, vector_offset, span_offset, num_rows, dim = entry
+      try:
+        vectors = self._mmap(segment, _VECTORS_SUFFIX, np.float32, vector_offset + num_rows * dim)
+        spans = self._mmap(segment, _SPANS_SUFFIX, np.int32, 2 * (span_offset + num_rows))
+      except FileNotFoundError:
+        # Another process evicted the segment.
+        self._drop_segment(segment)
+        return None
+    # Copy the rows out of the memory map, so they outlive the eviction of the segment.
+    matrix = np.array(vectors[vector_offset:vector_offset + num_rows * dim]).reshape(num_rows, dim)
+    doc_spans = spans[2 * span_offset:2 * (span_offset + num_rows)].reshape(num_rows, 2).tolist()
+    return [lilac_embedding(start, end, vector) for (start, end), vector in zip(doc_spans, matrix)]
+
+  def put(self, docs: list[tuple[bytes, list[Item]]]) -> None:
+    """Add the embeddings of documents to the cache.
+
+    Args:
+      docs: The key of each document, and its items of `lilac_embedding` spans.
+    """
+    docs = [(key, items) for key, items in docs if items]
+    if not docs:
+      return
+    vectors = [
+      np.array([item[EMBEDDING_KEY] for item in items], dtype=np.float32) for _, items in docs
+    ]
+    spans = np.array(
+      [[item[VALUE_KEY][TEXT_SPAN_START_FEATURE], item[VALUE_KEY][TEXT_SPAN_END_FEATURE]]
+       for _, items in docs
+       for item in items],
+      dtype=np.int32)
+
+    with self._lock:
+      segment = self._get_active_segment()
+      vectors_path = self._path(segment, _VECTORS_SUFFIX)
+      spans_path = self._path(segment, _SPANS_SUFFIX)
+      vector_offset = _file_size(vectors_path) // 4
+      span_offset = _file_size(spans_path) // 8
+
+      keys = [key for key, _ in docs]
+      records = np.empty(len(docs), dtype=_INDEX_DTYPE)
+      records['key'] = np.frombuffer(b''.join(keys), dtype=np.uint8).reshape(len(docs), _KEY_BYTES)
+      num_rows = np.array([len(doc_vectors) for doc_vectors in vectors])
+      dims = np.array([doc_vectors.shape[1] for doc_vectors in vectors])
+      num_values = num_rows * dims
+      records['vector_offset'] = vector_offset + np.cumsum(num_values) - num_values
+      records['span_offset'] = span_offset + np.cumsum(num_rows) - num_rows
+      records['num_rows'] = num_rows
+      records['dim'] = dims
+
+      with open(vectors_path, 'ab') as f:
+        for doc_vectors in vectors:
+          f.write(doc_vectors.tobytes())
+      with open(spans_path, 'ab') as f:
+        f.write(spans.tobytes())
+      with open(self._path(segment, _INDEX_SUFFIX), 'ab') as f:
+        f.write(records.tobytes())
+
+      for key, (_, doc_vector_offset, doc_span_offset, doc_rows,
+                dim) in zip(keys, records.tolist()):
+        self._active_index[key] = (segment, doc_vector_offset, doc_span_offset, doc_rows, dim)
+      self._segment_sizes[segment] = _segment_size(self._path(segment, ''))
+      # Reads of the active segment re-map the grown files.
+      self._mmaps.pop((segment, _VECTORS_SUFFIX), None)
+      self._mmaps.pop((segment, _SPANS_SUFFIX), None)
+      if self._segment_sizes[segment] >= self.segment_bytes:
+        # The sealed segment is searched from its index file, like the segments of other processes.
+        self._active_segment = None
+        self._active_index = {}
+      self._evict()
+
+  def num_bytes(self) -> int:
+    """Return the size of the cache on disk."""
+    with self._lock:
+      return sum(self._segment_sizes.values())
+
+  def __len__(self) -> int:
+    with self._lock:
+      all_keys = [
+        index[0]
+        for index in map(self._segment_index, list(self._segment_sizes))
+        if index is not None
+      ]
+      all_keys.append(np.array(list(self._active_index), dtype=_KEY_DTYPE))
+      return len(np.unique(np.concatenate(all_keys)))
+
+  def _load(self) -> None:
+    if not os.path.exists(self.cache_dir):
+      return
+    segments = sorted(file[:-len(_INDEX_SUFFIX)]
+                      for file in os.listdir(self.cache_dir)
+                      if file.endswith(_INDEX_SUFFIX))
+    for segment in segments:
+      self._segment_sizes[segment] = _segment_size(self._path(segment, ''))
+
+  def _find(self, key: bytes) -> Optional[_Entry]:
+    """Return the location of a document in the newest segment that has it."""
+    entry = self._active_index.get(key)
+    if entry is not None:
+      return entry
+    # Byte strings in numpy drop trailing zeros, so the key is compared as a numpy byte string.
+    query = np.array(key, dtype=_KEY_DTYPE)
+    for segment in reversed(list(self._segment_sizes)):
+      index = self._segment_index(segment)
+      if index is None:
+        continue
+      keys, records = index
+      # The last record of a key in a segment is its latest put.
+      position = int(np.searchsorted(keys, query, side='right')) - 1
+      if position >= 0 and keys[position] == query:
+        _, vector_offset, span_offset, num_rows, dim = records[position].tolist()
+        return (segment, vector_offset, span_offset, num_rows, dim)
+    return None
+
+  def _segment_index(self, segment: str) -> Optional[tuple[np.ndarray, np.ndarray]]:
+    """Return the sorted keys and records of a sealed segment, or None if it was evicted."""
+    if segment == self._active_segment:
+      return None
+    index = self._segment_indexes.get(segment)
+    if index is None:
+      index_path = self._path(segment, _INDEX_SUFFIX)
+      # A record that is cut short by a crash is ignored.
+      num_records = _file_size(index_path) // _INDEX_DTYPE.itemsize
+      try:
+        records = np.fromfile(index_path, dtype=_INDEX_DTYPE, count=num_records)
+      except FileNotFoundError:
+        # Another process evicted the segment.
+        self._drop_segment(segment)
+        return None
+      keys = np.ascontiguousarray(records['key']).view(_KEY_DTYPE).reshape(-1)
+      order = np.argsort(keys, kind='stable')
+      index = (keys[order], records[order])
+      self._segment_indexes[segment] = index
+    return index
+
+  def _get_active_segment(self) -> str:
+    if self._active_segment is None:
+      os.makedirs(self.cache_dir, exist_ok=True)
+      # Segment names sort by creation time. The process id keeps concurrent writers apart.
+      self._active_segment = f'{time.time_ns():020d}-{os.getpid()}-{id(self)}'
+      self._segment_sizes[self._active_segment] = 0
+    return self._active_segment
+
+  def _mmap(self, segment: str, suffix: str, dtype: type[np.generic], size: int) -> np.ndarray:
+    array = self._mmaps.get((segment, suffix))
+    if array is None or len(array) < size:
+      array = np.memmap(self._path(segment, suffix), dtype=dtype, mode='r')
+      self._mmaps[(segment, suffix)] = array
+    return array
+
+  def _evict(self) -> None:
+    for segment in list(self._segment_sizes):
+      if sum(self._segment_sizes.values()) <= self.max_bytes:
+        return
+      if segment == self._active_segment:
+        continue
+      num_bytes = self._segment_sizes[segment]
+      self._drop_segment(segment)
+      for suffix in [_INDEX_SUFFIX, _VECTORS_SUFFIX, _SPANS_SUFFIX]:
+        if os.path.exists(self._path(segment, suffix)):
+          os.remove(self._path(segment, suffix))
+      log(f'Evicted embedding cache segment {segment} ({num_bytes / 1024**2:.1f}MB).')
+
+  def _drop_segment(self, segment: str) -> None:
+    """Forget a segment and its entries."""
+    if segment == self._active_segment:
+      self._active_segment = None
+      self._active_index = {}
+    self._segment_sizes.pop(segment, None)
+    self._segment_indexes.pop(segment, None)
+    self._mmaps.pop((segment, _VECTORS_SUFFIX), None)
+    self._mmaps.pop((segment, _SPANS_SUFFIX), None)
+
+  def _path(self, segment: str, suffix: str) -> str:
+    return os.path.join(self.cache_dir, segment + suffix)
+
+
+def _file_size(path: str) -> int:
+  return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+def _segment_size(base_path: str) -> int:
+  return sum(
+    _file_size(base_path + suffix) for suffix in [_INDEX_SUFFIX, _VECTORS_SUFFIX, _SPANS_SUFFIX])
+
+
+@functools.lru_cache(maxsize=None)
+def _get_embedding_cache(cache_dir: str, max_bytes: int) -> EmbeddingCache:
+  return EmbeddingCache(cache_dir, max_bytes)
+
+
+def get_embedding_cache() -> Optional[EmbeddingCache]:
+  """Return the embedding cache of the current data path, or None if it is disabled."""
+  max_gb = float(env('EMBEDDING_CACHE_GB', DEFAULT_CACHE_GB))
+  if max_gb <= 0:
+    return None
+  cache_dir = os.path.join(get_lilac_cache_dir(data_path()), 'embeddings')
+  return _get_embedding_cache(os.path.abspath(cache_dir), int(max_gb * 1024**3))
@@ -0,0 +1,133 @@
+"""Tests for the embedding cache."""
+
+import os
+import pathlib
+from typing import Optional
+
+import numpy as np
+
+from ..schema import (
+  EMBEDDING_KEY,
+  TEXT_SPAN_END_FEATURE,
+  TEXT_SPAN_START_FEATURE,
+  VALUE_KEY,
+  Item,
+  lilac_embedding,
+)
+from .embedding_cache import EmbeddingCache
+
+
+def _items(*vectors: list[float]) -> list[Item]:
+  return [
+    lilac_embedding(i, i + 1, np.array(vector, dtype=np.float32))
+    for i, vector in enumerate(vectors)
+  ]
+
+
+def _to_lists(items: Optional[list[Item]]) -> Optional[list[tuple[int, int, list[float]]]]:
+  if items is None:
+    return None
+  return [(item[VALUE_KEY][TEXT_SPAN_START_FEATURE], item[VALUE_KEY][TEXT_SPAN_END_FEATURE],
+           item[EMBEDDING_KEY].tolist()) for item in items]
+
+
+def test_put_and_get(tmp_path: pathlib.Path) -> None:
+  cache = EmbeddingCache(str(tmp_path), max_bytes=1 << 30)
+  hello_key = EmbeddingCache.key('sbert', 'hello')
+  world_key = EmbeddingCache.key('sbert', 'world')
+  assert cache.get(hello_key) is None
+
+  cache.put([(hello_key, _items([1, 0], [0, 1])), (world_key, _items([0.5, 0.5]))])
+  assert _to_lists(cache.get(hello_key)) == _to_lists(_items([1, 0], [0, 1]))
+  assert _to_lists(cache.get(world_key)) == _to_lists(_items([0.5, 0.5]))
+
+  # Entries appended to the active segment are readable.
+  again_key = EmbeddingCache.key('sbert', 'again')
+  cache.put([(again_key, _items([1, 1, 1]))])
+  assert _to_lists(cache.get(again_key)) == _to_lists(_items([1, 1, 1]))
+  assert _to_lists(cache.get(hello_key)) == _to_lists(_items([1, 0], [0, 1]))
+
+
+def test_namespace_is_part_of_the_key() -> None:
+  assert EmbeddingCache.key('sbert', 'hello') != EmbeddingCache.key('openai', 'hello')
+
+
+def test_persists(tmp_path: pathlib.Path) -> None:
+  key = EmbeddingCache.key('sbert', 'hello')
+  EmbeddingCache(str(tmp_path), max_bytes=1 << 30).put([(key, _items([1, 2]))])
+
+  cache = EmbeddingCache(str(tmp_path), max_bytes=1 << 30)
+  assert len(cache) == 1
+  assert _to_lists(cache.get(key)) == _to_lists(_items([1, 2]))
+
+
+def test_ignores_partially_written_records(tmp_path: pathlib.Path) -> None:
+  key = EmbeddingCache.key('sbert', 'hello')
+  EmbeddingCache(str(tmp_path), max_bytes=1 << 30).put([(key, _items([1, 2]))])
+  [index_file] = [file for file in os.listdir(tmp_path) if file.endswith('.index')]
+  with open(tmp_path / index_file, 'ab') as f:
+    f.write(b'\0' * 10)
+
+  cache = EmbeddingCache(str(tmp_path), max_bytes=1 << 30)
+  assert len(cache) == 1
+  assert _to_lists(cache.get(key)) == _to_lists(_items([1, 2]))
+
+
+def test_evicts_oldest_segments(tmp_path: pathlib.Path) -> None:
+  # Every put seals its segment.
+  cache = EmbeddingCache(str(tmp_path), max_bytes=200, segment_bytes=1)
+  keys = [EmbeddingCache.key('sbert', str(i)) for i in range(5)]
+  for key in keys:
+    cache.put([(key, _items([1.0] * 8))])
+
+  assert cache.num_bytes() <= 200
+  assert cache.get(keys[0]) is None
+  assert _to_lists(cache.get(keys[-1])) == _to_lists(_items([1.0] * 8))
+  # Evicted segments are deleted from disk.
+  assert len(EmbeddingCache(str(tmp_path), max_bytes=1 << 30)) == len(cache)
+
+
+def test_reads_segment_indexes_when_first_needed(tmp_path: pathlib.Path) -> None:
+  writer = EmbeddingCache(str(tmp_path), max_bytes=1 << 30, segment_bytes=1)
+  keys = [EmbeddingCache.key('sbert', str(i)) for i in range(3)]
+  for i, key in enumerate(keys):
+    writer.put([(key, _items([float(i)]))])
+
+  cache = EmbeddingCache(str(tmp_path), max_bytes=1 << 30)
+  assert cache._segment_indexes == {}
+  # Segments are searched from the newest to the oldest.
+  assert _to_lists(cache.get(keys[-1])) == _to_lists(_items([2.0]))
+  assert len(cache._segment_indexes) == 1
+  assert _to_lists(cache.get(keys[0])) == _to_lists(_items([0.0]))
+  assert len(cache._segment_indexes) == 3
+
+
+def test_segments_evicted_by_another_process_are_misses(tmp_path: pathlib.Path) -> None:
+  writer = EmbeddingCache(str(tmp_path), max_bytes=1 << 30, segment_bytes=1)
+  keys = [EmbeddingCache.key('sbert', str(i)) for i in range(3)]
+  for key in keys:
+    writer.put([(key, _items([1.0, 2.0]))])
+  segments = sorted({file.split('.')[0] for file in os.listdir(tmp_path)})
+
+  def evict(segment: str) -> None:
+    for file in os.listdir(tmp_path):
+      if file.startswith(segment):
+        os.remove(tmp_path / file)
+
+  cache = EmbeddingCache(str(tmp_path), max_bytes=1 << 30)
+  # Reads the index of every segment.
+  assert cache.get(keys[0]) is not None
+  num_bytes = cache.num_bytes()
+
+  # The index of the segment was read, but its vectors are gone.
+  evict(segments[1])
+  assert cache.get(keys[1]) is None
+  assert segments[1] not in cache._segment_sizes
+  # The index of the segment is gone.
+  cache = EmbeddingCache(str(tmp_path), max_bytes=1 << 30)
+  evict(segments[2])
+  assert cache.get(keys[2]) is None
+  assert segments[2] not in cache._segment_sizes
+
+  assert cache.num_bytes() < num_bytes
+  assert _to_lists(cache.get(keys[0])) == _to_lists(_items([1.0, 2.0]))
@@ -0,0 +1,396 @@
+"""A shared client for remote embedding APIs, with rate limits and request coalescing."""
+
+import abc
+import asyncio
+import random
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Optional
+
+import httpx
+import numpy as np
+from pydantic import BaseModel
+from typing_extensions import override
+
+# Characters per token, to estimate the tokens of a request without a tokenizer.
+CHARS_PER_TOKEN = 4
+# The number of times a text is sent before its error is raised to the caller. Client errors (4xx,
+# other than rate limits) are not retried.
+MAX_ATTEMPTS = 10
+# The range of the random exponential backoff after a failed request, in seconds.
+MIN_BACKOFF_SECONDS = 1
+MAX_BACKOFF_SECONDS = 20
+# The timeout of an HTTP request, in seconds.
+REQUEST_TIMEOUT_SECONDS = 60
+
+
+class RateLimitError(Exception):
+  """The API rejected a request because a rate limit was exceeded."""
+
+  def __init__(self, message: str, retry_after: Optional[float] = None) -> None:
+    super().__init__(message)
+    # The seconds to wait before the next request, if the API said so.
+    self.retry_after = retry_after
+
+
+class EmbeddingTransport(abc.ABC):
+  """Sends a batch of texts to an embedding API."""
+
+  @abc.abstractmethod
+  async def embed(self, texts: list[str]) -> list[np.ndarray]:
+    """Return the embeddings of the texts. Raises `RateLimitError` when the API is rate limited."""
+    pass
+
+  async def close(self) -> None:
+    """Release the resources of the transport."""
+    pass
+
+
+class HttpTransport(EmbeddingTransport):
+  """Calls a JSON embedding API over HTTP.
+
+  Args:
+    url: The URL that texts are posted to.
+    make_body: Returns the JSON body of a request for the texts.
+    parse_response: Returns the embeddings from the JSON body of a response.
+    headers: The headers of every request, e.g. for authentication.
+    transport: Overrides the httpx transport, e.g. with an `httpx.MockTransport` that stubs the
+      server in tests and benchmarks.
+  """
+
+  def __init__(self,
+               url: str,
+               make_body: Callable[[list[str]], Any],
+               parse_response: Callable[[Any], list[list[float]]],
+               headers: dict[str, str] = {},
+               transport: Optional[httpx.AsyncBaseTransport] = None) -> None:
+    self.url = url
+    self.headers = headers
+    self._make_body = make_body
+    self._parse_response = parse_response
+    self._transport = transport
+    self._client: Optional[httpx.AsyncClient] = None
+
+  @override
+  async def embed(self, texts: list[str]) -> list[np.ndarray]:
+    if self._client is None:
+      self._client = httpx.AsyncClient(transport=self._transport, timeout=REQUEST_TIMEOUT_SECONDS)
+    response = await self._client.post(self.url, json=self._make_body(texts), headers=self.headers)
+    if response.status_code == httpx.codes.TOO_MANY_REQUESTS:
+      raise RateLimitError(f'Rate limited by {self.url}.',
+                           _parse_retry_after(response.headers.get('retry-after')))
+    response.raise_for_status()
+    return [
+      np.array(embedding, dtype=np.float32) for embedding in self._parse_response(response.json())
+    ]
+
+  @override
+  async def close(self) -> None:
+    if self._client is not None:
+      await self._client.aclose()
+      self._client = None
+
+
+def _parse_retry_after(retry_after: Optional[str]) -> Optional[float]:
+  try:
+    return float(retry_after) if retry_after is not None else None
+  except ValueError:
+    # An HTTP date, which we treat like a missing header.
+    return None
+
+
+class RateLimits(BaseModel):
+  """The limits of an embedding API. A limit of None is unlimited."""
+  requests_per_minute: Optional[float] = None
+  # Tokens are estimated from the number of characters.
+  tokens_per_minute: Optional[float] = None
+  # The most texts in a request.
+  max_batch_size: int
+  # The most concurrent requests. The client lowers its concurrency when it is rate limited.
+  max_concurrency: int
+
+
+class TokenBucket:
+  """Allows `rate_per_minute` tokens per minute, in bursts of up to a minute of tokens."""
+
+  def __init__(self, rate_per_minute: float) -> None:
+    self.rate_per_second = rate_per_minute / 60
+    self.capacity = rate_per_minute
+    self._tokens = rate_per_minute
+    self._updated = time.monotonic()
+
+  async def acquire(self, num_tokens: float) -> None:
+    """Wait until `num_tokens` are available and take them."""
+    # A request larger than the bucket waits for a full bucket.
+    num_tokens = min(num_tokens, self.capacity)
+    while True:
+      now = time.monotonic()
+      self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate_per_second)
+      self._updated = now
+      if self._tokens >= num_tokens:
+        self._tokens -= num_tokens
+        return
+      await asyncio.sleep((num_tokens - self._tokens) / self.rate_per_second)
+
+
+class AdaptiveConcurrency:
+  """Limits the concurrent requests, with additive increase and multiplicative decrease.
+
+  A rate limited request halves the limit. Every successful request grows it by 1 / limit, so a full
+  window of successes adds one request, up to `max_concurrency`.
+  """
+
+  def __init__(self, max_concurrency: int) -> None:
+    self.max_concurrency = max_concurrency
+    self.limit = float(max_concurrency)
+    self._num_in_flight = 0
+    self._condition = asyncio.Condition()
+
+  async def acquire(self) -> None:
+    """Wait until a request can be sent."""
+    async with self._condition:
+      await self._condition.wait_for(lambda: self._num_in_flight < max(1, int(self.limit)))
+      self._num_in_flight += 1
+
+  async def release(self, rate_limited: bool) -> None:
+    """Finish a request, and adapt the limit to whether it was rate limited."""
+    async with self._condition:
+      self._num_in_flight -= 1
+      if rate_limited:
+        self.limit = max(1.0, self.limit / 2)
+      else:
+        self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+      self._condition.notify_all()
+
+
+class _PendingText:
+  """A text waiting to be embedded."""
+  __slots__ = ('text', 'future', 'attempts')
+
+  def __init__(self, text: str, future: asyncio.Future) -> None:
+    self.text = text
+    self.future = future
+    self.attempts = 0
+
+
+class EmbeddingClient:
+  """Embeds texts with a remote API, with limits that are shared by every caller in the process.
+
+  Texts from concurrent callers are queued, and coalesced into requests of up to `max_batch_size`
+  texts. A dispatcher on a background event loop sends a request whenever the rate limits and the
+  concurrency allow it. A rate limited request lowers the concurrency, pauses the dispatcher for
+  the time the API asked for, and puts its texts back at the front of the queue. A client error
+  (4xx) is not retried: the request is split in halves until the error is narrowed down to the texts
+  that caused it, so the texts of other callers in the same request are still embedded. Other errors
+  are retried with a random exponential backoff, up to `MAX_ATTEMPTS` times.
+  """
+
+  def __init__(self, transport: EmbeddingTransport, limits: RateLimits) -> None:
+    self.transport = transport
+    self.limits = limits
+    self._lock = threading.Lock()
+    self._loop: Optional[asyncio.AbstractEventLoop] = None
+    self._thread: Optional[threading.Thread] = None
+    self._pending: deque[_PendingText] = deque()
+    # The halves of requests that failed with a client error, sent before the pending texts.
+    self._split_batches: deque[list[_PendingText]] = deque()
+    # The dispatcher doesn't send requests before this time.
+    self._paused_until = 0.0
+    # The tasks of the requests in flight, so they aren't garbage collected.
+    self._tasks: set[asyncio.Task] = set()
+
+  def embed(self, texts: list[str]) -> list[np.ndarray]:
+    """Embed the texts, and block until they are embedded. Safe to call from any thread."""
+    return asyncio.run_coroutine_threadsafe(self._embed(texts), self._get_loop()).result()
+
+  async def embed_async(self, texts: list[str]) -> list[np.ndarray]:
+    """Embed the texts, from a coroutine on any event loop."""
+    future = asyncio.run_coroutine_threadsafe(self._embed(texts), self._get_loop())
+    return await asyncio.wrap_future(future)
+
+  def close(self) -> None:
+    """Stop the event loop of the client. Texts that are not embedded yet fail."""
+    with self._lock:
+      loop, self._loop = self._loop, None
+      thread = self._thread
+    if loop is None or thread is None:
+      return
+    asyncio.run_coroutine_threadsafe(self._stop(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+
+  def concurrency_limit(self) -> float:
+    """Return the current limit of concurrent requests."""
+    self._get_loop()
+    return self._concurrency.limit
+
+  def _get_loop(self) -> asyncio.AbstractEventLoop:
+    with self._lock:
+      if self._loop is None:
+        loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+          target=loop.run_forever, name='embedding_client', daemon=True)
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._start(), loop).result()
+        self._loop = loop
+      return self._loop
+
+  async def _start(self) -> None:
+    """Create the state that belongs to the event loop, and start the dispatcher."""
+    self._has_pending = asyncio.Event()
+    self._concurrency = AdaptiveConcurrency(self.limits.max_concurrency)
+    self._request_bucket: Optional[TokenBucket] = None
+    if self.limits.requests_per_minute is not None:
+      self._request_bucket = TokenBucket(self.limits.requests_per_minute)
+    self._token_bucket: Optional[TokenBucket] = None
+    if self.limits.tokens_per_minute is not None:
+      self._token_bucket = TokenBucket(self.limits.tokens_per_minute)
+    self._dispatcher = asyncio.create_task(self._dispatch())
+
+  async def _stop(self) -> None:
+    tasks = [self._dispatcher, *self._tasks]
+    for task in tasks:
+      task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    error = RuntimeError('The embedding client was closed.')
+    _fail(list(self._pending), error)
+    self._pending.clear()
+    for batch in self._split_batches:
+      _fail(batch, error)
+    self._split_batches.clear()
+    await self.transport.close()
+
+  async def _embed(self, texts: list[str]) -> list[np.ndarray]:
+    loop = asyncio.get_running_loop()
+    pending_texts = [_PendingText(text, loop.create_future()) for text in texts]
+    self._pending.extend(pending_texts)
+    self._has_pending.set()
+    return list(await asyncio.gather(*[pending_text.future for pending_text in pending_texts]))
+
+  async def _dispatch(self) -> None:
+    while True:
+      await self._has_pending.wait()
+      await self._concurrency.acquire()
+      pause = self._paused_until - time.monotonic()
+      if pause > 0:
+        await asyncio.sleep(pause)
+      if self._request_bucket:
+        await self._request_bucket.acquire(1)
+      # The batch is taken as late as possible, so it has every text that was queued meanwhile.
+      batch = self._take_batch()
+      if self._token_bucket:
+        await self._token_bucket.acquire(
+          sum(len(pending_text.text) for pending_text in batch) / CHARS_PER_TOKEN)
+      task = asyncio.create_task(self._send(batch))
+      self._tasks.add(task)
+      task.add_done_callback(self._tasks.discard)
+
+  def _take_batch(self) -> list[_PendingText]:
+    batch: list[_PendingText] = []
+    if self._split_batches:
+      batch = self._split_batches.popleft()
+    else:
+      while self._pending and len(batch) < self.limits.max_batch_size:
+        batch.append(self._pending.popleft())
+    if not self._pending and not self._split_batches:
+      self._has_pending.clear()
+    return batch
+
+  async def _send(self, batch: list[_PendingText]) -> None:
+    try:
+      embeddings = await self.transport.embed([pending_text.text for pending_text in batch])
+      if len(embeddings) != len(batch):
+        raise ValueError(f'Expected {len(batch)} embeddings, but got {len(embeddings)}.')
+    except asyncio.CancelledError:
+      _fail(batch, RuntimeError('The embedding client was closed.'))
+      raise
+    except RateLimitError as e:
+      await self._concurrency.release(rate_limited=True)
+      pause = e.retry_after if e.retry_after is not None else _backoff_seconds(batch)
+      self._paused_until = max(self._paused_until, time.monotonic() + pause)
+      self._retry(batch, e)
+      return
+    except Exception as e:
+      await self._concurrency.release(rate_limited=False)
+      if _is_client_error(e):
+        self._split(batch, e)
+        return
+      await asyncio.sleep(_backoff_seconds(batch))
+      self._retry(batch, e)
+      return
+
+    await self._concurrency.release(rate_limited=False)
+    for pending_text, embedding in zip(batch, embeddings):
+      if not pending_text.future.done():
+        pending_text.future.set_result(embedding)
+
+  def _split(self, batch: list[_PendingText], error: Exception) -> None:
+    """Send the halves of a request that failed with a client error, or fail its only text."""
+    batch = [pending_text for pending_text in batch if not pending_text.future.done()]
+    if len(batch) <= 1:
+      _fail(batch, error)
+      return
+    middle = len(batch) // 2
+    self._split_batches.extendleft([batch[middle:], batch[:middle]])
+    self._has_pending.set()
+
+  def _retry(self, batch: list[_PendingText], error: Exception) -> None:
+    """Queue the texts of a failed request again, or fail them when they are out of attempts."""
+    retry_texts: list[_PendingText] = []
+    for pending_text in batch:
+      pending_text.attempts += 1
+      if pending_text.future.done():
+        continue
+      if pending_text.attempts >= MAX_ATTEMPTS:
+        pending_text.future.set_exception(error)
+      else:
+        retry_texts.append(pending_text)
+    self._pending.extendleft(reversed(retry_texts))
+    if self._pending:
+      self._has_pending.set()
+
+
+def _fail(batch: list[_PendingText], error: Exception) -> None:
+  for pending_text in batch:
+    if not pending_text.future.done():
+      pending_text.future.set_exception(error)
+
+
+def _is_client_error(error: Exception) -> bool:
+  """Whether the API rejected the request itself, so sending it again fails the same way."""
+  return isinstance(error, httpx.HTTPStatusError) and error.response.is_client_error
+
+
+def _backoff_seconds(batch: list[_PendingText]) -> float:
+  attempts = max(pending_text.attempts for pending_text in batch)
+  return random.uniform(MIN_BACKOFF_SECONDS,
+                        min(MAX_BACKOFF_SECONDS, MIN_BACKOFF_SECONDS * 2**attempts))
+
+
+# The client of every API, with the API key it was created with.
+_CLIENTS: dict[str, tuple[str, EmbeddingClient]] = {}
+_clients_lock = threading.Lock()
+
+
+def get_embedding_client(name: str, api_key: str, make_transport: Callable[[], EmbeddingTransport],
+                         limits: RateLimits) -> EmbeddingClient:
+  """Return the process-wide client of an embedding API, creating it on first use.
+
+  Every caller of the same API shares the client, so concurrent tasks share its rate limits. When
+  the API key changes, e.g. after it was rotated in the environment, the client is replaced by a
+  new one from `make_transport`.
+  """
+  with _clients_lock:
+    stale_client: Optional[EmbeddingClient] = None
+    if name in _CLIENTS:
+      client_api_key, client = _CLIENTS[name]
+      if client_api_key == api_key:
+        return client
+      stale_client = client
+    client = EmbeddingClient(make_transport(), limits)
+    _CLIENTS[name] = (api_key, client)
+  if stale_client is not None:
+    stale_client.close()
+  return client
@@ -0,0 +1,193 @@
+"""Tests for the remote embedding client."""
+
+import asyncio
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import numpy as np
+import pytest
+from pytest_mock import MockerFixture
+from typing_extensions import override
+
+from . import embedding_client
+from .embedding_client import (
+  EmbeddingClient,
+  EmbeddingTransport,
+  HttpTransport,
+  RateLimits,
+  TokenBucket,
+  get_embedding_client,
+)
+
+
+class StubTransport(EmbeddingTransport):
+  """Embeds a text as its length, and blocks the first request until it is released."""
+
+  def __init__(self) -> None:
+    self.batches: list[list[str]] = []
+    self.first_request_started = threading.Event()
+    self.release_first_request = threading.Event()
+
+  @override
+  async def embed(self, texts: list[str]) -> list[np.ndarray]:
+    self.batches.append(texts)
+    if len(self.batches) == 1:
+      self.first_request_started.set()
+      while not self.release_first_request.is_set():
+        await asyncio.sleep(0.001)
+    return [np.array([len(text)], dtype=np.float32) for text in texts]
+
+
+def test_coalesces_concurrent_callers() -> None:
+  transport = StubTransport()
+  client = EmbeddingClient(transport, RateLimits(max_batch_size=4, max_concurrency=1))
+  try:
+    with ThreadPoolExecutor() as pool:
+      first = pool.submit(client.embed, ['a'])
+      transport.first_request_started.wait()
+      # These texts queue up while the only request slot is busy.
+      rest = [pool.submit(client.embed, ['b' * i, 'c' * i]) for i in range(2, 6)]
+      time.sleep(0.05)
+      transport.release_first_request.set()
+
+      assert [e.tolist() for e in first.result()] == [[1]]
+      for i, future in zip(range(2, 6), rest):
+        assert [e.tolist() for e in future.result()] == [[i], [i]]
+
+    # The 8 queued texts are sent in 2 full requests.
+    assert [len(batch) for batch in transport.batches] == [1, 4, 4]
+  finally:
+    client.close()
+
+
+def test_embed_async() -> None:
+  transport = StubTransport()
+  transport.release_first_request.set()
+  client = EmbeddingClient(transport, RateLimits(max_batch_size=4, max_concurrency=1))
+  try:
+    embeddings = asyncio.run(client.embed_async(['hello', 'hi']))
+    assert [e.tolist() for e in embeddings] == [[5], [2]]
+  finally:
+    client.close()
+
+
+def test_retries_rate_limited_requests_with_less_concurrency() -> None:
+  num_requests = 0
+
+  def handler(request: httpx.Request) -> httpx.Response:
+    nonlocal num_requests
+    num_requests += 1
+    if num_requests == 1:
+      return httpx.Response(429, headers={'retry-after': '0'})
+    texts = json.loads(request.content)['input']
+    return httpx.Response(200, json={'data': [{'embedding': [len(text)]} for text in texts]})
+
+  transport = HttpTransport(
+    'https://stub/embed',
+    make_body=lambda texts: {'input': texts},
+    parse_response=lambda response: [data['embedding'] for data in response['data']],
+    transport=httpx.MockTransport(handler))
+  client = EmbeddingClient(transport, RateLimits(max_batch_size=8, max_concurrency=8))
+  try:
+    embeddings = client.embed(['hello', 'hi'])
+    assert [e.tolist() for e in embeddings] == [[5], [2]]
+    assert num_requests == 2
+    # The rate limit halved the concurrency, and the success added back 1 / limit.
+    assert client.concurrency_limit() == 4.25
+  finally:
+    client.close()
+
+
+def test_raises_after_max_attempts(mocker: MockerFixture) -> None:
+  mocker.patch.object(embedding_client, 'MAX_ATTEMPTS', 3)
+  mocker.patch.object(embedding_client, 'MIN_BACKOFF_SECONDS', 0)
+  num_requests = 0
+
+  def handler(request: httpx.Request) -> httpx.Response:
+    nonlocal num_requests
+    num_requests += 1
+    return httpx.Response(500)
+
+  transport = HttpTransport(
+    'https://stub/embed',
+    make_body=lambda texts: {'input': texts},
+    parse_response=lambda response: response,
+    transport=httpx.MockTransport(handler))
+  client = EmbeddingClient(transport, RateLimits(max_batch_size=8, max_concurrency=8))
+  try:
+    with pytest.raises(httpx.HTTPStatusError):
+      client.embed(['hello'])
+    assert num_requests == 3
+  finally:
+    client.close()
+
+
+class RejectingTransport(StubTransport):
+  """Rejects every request with a text that starts with 'bad', like an API rejects a bad input."""
+
+  @override
+  async def embed(self, texts: list[str]) -> list[np.ndarray]:
+    embeddings = await super().embed(texts)
+    if any(text.startswith('bad') for text in texts):
+      request = httpx.Request('POST', 'https://stub/embed')
+      raise httpx.HTTPStatusError(
+        'Bad request', request=request, response=httpx.Response(400, request=request))
+    return embeddings
+
+
+def test_client_errors_fail_only_the_offending_texts() -> None:
+  transport = RejectingTransport()
+  client = EmbeddingClient(transport, RateLimits(max_batch_size=8, max_concurrency=1))
+  try:
+    with ThreadPoolExecutor() as pool:
+      first = pool.submit(client.embed, ['a'])
+      transport.first_request_started.wait()
+      # These callers are coalesced into one request, which the API rejects because of 'bad'.
+      good = pool.submit(client.embed, ['bb', 'ccc'])
+      bad = pool.submit(client.embed, ['bad'])
+      other = pool.submit(client.embed, ['dddd'])
+      time.sleep(0.05)
+      transport.release_first_request.set()
+
+      assert [e.tolist() for e in first.result()] == [[1]]
+      assert [e.tolist() for e in good.result()] == [[2], [3]]
+      assert [e.tolist() for e in other.result()] == [[4]]
+      with pytest.raises(httpx.HTTPStatusError):
+        bad.result()
+
+    # The request is bisected down to the bad text, which is not retried.
+    assert transport.batches == [['a'], ['bb', 'ccc', 'bad', 'dddd'], ['bb', 'ccc'],
+                                 ['bad', 'dddd'], ['bad'], ['dddd']]
+  finally:
+    client.close()
+
+
+def test_embedding_client_is_replaced_when_the_api_key_changes(mocker: MockerFixture) -> None:
+  mocker.patch.dict(embedding_client._CLIENTS, clear=True)
+  limits = RateLimits(max_batch_size=8, max_concurrency=1)
+  first = get_embedding_client('stub', 'key-1', StubTransport, limits)
+  close = mocker.spy(first, 'close')
+  assert get_embedding_client('stub', 'key-1', StubTransport, limits) is first
+  assert close.call_count == 0
+
+  second = get_embedding_client('stub', 'key-2', StubTransport, limits)
+  assert second is not first
+  assert close.call_count == 1
+  assert get_embedding_client('stub', 'key-2', StubTransport, limits) is second
+  second.close()
+
+
+def test_token_bucket() -> None:
+
+  async def acquire_all() -> float:
+    # 6000 tokens per minute is 100 per second, with a burst of 6000.
+    bucket = TokenBucket(rate_per_minute=6000)
+    await bucket.acquire(6000)
+    start = time.monotonic()
+    await bucket.acquire(5)
+    return time.monotonic() - start
+
+  assert asyncio.run(acquire_all()) >= 0.04
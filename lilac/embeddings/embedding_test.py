@@ -1,10 +1,25 @@
 """Tests for embedding.py."""
 
-import numpy as np
+import os
+import pathlib
+import random
+import threading
+import time
+from typing import Iterator
 
-from ..schema import lilac_embedding
+import numpy as np
+from pytest_mock import MockerFixture
+
+from ..schema import (
+  EMBEDDING_KEY,
+  TEXT_SPAN_END_FEATURE,
+  TEXT_SPAN_START_FEATURE,
+  VALUE_KEY,
+  lilac_embedding,
+)
 from ..splitters.chunk_splitter import TextChunk
-from .embedding import compute_split_embeddings
+from . import embedding as embedding_module
+from .embedding import compute_split_embeddings, embedding_cache_namespace
 
 
 def char_splitter(text: str) -> list[TextChunk]:
@@ -110,3 +125,126 @@ def test_split_and_combine_text_embeddings_empty_docs_at_end() -> None:
     None,
     None
   ]
+
+
+def test_split_and_combine_text_embeddings_in_order_with_parallel_requests() -> None:
+  docs = [str(i % 10) * (i % 7) for i in range(100)]
+
+  def slow_splitter(text: str) -> list[TextChunk]:
+    # Splits finish out of order.
+    time.sleep(random.random() * 0.001)
+    return char_splitter(text)
+
+  def embed_fn(batch: list[str]) -> list[np.ndarray]:
+    time.sleep(random.random() * 0.001)
+    return [np.array([float(text), 1.0]) for text in batch]
+
+  result = list(compute_split_embeddings(docs, 3, embed_fn, slow_splitter, num_parallel_requests=4))
+
+  assert len(result) == len(docs)
+  for doc, item in zip(docs, result):
+    if not doc:
+      assert item is None
+      continue
+    assert item is not None
+    assert [
+      (x[VALUE_KEY][TEXT_SPAN_START_FEATURE], x[VALUE_KEY][TEXT_SPAN_END_FEATURE]) for x in item
+    ] == [(i, i + 1) for i in range(len(doc))]
+    expected = np.array([float(doc[0]), 1.0])
+    for x in item:
+      np.testing.assert_allclose(x[EMBEDDING_KEY], expected / np.linalg.norm(expected), rtol=1e-6)
+
+
+def test_split_and_combine_text_embeddings_bounds_lookahead(mocker: MockerFixture) -> None:
+  mocker.patch.object(embedding_module, 'SPLIT_AHEAD_DOCS', 4)
+  num_docs_read = 0
+
+  def docs() -> Iterator[str]:
+    nonlocal num_docs_read
+    for _ in range(1000):
+      num_docs_read += 1
+      yield 'a'
+
+  def embed_fn(batch: list[str]) -> list[np.ndarray]:
+    return [np.ones(1) for _ in batch]
+
+  result = compute_split_embeddings(docs(), 1, embed_fn, num_parallel_requests=2)
+  next(result)
+  # Only a few batches are embedded ahead of the caller, so the input isn't read eagerly.
+  assert num_docs_read < 20
+  result.close()
+
+
+def test_split_and_combine_text_embeddings_shuts_down_workers() -> None:
+  threads_before = threading.active_count()
+
+  def embed_fn(batch: list[str]) -> list[np.ndarray]:
+    return [np.ones(1) for _ in batch]
+
+  for _ in range(10):
+    list(compute_split_embeddings(['abc', 'de'], 1, embed_fn, char_splitter))
+  time.sleep(0.1)
+  assert threading.active_count() <= threads_before
+
+
+def test_split_and_combine_text_embeddings_uses_cache(tmp_path: pathlib.Path,
+                                                      mocker: MockerFixture) -> None:
+  mocker.patch.dict(os.environ, {'LILAC_DATA_PATH': str(tmp_path)})
+  embed_fn_inputs: list[list[str]] = []
+
+  def embed_fn(batch: list[str]) -> list[np.ndarray]:
+    embed_fn_inputs.append(batch)
+    return [np.ones(1) for _ in batch]
+
+  namespace = embedding_cache_namespace('test_embedding', 'v1', split=True)
+  first = list(
+    compute_split_embeddings(['ab', '', 'cd'],
+                             3,
+                             embed_fn,
+                             char_splitter,
+                             cache_namespace=namespace))
+  assert embed_fn_inputs == [['a', 'b', 'c'], ['d']]
+
+  # Cached documents are not split or embedded again.
+  embed_fn_inputs.clear()
+  second = list(
+    compute_split_embeddings(['cd', 'ef', 'ab'],
+                             3,
+                             embed_fn,
+                             char_splitter,
+                             cache_namespace=namespace))
+  assert embed_fn_inputs == [['e', 'f']]
+  assert second == [first[2], first[0], first[0]]
+
+  # A different model version has its own embeddings.
+  embed_fn_inputs.clear()
+  list(
+    compute_split_embeddings(['ab'],
+                             3,
+                             embed_fn,
+                             char_splitter,
+                             cache_namespace=embedding_cache_namespace(
+                               'test_embedding', 'v2', split=True)))
+  assert embed_fn_inputs == [['a', 'b']]
+
+
+def test_split_and_combine_text_embeddings_sort_by_length() -> None:
+  docs = ['aaaa', 'b', 'cc', 'ddd', 'e']
+  embed_fn_inputs: list[list[str]] = []
+
+  def embed_fn(batch: list[str]) -> list[np.ndarray]:
+    embed_fn_inputs.append(batch)
+    return [np.array([len(text), 1.0]) for text in batch]
+
+  result = list(compute_split_embeddings(docs, 2, embed_fn, sort_by_length=True))
+
+  # Chunks of similar length are embedded together.
+  assert embed_fn_inputs == [['b', 'e'], ['cc', 'ddd'], ['aaaa']]
+  # The results keep the order of the documents.
+  for doc, item in zip(docs, result):
+    assert item is not None
+    [embedding] = item
+    assert embedding[VALUE_KEY][TEXT_SPAN_END_FEATURE] == len(doc)
+    expected = np.array([len(doc), 1.0])
+    np.testing.assert_allclose(
+      embedding[EMBEDDING_KEY], expected / np.linalg.norm(expected), rtol=1e-6)
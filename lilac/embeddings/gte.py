@@ -6,8 +6,8 @@ from typing_extensions import override
 from ..schema import Item, RichData
 from ..signal import TextEmbeddingSignal
 from ..splitters.chunk_splitter import split_text
-from .embedding import compute_split_embeddings
-from .transformer_utils import get_model
+from .embedding import compute_split_embeddings, embedding_cache_namespace
+from .transformer_utils import get_model, preload_model
 
 if TYPE_CHECKING:
   pass
@@ -41,6 +41,11 @@ class GTESmall(TextEmbeddingSignal):
 
   _model_name = GTE_SMALL
 
+  @override
+  def setup(self) -> None:
+    # Load the model in the background while the caller prepares the data.
+    preload_model(self._model_name)
+
   @override
   def compute(self, docs: Iterable[RichData]) -> Iterable[Item]:
     """Call the embedding function."""
@@ -48,7 +53,13 @@ class GTESmall(TextEmbeddingSignal):
     embed_fn = model.encode
     split_fn = split_text if self._split else None
     docs = cast(Iterable[str], docs)
-    yield from compute_split_embeddings(docs, batch_size, embed_fn=embed_fn, split_fn=split_fn)
+    yield from compute_split_embeddings(
+      docs,
+      batch_size,
+      embed_fn=embed_fn,
+      split_fn=split_fn,
+      cache_namespace=embedding_cache_namespace(self.name, self._model_name, self._split),
+      sort_by_length=True)
 
 
 class GTEBase(GTESmall):
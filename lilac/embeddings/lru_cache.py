@@ -0,0 +1,79 @@
+"""A least recently used cache of loaded values, with a memory budget."""
+
+import threading
+from collections import OrderedDict
+from typing import Callable, Generic, Hashable, TypeVar
+
+from ..utils import log
+
+K = TypeVar('K', bound=Hashable)
+V = TypeVar('V')
+
+
+class SizedLRUCache(Generic[K, V]):
+  """Keeps the most recently used values loaded, up to a budget of bytes.
+
+  When the cache is over its budget, the least recently used values are evicted, except for the
+  value that was just used. Values are loaded outside of the cache lock, so a slow load doesn't
+  block other keys, and concurrent requests for the same key only load it once.
+
+  Args:
+    max_bytes: The memory budget of the cache.
+    describe: Returns the description of a key in the logs, e.g. 'model "gte-small"'.
+  """
+
+  def __init__(self, max_bytes: int, describe: Callable[[K], str] = str) -> None:
+    self.max_bytes = max_bytes
+    self._describe = describe
+    # Maps a key to its value and size, from least to most recently used.
+    self._values: OrderedDict[K, tuple[V, int]] = OrderedDict()
+    self._num_bytes = 0
+    self._lock = threading.Lock()
+    # Locks the loading of a key, so concurrent requests for the same key only load it once.
+    self._load_locks: dict[K, threading.Lock] = {}
+
+  def get(self, key: K, load: Callable[[], tuple[V, int]]) -> V:
+    """Return the value of `key`, calling `load` for the value and its size if it isn't cached."""
+    with self._lock:
+      if key in self._values:
+        return self._use(key)
+      load_lock = self._load_locks.setdefault(key, threading.Lock())
+
+    with load_lock:
+      with self._lock:
+        if key in self._values:
+          return self._use(key)
+      value, num_bytes = load()
+      with self._lock:
+        self._values[key] = (value, num_bytes)
+        self._num_bytes += num_bytes
+        self._load_locks.pop(key, None)
+        self._evict()
+    return value
+
+  def remove(self, should_remove: Callable[[K], bool]) -> None:
+    """Remove the values of the keys that `should_remove` returns True for."""
+    with self._lock:
+      for key in [key for key in self._values if should_remove(key)]:
+        _, num_bytes = self._values.pop(key)
+        self._num_bytes -= num_bytes
+
+  def clear(self) -> None:
+    """Remove every value."""
+    with self._lock:
+      self._values.clear()
+      self._num_bytes = 0
+
+  def num_bytes(self) -> int:
+    """Return the size of the cached values."""
+    return self._num_bytes
+
+  def _use(self, key: K) -> V:
+    self._values.move_to_end(key)
+    return self._values[key][0]
+
+  def _evict(self) -> None:
+    while self._num_bytes > self.max_bytes and len(self._values) > 1:
+      key, (_, num_bytes) = self._values.popitem(last=False)
+      self._num_bytes -= num_bytes
+      log(f'Evicted {self._describe(key)} ({num_bytes / 1024**2:.1f}MB) from the cache.')
@@ -0,0 +1,63 @@
+"""Tests for the least recently used cache."""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .lru_cache import SizedLRUCache
+
+
+def test_evicts_least_recently_used() -> None:
+  cache: SizedLRUCache[str, str] = SizedLRUCache(max_bytes=200)
+  assert cache.get('a', lambda: ('a1', 100)) == 'a1'
+  assert cache.get('b', lambda: ('b1', 100)) == 'b1'
+  # Using `a` makes `b` the least recently used value.
+  assert cache.get('a', lambda: ('a2', 100)) == 'a1'
+  assert cache.get('c', lambda: ('c1', 100)) == 'c1'
+
+  assert cache.num_bytes() == 200
+  assert cache.get('a', lambda: ('a2', 100)) == 'a1'
+  assert cache.get('b', lambda: ('b2', 100)) == 'b2'
+
+
+def test_keeps_a_value_over_budget() -> None:
+  cache: SizedLRUCache[str, str] = SizedLRUCache(max_bytes=0)
+  assert cache.get('a', lambda: ('a1', 100)) == 'a1'
+  assert cache.get('a', lambda: ('a2', 100)) == 'a1'
+  assert cache.get('b', lambda: ('b1', 100)) == 'b1'
+  assert cache.get('a', lambda: ('a2', 100)) == 'a2'
+
+
+def test_concurrent_gets_load_once() -> None:
+  cache: SizedLRUCache[str, str] = SizedLRUCache(max_bytes=1000)
+  load_started = threading.Event()
+  finish_load = threading.Event()
+  num_loads = 0
+
+  def load() -> tuple[str, int]:
+    nonlocal num_loads
+    num_loads += 1
+    load_started.set()
+    finish_load.wait()
+    return 'a1', 100
+
+  with ThreadPoolExecutor() as pool:
+    first = pool.submit(cache.get, 'a', load)
+    load_started.wait()
+    second = pool.submit(cache.get, 'a', load)
+    # Other keys are not blocked by the slow load.
+    assert cache.get('b', lambda: ('b1', 100)) == 'b1'
+    finish_load.set()
+    assert first.result() == second.result() == 'a1'
+  assert num_loads == 1
+
+
+def test_remove() -> None:
+  cache: SizedLRUCache[str, str] = SizedLRUCache(max_bytes=1000)
+  cache.get('a/1', lambda: ('a1', 100))
+  cache.get('a/2', lambda: ('a2', 100))
+  cache.get('b/1', lambda: ('b1', 100))
+
+  cache.remove(lambda key: key.startswith('a/'))
+  assert cache.num_bytes() == 100
+  assert cache.get('a/1', lambda: ('a1 reloaded', 100)) == 'a1 reloaded'
+  assert cache.get('b/1', lambda: ('b1 reloaded', 100)) == 'b1'
@@ -1,22 +1,32 @@
 """OpenAI embeddings."""
-from typing import TYPE_CHECKING, Any, Iterable, cast
+from typing import Any, Iterable, cast
 
-import numpy as np
-from tenacity import retry, stop_after_attempt, wait_random_exponential
 from typing_extensions import override
 
 from ..env import env
 from ..schema import Item, RichData
 from ..signal import TextEmbeddingSignal
 from ..splitters.chunk_splitter import split_text
-from .embedding import compute_split_embeddings
-
-if TYPE_CHECKING:
-  import openai
+from .embedding import compute_split_embeddings, embedding_cache_namespace
+from .embedding_client import EmbeddingClient, HttpTransport, RateLimits, get_embedding_client
 
 NUM_PARALLEL_REQUESTS = 10
 OPENAI_BATCH_SIZE = 128
 EMBEDDING_MODEL = 'text-embedding-ada-002'
+EMBEDDINGS_URL = 'https://api.openai.com/v1/embeddings'
+# The default rate limits of the embedding model. See https://platform.openai.com/account/limits.
+REQUESTS_PER_MINUTE = 3000
+TOKENS_PER_MINUTE = 1_000_000
+
+
+def _make_body(texts: list[str]) -> Any:
+  # Replace newlines, which can negatively affect performance.
+  # See https://github.com/search?q=repo%3Aopenai%2Fopenai-python+replace+newlines&type=code
+  return {'input': [text.replace('\n', ' ') for text in texts], 'model': EMBEDDING_MODEL}
+
+
+def _parse_response(response: Any) -> list[list[float]]:
+  return [data['embedding'] for data in sorted(response['data'], key=lambda data: data['index'])]
 
 
 class OpenAI(TextEmbeddingSignal):
@@ -33,36 +43,32 @@ class OpenAI(TextEmbeddingSignal):
   name = 'openai'
   display_name = 'OpenAI Embeddings'
 
-  _model: type['openai.Embedding']
+  _client: EmbeddingClient
 
   @override
   def setup(self) -> None:
     api_key = env('OPENAI_API_KEY')
     if not api_key:
       raise ValueError('`OPENAI_API_KEY` environment variable not set.')
-    try:
-      import openai
-      openai.api_key = api_key
-      self._model = openai.Embedding
-    except ImportError:
-      raise ImportError('Could not import the "openai" python package. '
-                        'Please install it with `pip install openai`.')
+    self._client = get_embedding_client(
+      self.name, api_key, lambda: HttpTransport(
+        EMBEDDINGS_URL, _make_body, _parse_response, headers={'Authorization': f'Bearer {api_key}'}
+      ),
+      RateLimits(
+        requests_per_minute=REQUESTS_PER_MINUTE,
+        tokens_per_minute=TOKENS_PER_MINUTE,
+        max_batch_size=OPENAI_BATCH_SIZE,
+        max_concurrency=NUM_PARALLEL_REQUESTS))
 
   @override
   def compute(self, docs: Iterable[RichData]) -> Iterable[Item]:
     """Compute embeddings for the given documents."""
-
-    @retry(wait=wait_random_exponential(min=1, max=20), stop=stop_after_attempt(10))
-    def embed_fn(texts: list[str]) -> list[np.ndarray]:
-
-      # Replace newlines, which can negatively affect performance.
-      # See https://github.com/search?q=repo%3Aopenai%2Fopenai-python+replace+newlines&type=code
-      texts = [text.replace('\n', ' ') for text in texts]
-
-      response: Any = self._model.create(input=texts, model=EMBEDDING_MODEL)
-      return [np.array(embedding['embedding'], dtype=np.float32) for embedding in response['data']]
-
     docs = cast(Iterable[str], docs)
     split_fn = split_text if self._split else None
     yield from compute_split_embeddings(
-      docs, OPENAI_BATCH_SIZE, embed_fn, split_fn, num_parallel_requests=NUM_PARALLEL_REQUESTS)
+      docs,
+      OPENAI_BATCH_SIZE,
+      self._client.embed,
+      split_fn,
+      num_parallel_requests=NUM_PARALLEL_REQUESTS,
+      cache_namespace=embedding_cache_namespace(self.name, EMBEDDING_MODEL, self._split))
@@ -1,22 +1,31 @@
 """PaLM embeddings."""
-from typing import TYPE_CHECKING, Iterable, cast
+from typing import Any, Iterable, cast
 
-import numpy as np
-from tenacity import retry, stop_after_attempt, wait_random_exponential
 from typing_extensions import override
 
 from ..env import env
 from ..schema import Item, RichData
 from ..signal import TextEmbeddingSignal
 from ..splitters.chunk_splitter import split_text
-from .embedding import compute_split_embeddings
-
-if TYPE_CHECKING:
-  import google.generativeai as palm
+from .embedding import compute_split_embeddings, embedding_cache_namespace
+from .embedding_client import EmbeddingClient, HttpTransport, RateLimits, get_embedding_client
 
 PALM_BATCH_SIZE = 1  # PaLM API only supports batch size 1.
-NUM_PARALLEL_REQUESTS = 256  # Because batch size is 1, we can send many requests in parallel.
+MAX_CONCURRENT_REQUESTS = 256  # Because batch size is 1, we can send many requests in parallel.
+# Chunks are handed to the client in batches of this size, which it sends one text per request.
+CLIENT_BATCH_SIZE = 64
 EMBEDDING_MODEL = 'models/embedding-gecko-001'
+EMBED_TEXT_URL = f'https://generativelanguage.googleapis.com/v1beta2/{EMBEDDING_MODEL}:embedText'
+# The default quota of the embedding model.
+REQUESTS_PER_MINUTE = 1500
+
+
+def _make_body(texts: list[str]) -> Any:
+  return {'text': texts[0]}
+
+
+def _parse_response(response: Any) -> list[list[float]]:
+  return [response['embedding']['value']]
 
 
 class PaLM(TextEmbeddingSignal):
@@ -31,32 +40,30 @@ class PaLM(TextEmbeddingSignal):
   name = 'palm'
   display_name = 'PaLM Embeddings'
 
-  _model: 'palm.generate_embeddings'
+  _client: EmbeddingClient
 
   @override
   def setup(self) -> None:
     api_key = env('PALM_API_KEY')
     if not api_key:
       raise ValueError('`PALM_API_KEY` environment variable not set.')
-    try:
-      import google.generativeai as palm
-      palm.configure(api_key=api_key)
-      self._model = palm.generate_embeddings
-    except ImportError:
-      raise ImportError('Could not import the "google.generativeai" python package. '
-                        'Please install it with `pip install google-generativeai`.')
+    self._client = get_embedding_client(
+      self.name, api_key, lambda: HttpTransport(
+        EMBED_TEXT_URL, _make_body, _parse_response, headers={'x-goog-api-key': api_key}),
+      RateLimits(
+        requests_per_minute=REQUESTS_PER_MINUTE,
+        max_batch_size=PALM_BATCH_SIZE,
+        max_concurrency=MAX_CONCURRENT_REQUESTS))
 
   @override
   def compute(self, docs: Iterable[RichData]) -> Iterable[Item]:
     """Compute embeddings for the given documents."""
-
-    @retry(wait=wait_random_exponential(min=1, max=20), stop=stop_after_attempt(10))
-    def embed_fn(texts: list[str]) -> list[np.ndarray]:
-      assert len(texts) == 1, 'PaLM API only supports batch size 1.'
-      response = self._model(model=EMBEDDING_MODEL, text=texts[0])
-      return [np.array(response['embedding'], dtype=np.float32)]
-
     docs = cast(Iterable[str], docs)
     split_fn = split_text if self._split else None
     yield from compute_split_embeddings(
-      docs, PALM_BATCH_SIZE, embed_fn, split_fn, num_parallel_requests=NUM_PARALLEL_REQUESTS)
+      docs,
+      CLIENT_BATCH_SIZE,
+      self._client.embed,
+      split_fn,
+      num_parallel_requests=MAX_CONCURRENT_REQUESTS // CLIENT_BATCH_SIZE,
+      cache_namespace=embedding_cache_namespace(self.name, EMBEDDING_MODEL, self._split))
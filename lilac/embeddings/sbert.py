@@ -6,8 +6,8 @@ from typing_extensions import override
 from ..schema import Item, RichData
 from ..signal import TextEmbeddingSignal
 from ..splitters.chunk_splitter import split_text
-from .embedding import compute_split_embeddings
-from .transformer_utils import get_model
+from .embedding import compute_split_embeddings, embedding_cache_namespace
+from .transformer_utils import get_model, preload_model
 
 # The `all-mpnet-base-v2` model provides the best quality, while `all-MiniLM-L6-v2`` is 5 times
 # faster and still offers good quality. See https://www.sbert.net/docs/pretrained_models.html#sentence-embedding-models/
@@ -28,6 +28,11 @@ class SBERT(TextEmbeddingSignal):
   name = 'sbert'
   display_name = 'SBERT Embeddings'
 
+  @override
+  def setup(self) -> None:
+    # Load the model in the background while the caller prepares the data.
+    preload_model(MINI_LM_MODEL)
+
   @override
   def compute(self, docs: Iterable[RichData]) -> Iterable[Item]:
     """Call the embedding function."""
@@ -35,4 +40,10 @@ class SBERT(TextEmbeddingSignal):
     embed_fn = model.encode
     split_fn = split_text if self._split else None
     docs = cast(Iterable[str], docs)
-    yield from compute_split_embeddings(docs, batch_size, embed_fn=embed_fn, split_fn=split_fn)
+    yield from compute_split_embeddings(
+      docs,
+      batch_size,
+      embed_fn=embed_fn,
+      split_fn=split_fn,
+      cache_namespace=embedding_cache_namespace(self.name, MINI_LM_MODEL, self._split),
+      sort_by_length=True)
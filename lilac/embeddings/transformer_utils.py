@@ -1,32 +1,125 @@
 """Utils for transformer embeddings."""
 
 import functools
-from typing import TYPE_CHECKING, Optional
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any, Callable
 
-from ..utils import log
+from ..env import env
+from ..utils import DebugTimer, log
+from .lru_cache import SizedLRUCache
 
 if TYPE_CHECKING:
   from sentence_transformers import SentenceTransformer
 
+# The default memory budget of the loaded models, in GB. Overridden by the `MODEL_CACHE_GB`
+# environment variable.
+DEFAULT_MODEL_CACHE_GB = 4
+# The dtype of the model weights. Half precision is only used when asked for.
+DEFAULT_DTYPE = 'float32'
 
-def get_model(model_name: str,
-              optimal_batch_sizes: dict[str, int] = {}) -> tuple[int, 'SentenceTransformer']:
-  """Get a transformer model and the optimal batch size for it."""
+# A model is identified by its name, device and dtype.
+ModelKey = tuple[str, str, str]
+
+
+class ModelRegistry:
+  """Keeps the most recently used models loaded, up to a memory budget.
+
+  The size of a model is the size of its parameters.
+  """
+
+  def __init__(self, max_bytes: int, load_fn: Callable[[ModelKey], Any]) -> None:
+    self.max_bytes = max_bytes
+    self._load_fn = load_fn
+    self._models: SizedLRUCache[ModelKey, Any] = SizedLRUCache(max_bytes, _describe_model)
+    self._preload_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='model_preload')
+
+  def get(self, key: ModelKey) -> Any:
+    """Return the model for `key`, loading it if it is not in the registry."""
+    return self._models.get(key, lambda: self._load(key))
+
+  def preload(self, key: ModelKey) -> Future:
+    """Load the model for `key` in the background. Returns a future of the model."""
+    future = self._preload_pool.submit(self.get, key)
+    future.add_done_callback(functools.partial(_log_preload_error, key))
+    return future
+
+  def clear(self) -> None:
+    """Unload every model."""
+    self._models.clear()
+
+  def num_bytes(self) -> int:
+    """Return the size of the loaded models."""
+    return self._models.num_bytes()
+
+  def _load(self, key: ModelKey) -> tuple[Any, int]:
+    with DebugTimer(f'Loading {_describe_model(key)}'):
+      model = self._load_fn(key)
+    return model, _model_bytes(model)
+
+
+def _describe_model(key: ModelKey) -> str:
+  model_name, device, dtype = key
+  return f'model "{model_name}" on "{device or "cpu"}" with {dtype}'
+
+
+def _log_preload_error(key: ModelKey, future: Future) -> None:
+  error = future.exception()
+  if error is not None:
+    log(f'Failed to preload model "{key[0]}": {error}')
+
+
+def _model_bytes(model: Any) -> int:
+  """Return the size of the parameters of a torch model."""
+  if not hasattr(model, 'parameters'):
+    return 0
+  return sum(param.numel() * param.element_size() for param in model.parameters())
+
+
+def _import_sentence_transformers() -> Any:
   try:
-    import torch.backends.mps
-    from sentence_transformers import SentenceTransformer
+    import sentence_transformers
   except ImportError:
     raise ImportError('Could not import the "sentence_transformers" python package. '
                       'Please install it with `pip install "lilac[gte]".')
-  preferred_device: Optional[str] = None
+  return sentence_transformers
+
+
+def _load_sentence_transformer(key: ModelKey) -> 'SentenceTransformer':
+  model_name, device, dtype = key
+  model = _import_sentence_transformers().SentenceTransformer(model_name, device=device or None)
+  if dtype == 'float16':
+    model.half()
+  return model
+
+
+@functools.cache
+def _get_preferred_device() -> str:
+  """Return the device to run models on, or '' for the default device."""
+  _import_sentence_transformers()
+  import torch.backends.mps
   if torch.backends.mps.is_available():
-    preferred_device = 'mps'
+    return 'mps'
   elif not torch.backends.mps.is_built():
     log('MPS not available because the current PyTorch install was not built with MPS enabled.')
+  return ''
+
+
+@functools.cache
+def get_model_registry() -> ModelRegistry:
+  """The global singleton for the model registry."""
+  max_gb = float(env('MODEL_CACHE_GB', DEFAULT_MODEL_CACHE_GB))
+  return ModelRegistry(max_bytes=int(max_gb * 1024**3), load_fn=_load_sentence_transformer)
+
+
+def get_model(model_name: str,
+              optimal_batch_sizes: dict[str, int] = {},
+              dtype: str = DEFAULT_DTYPE) -> tuple[int, 'SentenceTransformer']:
+  """Get a transformer model and the optimal batch size for it."""
+  preferred_device = _get_preferred_device()
+  batch_size = optimal_batch_sizes[preferred_device]
+  return batch_size, get_model_registry().get((model_name, preferred_device, dtype))
 
-  @functools.cache
-  def _get_model(model_name: str) -> 'SentenceTransformer':
-    return SentenceTransformer(model_name, device=preferred_device)
 
-  batch_size = optimal_batch_sizes[preferred_device or '']
-  return batch_size, _get_model(model_name)
+def preload_model(model_name: str, dtype: str = DEFAULT_DTYPE) -> None:
+  """Start loading a transformer model in the background, so a later `get_model` is fast."""
+  get_model_registry().preload((model_name, _get_preferred_device(), dtype))
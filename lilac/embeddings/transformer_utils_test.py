@@ -0,0 +1,91 @@
+"""Tests for the transformer model registry."""
+
+import threading
+
+import numpy as np
+
+from .transformer_utils import ModelKey, ModelRegistry
+
+
+class FakeModel:
+  """A model with a single parameter of `num_bytes` bytes."""
+
+  def __init__(self, key: ModelKey, num_bytes: int) -> None:
+    self.key = key
+    self._param = np.zeros(num_bytes, dtype=np.uint8)
+
+  def parameters(self) -> list['FakeParam']:
+    return [FakeParam(self._param)]
+
+
+class FakeParam:
+  """Mimics the size methods of a torch parameter."""
+
+  def __init__(self, array: np.ndarray) -> None:
+    self._array = array
+
+  def numel(self) -> int:
+    return self._array.size
+
+  def element_size(self) -> int:
+    return self._array.itemsize
+
+
+def test_get_loads_once() -> None:
+  loaded_keys: list[ModelKey] = []
+
+  def load_fn(key: ModelKey) -> FakeModel:
+    loaded_keys.append(key)
+    return FakeModel(key, 100)
+
+  registry = ModelRegistry(max_bytes=1000, load_fn=load_fn)
+  model = registry.get(('gte-small', '', 'float32'))
+  assert registry.get(('gte-small', '', 'float32')) is model
+  # The device and dtype are part of the key.
+  assert registry.get(('gte-small', 'mps', 'float32')) is not model
+  assert registry.get(('gte-small', '', 'float16')) is not model
+
+  assert loaded_keys == [('gte-small', '', 'float32'), ('gte-small', 'mps', 'float32'),
+                         ('gte-small', '', 'float16')]
+  assert registry.num_bytes() == 300
+
+
+def test_unloads_least_recently_used() -> None:
+  registry = ModelRegistry(max_bytes=200, load_fn=lambda key: FakeModel(key, 100))
+  a_model = registry.get(('a', '', 'float32'))
+  b_model = registry.get(('b', '', 'float32'))
+  # Using `a` makes `b` the least recently used model.
+  assert registry.get(('a', '', 'float32')) is a_model
+  registry.get(('c', '', 'float32'))
+
+  assert registry.num_bytes() == 200
+  assert registry.get(('a', '', 'float32')) is a_model
+  assert registry.get(('b', '', 'float32')) is not b_model
+
+
+def test_keeps_a_model_over_budget() -> None:
+  registry = ModelRegistry(max_bytes=0, load_fn=lambda key: FakeModel(key, 100))
+  model = registry.get(('a', '', 'float32'))
+  assert registry.get(('a', '', 'float32')) is model
+
+
+def test_preload() -> None:
+  load_started = threading.Event()
+  finish_load = threading.Event()
+  num_loads = 0
+
+  def load_fn(key: ModelKey) -> FakeModel:
+    nonlocal num_loads
+    num_loads += 1
+    load_started.set()
+    finish_load.wait()
+    return FakeModel(key, 100)
+
+  registry = ModelRegistry(max_bytes=1000, load_fn=load_fn)
+  future = registry.preload(('a', '', 'float32'))
+  load_started.wait()
+  finish_load.set()
+
+  # A get during the preload waits for it instead of loading the model again.
+  assert registry.get(('a', '', 'float32')) is future.result()
+  assert num_loads == 1
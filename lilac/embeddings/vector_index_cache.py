@@ -0,0 +1,73 @@
+"""A process-wide cache of loaded vector indices."""
+
+import functools
+import os
+
+from ..env import env
+from ..utils import DebugTimer
+from .lru_cache import SizedLRUCache
+from .vector_store import VectorDBIndex
+
+# The default memory budget of the cache, in GB. Overridden by the `VECTOR_INDEX_CACHE_GB`
+# environment variable.
+DEFAULT_CACHE_GB = 4
+
+
+class VectorIndexCache:
+  """Keeps the most recently used vector indices loaded, up to a memory budget.
+
+  The size of an index is estimated by the size of its files on disk.
+  """
+
+  def __init__(self, max_bytes: int) -> None:
+    self.max_bytes = max_bytes
+    # Maps the base path of an index to the index.
+    self._indices: SizedLRUCache[str, VectorDBIndex] = SizedLRUCache(
+      max_bytes, lambda base_path: f'vector index {base_path}')
+
+  def get(self, base_path: str, vector_store: str) -> VectorDBIndex:
+    """Return the index saved at `base_path`, loading it if it is not in the cache.
+
+    Args:
+      base_path: The directory the index was saved to.
+      vector_store: The name of the vector store of the index.
+    """
+    return self._indices.get(base_path, lambda: _load_index(base_path, vector_store))
+
+  def remove(self, path: str) -> None:
+    """Remove the indices saved at `path`, or in a directory under it."""
+    path = os.path.normpath(path)
+
+    def is_under_path(base_path: str) -> bool:
+      normalized_base_path = os.path.normpath(base_path)
+      return normalized_base_path == path or normalized_base_path.startswith(path + os.sep)
+
+    self._indices.remove(is_under_path)
+
+  def clear(self) -> None:
+    """Remove every index from the cache."""
+    self._indices.clear()
+
+  def num_bytes(self) -> int:
+    """Return the estimated size of the cached indices."""
+    return self._indices.num_bytes()
+
+
+def _load_index(base_path: str, vector_store: str) -> tuple[VectorDBIndex, int]:
+  with DebugTimer(f'Loading vector index "{vector_store}" from {base_path}'):
+    vector_index = VectorDBIndex(vector_store)
+    vector_index.load(base_path)
+  return vector_index, _directory_size(base_path)
+
+
+def _directory_size(path: str) -> int:
+  """Return the total size of the files in a directory."""
+  return sum(
+    os.path.getsize(os.path.join(root, file)) for root, _, files in os.walk(path) for file in files)
+
+
+@functools.cache
+def get_vector_index_cache() -> VectorIndexCache:
+  """The global singleton for the vector index cache."""
+  max_gb = float(env('VECTOR_INDEX_CACHE_GB', DEFAULT_CACHE_GB))
+  return VectorIndexCache(max_bytes=int(max_gb * 1024**3))
@@ -0,0 +1,76 @@
+"""Tests for the vector index cache."""
+
+import os
+import pathlib
+from typing import Iterable
+
+import numpy as np
+import pytest
+from pytest_mock import MockerFixture
+
+from .vector_index_cache import VectorIndexCache
+from .vector_store import VectorDBIndex
+
+
+@pytest.fixture
+def index_paths(tmp_path: pathlib.Path) -> Iterable[list[str]]:
+  paths = []
+  for name in ['a', 'b', 'c']:
+    vector_index = VectorDBIndex('numpy')
+    vector_index.add([((name,), [(0, 1)])], np.array([[1.0, 0.0]]))
+    path = str(tmp_path / 'dataset' / name)
+    vector_index.save(path)
+    paths.append(path)
+  yield paths
+
+
+def _index_size(path: str) -> int:
+  return sum(os.path.getsize(os.path.join(path, file)) for file in os.listdir(path))
+
+
+def test_get_caches(index_paths: list[str], mocker: MockerFixture) -> None:
+  cache = VectorIndexCache(max_bytes=1 << 30)
+  load_spy = mocker.spy(VectorDBIndex, 'load')
+
+  vector_index = cache.get(index_paths[0], 'numpy')
+  assert cache.get(index_paths[0], 'numpy') is vector_index
+  assert load_spy.call_count == 1
+  assert list(vector_index.path_keys()) == [('a',)]
+  assert cache.num_bytes() == _index_size(index_paths[0])
+
+
+def test_evicts_least_recently_used(index_paths: list[str]) -> None:
+  a_path, b_path, c_path = index_paths
+  cache = VectorIndexCache(max_bytes=_index_size(a_path) + _index_size(b_path))
+
+  a_index = cache.get(a_path, 'numpy')
+  b_index = cache.get(b_path, 'numpy')
+  # Using `a` makes `b` the least recently used index.
+  assert cache.get(a_path, 'numpy') is a_index
+  cache.get(c_path, 'numpy')
+
+  assert cache.get(a_path, 'numpy') is a_index
+  assert cache.get(b_path, 'numpy') is not b_index
+
+
+def test_keeps_an_index_over_budget(index_paths: list[str]) -> None:
+  cache = VectorIndexCache(max_bytes=0)
+
+  a_index = cache.get(index_paths[0], 'numpy')
+  assert cache.get(index_paths[0], 'numpy') is a_index
+  cache.get(index_paths[1], 'numpy')
+  assert cache.get(index_paths[0], 'numpy') is not a_index
+
+
+def test_remove(index_paths: list[str]) -> None:
+  cache = VectorIndexCache(max_bytes=1 << 30)
+  a_index = cache.get(index_paths[0], 'numpy')
+  b_index = cache.get(index_paths[1], 'numpy')
+
+  cache.remove(index_paths[0])
+  assert cache.get(index_paths[0], 'numpy') is not a_index
+  assert cache.get(index_paths[1], 'numpy') is b_index
+
+  # Removing a directory removes the indices under it.
+  cache.remove(os.path.dirname(index_paths[0]))
+  assert cache.num_bytes() == 0
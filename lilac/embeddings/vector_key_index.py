@@ -0,0 +1,303 @@
+"""A columnar index from vector keys to integer values."""
+
+import os
+from typing import Iterable, Literal, Optional, Sequence, Union, cast
+
+import numpy as np
+
+from ..schema import VectorKey
+
+_PREFIXES_SUFFIX = '.key_prefixes.npy'
+_PREFIX_ORDER_SUFFIX = '.key_prefix_order.npy'
+_RADICES_SUFFIX = '.key_radices.npy'
+_CODES_SUFFIX = '.key_codes.npy'
+_CODE_ORDER_SUFFIX = '.key_order.npy'
+_VALUES_SUFFIX = '.key_values.npy'
+
+# The largest code is 2^63 - 1, so the parts of a key must fit in 63 bits.
+_MAX_CODE = np.iinfo(np.int64).max
+
+
+class VectorKeyIndex:
+  """Maps `VectorKey`s, such as (rowid, 0, 1), to integer values, such as rows in a matrix.
+
+  Keys are stored in numpy arrays rather than Python tuples. The first part of a key, typically a
+  rowid, is dictionary-encoded to an id, and each key is encoded as a mixed-radix int64 code of the
+  id and the other parts, which must be non-negative ints. Lookups are a vectorized binary search
+  over the sorted codes. The arrays are saved as .npy files, and can be memory-mapped on load.
+
+  Keys are kept in insertion order, and `add` moves existing keys to the end.
+  """
+
+  def __init__(self) -> None:
+    # The distinct first parts of the keys, in the order they were first added. Strings are stored
+    # as utf-8 bytes.
+    self._prefixes: np.ndarray = np.empty(0, dtype=np.int64)
+    # The radix of each part after the first. Codes are `id * stride_0 + part_1 * stride_1 + ...`.
+    self._radices = np.empty(0, dtype=np.int64)
+    # The code and the value of each key.
+    self._codes = np.empty(0, dtype=np.int64)
+    self._values = np.empty(0, dtype=np.int64)
+    # Sort orders of `_prefixes` and `_codes` for binary search. Built when first needed.
+    self._prefix_order: Optional[np.ndarray] = None
+    self._code_order: Optional[np.ndarray] = None
+
+  def __len__(self) -> int:
+    return len(self._codes)
+
+  @property
+  def values(self) -> np.ndarray:
+    """The value of each key, in key order."""
+    return self._values
+
+  def set_values(self, values: np.ndarray) -> None:
+    """Replace the value of each key, in key order."""
+    assert len(values) == len(self._codes), 'There must be one value per key.'
+    self._values = values.astype(np.int64)
+
+  def add(self, keys: Sequence[VectorKey], values: np.ndarray) -> None:
+    """Add keys with their values. Keys that already exist are moved to the end with the new value.
+
+    Args:
+      keys: The keys to add. They must have the same length as the keys already in the index.
+      values: The value of each key.
+    """
+    if len(keys) != len(values):
+      raise ValueError(f'Length of keys ({len(keys)}) does not match length of values '
+                       f'({len(values)}).')
+    if not keys:
+      return
+    prefixes, parts = _split_keys(keys)
+    initialized = len(self._prefixes) > 0
+    if initialized and parts.shape[1] != len(self._radices):
+      raise ValueError(f'Keys must have {len(self._radices) + 1} parts. Got {keys[0]}.')
+    if initialized and prefixes.dtype.kind != self._prefixes.dtype.kind:
+      raise ValueError(f'The first part of the keys must be of the same type. Got {keys[0]}.')
+
+    # Add the new prefixes to the end of the dictionary, so existing ids don't change.
+    prefix_ids = self._prefix_ids(prefixes)
+    new_prefixes = np.unique(prefixes[prefix_ids < 0])
+    if len(new_prefixes):
+      self._prefixes = np.concatenate([self._prefixes, new_prefixes
+                                      ]) if initialized else new_prefixes
+      self._prefix_order = None
+      prefix_ids = self._prefix_ids(prefixes)
+
+    radices = _radices(parts)
+    if initialized:
+      if np.any(radices > self._radices):
+        # A part is larger than its radix, so every code is re-encoded with the larger radices.
+        radices = np.maximum(radices, self._radices)
+        self._codes = _encode(*_decode(self._codes, self._radices), radices)
+        self._code_order = None
+      else:
+        radices = self._radices
+    _check_radices(len(self._prefixes), radices)
+    self._radices = radices
+
+    codes = _encode(prefix_ids, parts, radices)
+    # Later duplicates of a key win, as with consecutive adds, and the keys keep their order.
+    _, reversed_indices = np.unique(codes[::-1], return_index=True)
+    last_indices = np.sort(len(codes) - 1 - reversed_indices)
+    codes = codes[last_indices]
+    values = np.asarray(values, dtype=np.int64)[last_indices]
+    keep = ~np.isin(self._codes, codes)
+    self._codes = np.concatenate([self._codes[keep], codes])
+    self._values = np.concatenate([self._values[keep], values])
+    self._code_order = None
+
+  def delete(self, keys: Iterable[VectorKey]) -> None:
+    """Delete keys. Keys that are not in the index are ignored."""
+    positions = self.find(list(keys))
+    positions = positions[positions >= 0]
+    if not len(positions):
+      return
+    keep = np.ones(len(self._codes), dtype=bool)
+    keep[positions] = False
+    self._codes = self._codes[keep]
+    self._values = self._values[keep]
+    self._code_order = None
+
+  def find(self, keys: Sequence[VectorKey]) -> np.ndarray:
+    """Return the position of each key in key order, or -1 for keys that are not in the index."""
+    positions = np.full(len(keys), -1, dtype=np.int64)
+    if not len(keys) or not len(self._codes):
+      return positions
+    prefixes, parts = _split_keys(keys)
+    if parts.shape[1] != len(self._radices) or prefixes.dtype.kind != self._prefixes.dtype.kind:
+      return positions
+    prefix_ids = self._prefix_ids(prefixes)
+    # Keys with an unknown prefix, or a part that is too large for its radix, are not in the index.
+    valid = (prefix_ids >= 0) & np.all(parts < self._radices, axis=1)
+    codes = _encode(prefix_ids[valid], parts[valid], self._radices)
+
+    code_order = self._sorted_code_order()
+    sorted_positions = np.searchsorted(self._codes, codes, sorter=code_order)
+    sorted_positions = np.minimum(sorted_positions, len(code_order) - 1)
+    found_positions = code_order[sorted_positions]
+    found = self._codes[found_positions] == codes
+    valid_positions = np.full(len(codes), -1, dtype=np.int64)
+    valid_positions[found] = found_positions[found]
+    positions[valid] = valid_positions
+    return positions
+
+  def lookup(self, keys: Iterable[VectorKey]) -> np.ndarray:
+    """Return the value of each key. Raises a KeyError when a key is not in the index."""
+    keys = list(keys)
+    positions = self.find(keys)
+    if np.any(positions < 0):
+      missing = [key for key, position in zip(keys, positions) if position < 0]
+      raise KeyError(f'Keys are not in the index: {missing[:10]}')
+    return self._values[positions]
+
+  def keys(self, positions: Optional[np.ndarray] = None) -> list[VectorKey]:
+    """Return the keys at the given positions in key order, or all keys."""
+    codes = self._codes if positions is None else self._codes[positions]
+    prefix_ids, parts = _decode(codes, self._radices)
+    prefixes = self._prefixes[prefix_ids]
+    if prefixes.dtype.kind == 'S':
+      prefix_list: list[Union[str, int]] = [prefix.decode() for prefix in prefixes.tolist()]
+    else:
+      prefix_list = prefixes.tolist()
+    return [(prefix, *key_parts) for prefix, key_parts in zip(prefix_list, parts.tolist())]
+
+  def groups(self, positions: Optional[np.ndarray] = None) -> tuple[np.ndarray, np.ndarray]:
+    """Group the keys that only differ in their last part.
+
+    Args:
+      positions: The positions of the keys to group in key order. Defaults to all keys.
+
+    Returns
+      The positions, reordered so that the keys of a group are contiguous, and the start of each
+      group in the reordered positions.
+    """
+    if not len(self._radices):
+      raise ValueError('Keys with a single part cannot be grouped.')
+    # Codes are ordered by their parts from first to last, so sorting the codes groups the keys.
+    if positions is None:
+      sorted_positions = self._sorted_code_order()
+    else:
+      sorted_positions = positions[np.argsort(self._codes[positions], kind='stable')]
+    group_codes = self._codes[sorted_positions] // self._radices[-1]
+    group_starts = np.flatnonzero(np.diff(group_codes, prepend=-1))
+    return sorted_positions, group_starts
+
+  def save(self, base_path: str) -> None:
+    """Save the index to .npy files that start with `base_path`."""
+    save_array(base_path + _PREFIXES_SUFFIX, self._prefixes)
+    save_array(base_path + _PREFIX_ORDER_SUFFIX, self._sorted_prefix_order())
+    save_array(base_path + _RADICES_SUFFIX, self._radices)
+    save_array(base_path + _CODES_SUFFIX, self._codes)
+    save_array(base_path + _CODE_ORDER_SUFFIX, self._sorted_code_order())
+    save_array(base_path + _VALUES_SUFFIX, self._values)
+
+  def load(self, base_path: str, mmap: bool = False) -> None:
+    """Load the index from .npy files that start with `base_path`.
+
+    Args:
+      base_path: The prefix of the files.
+      mmap: Whether to memory-map the arrays instead of reading them.
+    """
+    mmap_mode: Optional[Literal['r']] = 'r' if mmap else None
+    self._prefixes = np.load(base_path + _PREFIXES_SUFFIX, mmap_mode=mmap_mode, allow_pickle=False)
+    self._prefix_order = np.load(
+      base_path + _PREFIX_ORDER_SUFFIX, mmap_mode=mmap_mode, allow_pickle=False)
+    self._radices = np.load(base_path + _RADICES_SUFFIX, allow_pickle=False)
+    self._codes = np.load(base_path + _CODES_SUFFIX, mmap_mode=mmap_mode, allow_pickle=False)
+    self._code_order = np.load(
+      base_path + _CODE_ORDER_SUFFIX, mmap_mode=mmap_mode, allow_pickle=False)
+    self._values = np.load(base_path + _VALUES_SUFFIX, mmap_mode=mmap_mode, allow_pickle=False)
+
+  @staticmethod
+  def exists(base_path: str) -> bool:
+    """Whether an index was saved at `base_path`."""
+    return os.path.exists(base_path + _CODES_SUFFIX)
+
+  def _prefix_ids(self, prefixes: np.ndarray) -> np.ndarray:
+    """Return the dictionary id of each prefix, or -1 for prefixes that are not in the index."""
+    ids = np.full(len(prefixes), -1, dtype=np.int64)
+    if not len(self._prefixes) or prefixes.dtype.kind != self._prefixes.dtype.kind:
+      return ids
+    prefix_order = self._sorted_prefix_order()
+    sorted_positions = np.searchsorted(self._prefixes, prefixes, sorter=prefix_order)
+    sorted_positions = np.minimum(sorted_positions, len(prefix_order) - 1)
+    found_ids = prefix_order[sorted_positions]
+    found = self._prefixes[found_ids] == prefixes
+    ids[found] = found_ids[found]
+    return ids
+
+  def _sorted_prefix_order(self) -> np.ndarray:
+    if self._prefix_order is None:
+      self._prefix_order = np.argsort(self._prefixes, kind='stable')
+    return self._prefix_order
+
+  def _sorted_code_order(self) -> np.ndarray:
+    if self._code_order is None:
+      self._code_order = np.argsort(self._codes, kind='stable')
+    return self._code_order
+
+
+def save_array(path: str, array: np.ndarray) -> None:
+  """Save an array to a .npy file.
+
+  The array is written to a temporary file that then replaces `path`, so arrays that are
+  memory-mapped from `path` stay valid.
+  """
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  tmp_path = path + '.tmp'
+  with open(tmp_path, 'wb') as f:
+    np.save(f, array, allow_pickle=False)
+  os.replace(tmp_path, path)
+
+
+def _split_keys(keys: Sequence[VectorKey]) -> tuple[np.ndarray, np.ndarray]:
+  """Split keys into an array of their first parts, and an int64 matrix of their other parts."""
+  num_parts = len(keys[0])
+  if any(len(key) != num_parts for key in keys):
+    raise ValueError(f'Keys must have the same number of parts. Got {keys[0]} with {num_parts}.')
+  first_parts = [key[0] for key in keys]
+  if isinstance(first_parts[0], str):
+    if not all(isinstance(part, str) for part in first_parts):
+      raise ValueError(f'The first part of the keys must be of the same type. Got {keys[0]}.')
+    prefixes = np.array([cast(str, part).encode() for part in first_parts], dtype=np.bytes_)
+  else:
+    prefixes = np.array(first_parts, dtype=np.int64)
+  try:
+    parts = np.array([key[1:] for key in keys], dtype=np.int64).reshape(len(keys), num_parts - 1)
+  except (TypeError, ValueError) as e:
+    raise ValueError(f'Every part of a key after the first must be an int. Got {keys[0]}.') from e
+  if np.any(parts < 0):
+    raise ValueError('Every part of a key after the first must be non-negative.')
+  return prefixes, parts
+
+
+def _radices(parts: np.ndarray) -> np.ndarray:
+  """Return the smallest powers of two that are larger than each column of `parts`."""
+  max_parts = parts.max(axis=0)
+  return np.left_shift(1, np.ceil(np.log2(max_parts + 1)).astype(np.int64))
+
+
+def _strides(radices: np.ndarray) -> tuple[int, np.ndarray]:
+  """Return the stride of the prefix id, and the stride of each other part."""
+  # The stride of a part is the product of the radices of the parts after it.
+  suffix_products = np.cumprod(radices[::-1])[::-1]
+  strides = np.append(suffix_products[1:], 1)[:len(radices)].astype(np.int64)
+  prefix_stride = int(suffix_products[0]) if len(radices) else 1
+  return prefix_stride, strides
+
+
+def _check_radices(num_prefixes: int, radices: np.ndarray) -> None:
+  if num_prefixes * int(np.prod(radices.astype(object))) > _MAX_CODE:
+    raise ValueError('The keys are too large to be encoded in 63 bits.')
+
+
+def _encode(prefix_ids: np.ndarray, parts: np.ndarray, radices: np.ndarray) -> np.ndarray:
+  prefix_stride, strides = _strides(radices)
+  return prefix_ids.astype(np.int64) * prefix_stride + parts @ strides
+
+
+def _decode(codes: np.ndarray, radices: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+  prefix_stride, strides = _strides(radices)
+  prefix_ids, remainders = np.divmod(codes, prefix_stride)
+  parts = (remainders[:, np.newaxis] // strides) % radices
+  return prefix_ids, parts
@@ -0,0 +1,97 @@
+"""Tests for the columnar vector key index."""
+
+import pathlib
+
+import numpy as np
+import pytest
+
+from .vector_key_index import VectorKeyIndex
+
+
+def test_add_and_lookup() -> None:
+  index = VectorKeyIndex()
+  index.add([('a', 0), ('b', 1), ('a', 2)], np.array([10, 11, 12]))
+
+  assert len(index) == 3
+  np.testing.assert_array_equal(index.lookup([('a', 2), ('b', 1)]), [12, 11])
+  np.testing.assert_array_equal(index.find([('a', 1), ('c', 0), ('b', 1)]), [-1, -1, 1])
+  assert index.keys() == [('a', 0), ('b', 1), ('a', 2)]
+  with pytest.raises(KeyError):
+    index.lookup([('a', 1)])
+
+
+def test_upsert_moves_keys_to_the_end() -> None:
+  index = VectorKeyIndex()
+  index.add([('a', 0), ('b', 0)], np.array([0, 1]))
+  index.add([('a', 0), ('c', 0), ('c', 0)], np.array([2, 3, 4]))
+
+  assert index.keys() == [('b', 0), ('a', 0), ('c', 0)]
+  np.testing.assert_array_equal(index.values, [1, 2, 4])
+
+
+def test_add_larger_parts_reencodes() -> None:
+  index = VectorKeyIndex()
+  index.add([('a', 0, 1)], np.array([0]))
+  index.add([('b', 1000, 70000)], np.array([1]))
+
+  assert index.keys() == [('a', 0, 1), ('b', 1000, 70000)]
+  np.testing.assert_array_equal(index.lookup([('a', 0, 1), ('b', 1000, 70000)]), [0, 1])
+
+
+def test_delete() -> None:
+  index = VectorKeyIndex()
+  index.add([('a', 0), ('b', 0), ('c', 0)], np.array([0, 1, 2]))
+  index.delete([('b', 0), ('d', 0)])
+
+  assert index.keys() == [('a', 0), ('c', 0)]
+  np.testing.assert_array_equal(index.find([('b', 0)]), [-1])
+
+
+def test_groups() -> None:
+  index = VectorKeyIndex()
+  index.add([('b', 0, 1), ('a', 0, 0), ('b', 0, 0), ('a', 1, 0)], np.array([0, 1, 2, 3]))
+
+  positions, group_starts = index.groups()
+  groups = np.split(np.array(index.keys(positions), dtype=object), group_starts[1:])
+  assert sorted(sorted(map(tuple, group)) for group in groups) == [[('a', 0, 0)], [('a', 1, 0)],
+                                                                   [('b', 0, 0), ('b', 0, 1)]]
+
+  positions, group_starts = index.groups(np.array([0, 3]))
+  assert sorted(index.keys(positions)) == [('a', 1, 0), ('b', 0, 1)]
+  np.testing.assert_array_equal(group_starts, [0, 1])
+
+
+def test_int_prefixes() -> None:
+  index = VectorKeyIndex()
+  index.add([(5,), (3,)], np.array([0, 1]))
+
+  assert index.keys() == [(5,), (3,)]
+  np.testing.assert_array_equal(index.lookup([(3,)]), [1])
+
+
+def test_invalid_keys() -> None:
+  index = VectorKeyIndex()
+  index.add([('a', 0)], np.array([0]))
+
+  with pytest.raises(ValueError, match='must have 2 parts'):
+    index.add([('a', 0, 0)], np.array([0]))
+  with pytest.raises(ValueError, match='must be non-negative'):
+    index.add([('a', -1)], np.array([0]))
+
+
+@pytest.mark.parametrize('mmap', [False, True])
+def test_save_and_load(tmp_path: pathlib.Path, mmap: bool) -> None:
+  index = VectorKeyIndex()
+  index.add([('a', 0), ('b', 1)], np.array([0, 1]))
+  base_path = str(tmp_path / 'index')
+  assert not VectorKeyIndex.exists(base_path)
+  index.save(base_path)
+  assert VectorKeyIndex.exists(base_path)
+
+  loaded_index = VectorKeyIndex()
+  loaded_index.load(base_path, mmap=mmap)
+  assert loaded_index.keys() == [('a', 0), ('b', 1)]
+  np.testing.assert_array_equal(loaded_index.lookup([('b', 1)]), [1])
+
+  loaded_index.add([('c', 2)], np.array([2]))
+  np.testing.assert_array_equal(loaded_index.lookup([('c', 2), ('a', 0)]), [2, 0])
@@ -8,7 +8,8 @@ from typing import Iterable, Optional, Type
 import numpy as np
 
 from ..schema import SpanVector, VectorKey
-from ..utils import open_file
+from ..utils import DebugTimer, open_file
+from .vector_key_index import VectorKeyIndex, save_array
 
 
 class VectorStore(abc.ABC):
@@ -16,6 +17,10 @@ class VectorStore(abc.ABC):
 
   # The global name of the vector store.
   name: str
+  # A filtered search over at most this many spans gets their vectors and scores them exactly.
+  # Larger filters search the store's index, which is faster for large subsets but slows down as the
+  # filter gets more selective. Stores with a slow `get` should set a low limit.
+  exact_search_max_spans = 50_000
 
   @abc.abstractmethod
   def save(self, base_path: str) -> None:
@@ -44,6 +49,14 @@ class VectorStore(abc.ABC):
     """
     pass
 
+  def delete(self, keys: Iterable[VectorKey]) -> None:
+    """Delete the embeddings for the given keys.
+
+    Args:
+      keys: The keys to delete. Keys that are not in the store are ignored.
+    """
+    raise NotImplementedError
+
   @abc.abstractmethod
   def get(self, keys: Optional[Iterable[VectorKey]] = None) -> np.ndarray:
     """Return the embeddings for given keys.
@@ -72,10 +85,82 @@ class VectorStore(abc.ABC):
     """
     raise NotImplementedError
 
+  def topk_batch(self,
+                 queries: np.ndarray,
+                 k: int,
+                 keys: Optional[Iterable[VectorKey]] = None) -> list[list[tuple[VectorKey, float]]]:
+    """Return the top k most similar vectors for each query.
+
+    Args:
+      queries: The query vectors. This should be a 2D matrix with one query per row.
+      k: The number of results to return for each query.
+      keys: Optional keys to restrict the search to.
+
+    Returns
+      A list of (key, score) tuples for each query.
+    """
+    if keys is not None:
+      keys = list(keys)
+    return [self.topk(query, k, keys) for query in queries]
+
+  def topk_groups(self,
+                  query: np.ndarray,
+                  k: int,
+                  keys: Optional[Iterable[VectorKey]] = None) -> list[tuple[VectorKey, float]]:
+    """Return the top k groups of keys, scored by their most similar vector.
+
+    A group is the keys that only differ in their last part, such as the spans (rowid, 0, 0) and
+    (rowid, 0, 1) of the group (rowid, 0).
+
+    Args:
+      query: The query vector.
+      k: The number of groups to return.
+      keys: Optional keys to restrict the search to.
+
+    Returns
+      A list of (group key, score) tuples.
+    """
+    return self.topk_groups_batch(np.expand_dims(query, axis=0), k, keys)[0]
+
+  def topk_groups_batch(
+      self,
+      queries: np.ndarray,
+      k: int,
+      keys: Optional[Iterable[VectorKey]] = None) -> list[list[tuple[VectorKey, float]]]:
+    """Return the top k groups of keys for each query. See `topk_groups`.
+
+    This implementation repeats `topk_batch` with a doubling k for the queries that have fewer than
+    k groups. Stores that score every vector override it with a single pass.
+    """
+    if keys is not None:
+      keys = list(keys)
+    num_keys = len(keys) if keys is not None else self.size()
+    results: list[list[tuple[VectorKey, float]]] = [[] for _ in range(len(queries))]
+    pending = list(range(len(queries)))
+    key_k = min(k, num_keys)
+    while key_k > 0 and pending:
+      next_pending: list[int] = []
+      for query_index, key_scores in zip(pending, self.topk_batch(queries[pending], key_k, keys)):
+        group_scores: dict[VectorKey, float] = {}
+        for (*group_key, _), score in key_scores:
+          group_scores.setdefault(tuple(group_key), score)
+        results[query_index] = list(group_scores.items())[:k]
+        if len(group_scores) < k and key_k < num_keys:
+          next_pending.append(query_index)
+      pending = next_pending
+      key_k = min(2 * key_k, num_keys)
+    return results
+
 
 PathKey = VectorKey
 
+# Indices saved before the span arrays have a pickled list of (path key, spans) pairs.
 _SPANS_PICKLE_NAME = 'spans.pkl'
+# The prefix of the files of the path key index and the span arrays.
+_SPANS_BASE_NAME = 'spans'
+_SPAN_OFFSETS_SUFFIX = '.offsets.npy'
+_SPAN_STARTS_SUFFIX = '.starts.npy'
+_SPAN_ENDS_SUFFIX = '.ends.npy'
 
 
 class VectorDBIndex:
@@ -83,41 +168,127 @@ class VectorDBIndex:
 
   This wraps a regular vector store by adding a mapping from path keys, such as (rowid1, 0),
   to span keys, such as (rowid1, 0, 0), which denotes the first span in the (rowid1, 0) document.
+
+  Spans are stored in compressed sparse row form: each path key maps to a slot, and the spans of
+  slot `i` are `_span_starts[_span_offsets[i]:_span_offsets[i + 1]]`, with their ends in
+  `_span_ends`. Slots are append-only, so replaced or deleted path keys leave dead slots until the
+  index is saved.
   """
 
   def __init__(self, vector_store: str) -> None:
     self._vector_store: VectorStore = get_vector_store_cls(vector_store)()
-    # Map a path key to spans for that path.
-    self._id_to_spans: dict[PathKey, list[tuple[int, int]]] = {}
+    # Maps a path key to its slot in the span arrays.
+    self._path_index = VectorKeyIndex()
+    self._span_offsets = np.zeros(1, dtype=np.int64)
+    self._span_starts = np.empty(0, dtype=np.int32)
+    self._span_ends = np.empty(0, dtype=np.int32)
 
   def load(self, base_path: str) -> None:
     """Load the vector index from disk."""
-    assert not self._id_to_spans, 'Cannot load into a non-empty index.'
-    with open_file(os.path.join(base_path, _SPANS_PICKLE_NAME), 'rb') as f:
-      self._id_to_spans.update(pickle.load(f))
+    assert not len(self._path_index), 'Cannot load into a non-empty index.'
+    spans_base_path = os.path.join(base_path, _SPANS_BASE_NAME)
+    if VectorKeyIndex.exists(spans_base_path):
+      self._path_index.load(spans_base_path, mmap=True)
+      self._span_offsets = np.load(
+        spans_base_path + _SPAN_OFFSETS_SUFFIX, mmap_mode='r', allow_pickle=False)
+      self._span_starts = np.load(
+        spans_base_path + _SPAN_STARTS_SUFFIX, mmap_mode='r', allow_pickle=False)
+      self._span_ends = np.load(
+        spans_base_path + _SPAN_ENDS_SUFFIX, mmap_mode='r', allow_pickle=False)
+    else:
+      with open_file(os.path.join(base_path, _SPANS_PICKLE_NAME), 'rb') as f:
+        self._add_spans(pickle.load(f))
     self._vector_store.load(os.path.join(base_path, self._vector_store.name))
 
   def save(self, base_path: str) -> None:
     """Save the vector index to disk."""
-    assert self._id_to_spans, 'Cannot save an empty index.'
-    with open_file(os.path.join(base_path, _SPANS_PICKLE_NAME), 'wb') as f:
-      pickle.dump(list(self._id_to_spans.items()), f)
+    assert len(self._path_index), 'Cannot save an empty index.'
+    self._compact_spans()
+    spans_base_path = os.path.join(base_path, _SPANS_BASE_NAME)
+    save_array(spans_base_path + _SPAN_OFFSETS_SUFFIX, self._span_offsets)
+    save_array(spans_base_path + _SPAN_STARTS_SUFFIX, self._span_starts)
+    save_array(spans_base_path + _SPAN_ENDS_SUFFIX, self._span_ends)
+    self._path_index.save(spans_base_path)
     self._vector_store.save(os.path.join(base_path, self._vector_store.name))
 
   def add(self, all_spans: list[tuple[PathKey, list[tuple[int, int]]]],
           embeddings: np.ndarray) -> None:
-    """Add the given spans and embeddings.
+    """Add or replace the given spans and embeddings.
+
+    The spans of a path key that is already in the index are replaced, acting as an "upsert".
 
     Args:
-      all_spans: The spans to initialize the index with.
-      embeddings: The embeddings to initialize the index with.
+      all_spans: The spans to add, for each path key.
+      embeddings: The embeddings of the spans, in the same order as `all_spans`.
     """
-    assert not self._id_to_spans, 'Cannot add to a non-empty index.'
-    self._id_to_spans.update(all_spans)
     vector_keys = [(*path_key, i) for path_key, spans in all_spans for i in range(len(spans))]
     assert len(vector_keys) == len(embeddings), (
       f'Number of spans ({len(vector_keys)}) and embeddings ({len(embeddings)}) must match.')
-    self._vector_store.add(vector_keys, embeddings)
+    # A path key can have fewer spans than before, so the old span vectors are deleted first.
+    self._delete_span_vectors([path_key for path_key, _ in all_spans])
+    self._add_spans(all_spans)
+    if vector_keys:
+      self._vector_store.add(vector_keys, embeddings)
+
+  def delete(self, path_keys: Iterable[PathKey]) -> None:
+    """Delete the spans and embeddings of the given path keys."""
+    path_keys = list(path_keys)
+    self._delete_span_vectors(path_keys)
+    self._path_index.delete(path_keys)
+
+  def _add_spans(self, all_spans: list[tuple[PathKey, list[tuple[int, int]]]]) -> None:
+    """Append a slot with the spans of each path key, and point the path keys to their slots."""
+    if not all_spans:
+      return
+    num_slots = len(self._span_offsets) - 1
+    counts = np.array([len(spans) for _, spans in all_spans], dtype=np.int64)
+    span_arrays = np.array([span for _, spans in all_spans for span in spans],
+                           dtype=np.int32).reshape(-1, 2)
+    self._span_offsets = np.concatenate(
+      [self._span_offsets, self._span_offsets[-1] + np.cumsum(counts)])
+    self._span_starts = np.concatenate([self._span_starts, span_arrays[:, 0]])
+    self._span_ends = np.concatenate([self._span_ends, span_arrays[:, 1]])
+    self._path_index.add([path_key for path_key, _ in all_spans],
+                         np.arange(num_slots, num_slots + len(all_spans)))
+
+  def _compact_spans(self) -> None:
+    """Drop the dead slots, and put the slots in the order of the path keys."""
+    slots = self._path_index.values
+    if len(slots) == len(self._span_offsets) - 1 and np.array_equal(slots, np.arange(len(slots))):
+      return
+    counts = self._span_offsets[slots + 1] - self._span_offsets[slots]
+    span_indices = _ranges(self._span_offsets[slots], counts)
+    self._span_offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    self._span_starts = self._span_starts[span_indices]
+    self._span_ends = self._span_ends[span_indices]
+    self._path_index.set_values(np.arange(len(slots)))
+
+  def _num_spans(self, path_keys: list[PathKey]) -> np.ndarray:
+    """Return the number of spans of each path key, or 0 for path keys that are not in the index."""
+    positions = self._path_index.find(path_keys)
+    if not len(self._path_index):
+      return np.zeros(len(path_keys), dtype=np.int64)
+    slots = self._path_index.values[np.maximum(positions, 0)]
+    counts = self._span_offsets[slots + 1] - self._span_offsets[slots]
+    return np.where(positions >= 0, counts, 0)
+
+  def _spans(self, slot: int) -> list[tuple[int, int]]:
+    start, end = self._span_offsets[slot], self._span_offsets[slot + 1]
+    return list(zip(self._span_starts[start:end].tolist(), self._span_ends[start:end].tolist()))
+
+  def _delete_span_vectors(self, path_keys: list[PathKey]) -> None:
+    if not path_keys:
+      return
+    vector_keys = [(*path_key, i)
+                   for path_key, num_spans in zip(path_keys,
+                                                  self._num_spans(path_keys).tolist())
+                   for i in range(num_spans)]
+    if vector_keys:
+      self._vector_store.delete(vector_keys)
+
+  def path_keys(self) -> Iterable[PathKey]:
+    """Return the path keys in the index."""
+    return self._path_index.keys()
 
   def get_vector_store(self) -> VectorStore:
     """Return the underlying vector store."""
@@ -132,18 +303,30 @@ class VectorDBIndex:
     Returns
       The span vectors for the given keys.
     """
-    all_spans: list[list[tuple[int, int]]] = []
-    all_vector_keys: list[list[VectorKey]] = []
-    for path_key in keys:
-      spans = self._id_to_spans.get(path_key, [])
-      all_spans.append(spans)
-      all_vector_keys.append([(*path_key, i) for i in range(len(spans))])
+    keys = list(keys)
+    if not keys:
+      return
+    # Resolve the span keys of every path key, and gather their vectors with a single store call.
+    positions = self._path_index.find(keys)
+    found = positions >= 0
+    slots = self._path_index.values[positions[found]]
+    num_spans = np.zeros(len(keys), dtype=np.int64)
+    num_spans[found] = self._span_offsets[slots + 1] - self._span_offsets[slots]
+    span_indices = _ranges(self._span_offsets[slots], num_spans[found])
+    starts = self._span_starts[span_indices].tolist()
+    ends = self._span_ends[span_indices].tolist()
+    vector_keys = [
+      (*path_key, i) for path_key, count in zip(keys, num_spans.tolist()) for i in range(count)
+    ]
+    vectors = self._vector_store.get(vector_keys) if vector_keys else np.array([])
 
     offset = 0
-    for spans, vector_keys in zip(all_spans, all_vector_keys):
-      vectors = self._vector_store.get(vector_keys) if vector_keys else np.array([])
-      yield [{'span': span, 'vector': vector} for span, vector in zip(spans, vectors)]
-      offset += len(spans)
+    for count in num_spans.tolist():
+      yield [{
+        'span': (starts[i], ends[i]),
+        'vector': vectors[i]
+      } for i in range(offset, offset + count)]
+      offset += count
 
   def topk(self,
            query: np.ndarray,
@@ -159,26 +342,83 @@ class VectorDBIndex:
     Returns
       A list of (key, score) tuples.
     """
+    return self.topk_batch(np.expand_dims(query, axis=0), k, path_keys)[0]
+
+  def topk_batch(
+      self,
+      queries: np.ndarray,
+      k: int,
+      path_keys: Optional[Iterable[PathKey]] = None) -> list[list[tuple[PathKey, float]]]:
+    """Return the top k most similar vectors for each query.
+
+    Args:
+      queries: The query vectors. This should be a 2D matrix with one query per row.
+      k: The number of results to return for each query.
+      path_keys: Optional key prefixes to restrict the search to.
+
+    Returns
+      A list of (key, score) tuples for each query.
+    """
     total_num_span_keys = self._vector_store.size()
     k = min(k, total_num_span_keys)
     span_keys: Optional[list[VectorKey]] = None
     if path_keys is not None:
-      span_keys = [
-        (*path_key, i) for path_key in path_keys for i in range(len(self._id_to_spans[path_key]))
-      ]
-      k = min(k, len(span_keys))
-    span_k = k
-    path_key_scores: dict[PathKey, float] = {}
-    while (len(path_key_scores) < k and span_k <= total_num_span_keys and
-           (not span_keys or span_k <= len(span_keys))):
-      span_k += k
-      vector_key_scores = self._vector_store.topk(query, span_k, span_keys)
-      for (*path_key_list, _), score in vector_key_scores:
-        path_key = tuple(path_key_list)
-        if path_key not in path_key_scores:
-          path_key_scores[path_key] = score
-
-    return list(path_key_scores.items())[:k]
+      path_keys = list(path_keys)
+      slots = self._path_index.lookup(path_keys)
+      num_spans = self._span_offsets[slots + 1] - self._span_offsets[slots]
+      num_span_keys = int(num_spans.sum())
+      k = min(k, num_span_keys)
+      if num_span_keys <= self._vector_store.exact_search_max_spans:
+        with DebugTimer(f'Exact vector search for {len(queries)} queries over {num_span_keys} of '
+                        f'{total_num_span_keys} spans'):
+          return self._exact_topk_batch(queries, k, path_keys, num_spans)
+      span_keys = [(*path_key, i)
+                   for path_key, count in zip(path_keys, num_spans.tolist())
+                   for i in range(count)]
+
+    search_name = 'Filtered vector search' if span_keys is not None else 'Vector search'
+    with DebugTimer(f'{search_name} for {len(queries)} queries in the '
+                    f'"{self._vector_store.name}" store over '
+                    f'{len(span_keys) if span_keys is not None else total_num_span_keys} spans'):
+      return self._vector_store.topk_groups_batch(queries, k, span_keys)
+
+  def _exact_topk_batch(self, queries: np.ndarray, k: int, path_keys: list[PathKey],
+                        num_spans: np.ndarray) -> list[list[tuple[PathKey, float]]]:
+    """Return the top k path keys for each query by scoring every span of the given path keys."""
+    has_spans = num_spans > 0
+    path_keys = [path_key for path_key, keep in zip(path_keys, has_spans.tolist()) if keep]
+    num_spans = num_spans[has_spans]
+    k = min(k, len(path_keys))
+    if k <= 0:
+      return [[] for _ in range(len(queries))]
+    span_keys = [
+      (*path_key, i) for path_key, count in zip(path_keys, num_spans.tolist()) for i in range(count)
+    ]
+    vectors = self._vector_store.get(span_keys)
+    span_scores = np.dot(queries.astype(np.float32), vectors.T)
+    # The score of a path key is the score of its best span.
+    scores = np.maximum.reduceat(span_scores, np.cumsum(num_spans) - num_spans, axis=1)
+    results: list[list[tuple[PathKey, float]]] = []
+    for indices, index_scores in zip(*topk_per_row(scores, k)):
+      results.append([(path_keys[index], score) for index, score in zip(indices, index_scores)])
+    return results
+
+
+def _ranges(starts: np.ndarray, counts: np.ndarray) -> np.ndarray:
+  """Return the concatenation of `range(start, start + count)` for each start and count."""
+  range_offsets = np.cumsum(counts) - counts
+  return np.repeat(starts - range_offsets, counts) + np.arange(int(counts.sum()))
+
+
+def topk_per_row(scores: np.ndarray, k: int) -> tuple[list[list[int]], list[list[float]]]:
+  """Return the indices and scores of the k best columns of each row, from largest to smallest."""
+  # We do a partition + sort only top K to save time: O(n + klogk) instead of O(nlogn).
+  indices = np.argpartition(scores, -k, axis=1)[:, -k:]
+  top_scores = np.take_along_axis(scores, indices, axis=1)
+  order = np.argsort(top_scores, axis=1, kind='stable')[:, ::-1]
+  indices = np.take_along_axis(indices, order, axis=1)
+  top_scores = np.take_along_axis(top_scores, order, axis=1)
+  return indices.tolist(), top_scores.tolist()
 
 
 VECTOR_STORE_REGISTRY: dict[str, Type[VectorStore]] = {}
@@ -1,7 +1,7 @@
 """HNSW vector store."""
 
 import multiprocessing
-from typing import Iterable, Optional, Set, cast
+from typing import Callable, Iterable, Optional, cast
 
 import hnswlib
 import numpy as np
@@ -10,9 +10,13 @@ from typing_extensions import override
 
 from ..schema import VectorKey
 from ..utils import DebugTimer
+from .vector_key_index import VectorKeyIndex
 from .vector_store import VectorStore
 
 _HNSW_SUFFIX = '.hnswlib.bin'
+_DIM_SUFFIX = '.hnswlib_dim.npy'
+# Stores saved before `VectorKeyIndex` have a pickled `pd.Series` from keys to labels, named by the
+# dimension.
 _LOOKUP_SUFFIX = '.lookup.pkl'
 
 # Parameters for HNSW index: https://github.com/nmslib/hnswlib/blob/master/ALGO_PARAMS.md
@@ -23,26 +27,42 @@ SPACE = 'ip'
 
 
 class HNSWVectorStore(VectorStore):
-  """HNSW-backed vector store."""
+  """HNSW-backed vector store.
+
+  Adds and deletes update the graph in place. hnswlib has no incremental file format, so every save
+  writes the whole graph.
+  """
 
   name = 'hnsw'
+  # hnswlib returns the vectors of `get` as Python lists, so only small filters are scored exactly.
+  exact_search_max_spans = 2_000
 
   def __init__(self) -> None:
-    # Maps a `VectorKey` to a row index in `_embeddings`.
-    self._key_to_label: Optional[pd.Series] = None
+    # Maps a `VectorKey` to its label in the hnswlib index.
+    self._key_index: Optional[VectorKeyIndex] = None
     self._index: Optional[hnswlib.Index] = None
+    # Maps a label to the position of its key in `_key_index`. Built when first needed.
+    self._label_positions: Optional[np.ndarray] = None
 
   @override
   def save(self, base_path: str) -> None:
-    assert self._key_to_label is not None and self._index is not None, (
+    assert self._key_index is not None and self._index is not None, (
       'The vector store has no embeddings. Call load() or add() first.')
     self._index.save_index(base_path + _HNSW_SUFFIX)
-    self._key_to_label.to_pickle(base_path + _LOOKUP_SUFFIX)
+    np.save(base_path + _DIM_SUFFIX, np.array(self._index.dim), allow_pickle=False)
+    self._key_index.save(base_path)
 
   @override
   def load(self, base_path: str) -> None:
-    self._key_to_label = pd.read_pickle(base_path + _LOOKUP_SUFFIX)
-    dim = int(self._key_to_label.name)
+    self._key_index = VectorKeyIndex()
+    self._label_positions = None
+    if VectorKeyIndex.exists(base_path):
+      self._key_index.load(base_path, mmap=True)
+      dim = int(np.load(base_path + _DIM_SUFFIX, allow_pickle=False))
+    else:
+      key_to_label: pd.Series = pd.read_pickle(base_path + _LOOKUP_SUFFIX)
+      self._key_index.add(key_to_label.index.tolist(), key_to_label.to_numpy())
+      dim = int(cast(str, key_to_label.name))
     index = hnswlib.Index(space=SPACE, dim=dim)
     index.set_num_threads(multiprocessing.cpu_count())
     index.load_index(base_path + _HNSW_SUFFIX)
@@ -51,42 +71,72 @@ class HNSWVectorStore(VectorStore):
 
   @override
   def size(self) -> int:
-    assert self._index is not None, (
+    assert self._key_index is not None, (
       'The vector store has no embeddings. Call load() or add() first.')
-    return self._index.get_current_count()
+    return len(self._key_index)
 
   @override
   def add(self, keys: list[VectorKey], embeddings: np.ndarray) -> None:
-    assert self._index is None, (
-      'Embeddings already exist in this store. Upsert is not yet supported.')
-
     if len(keys) != embeddings.shape[0]:
       raise ValueError(
         f'Length of keys ({len(keys)}) does not match number of embeddings {embeddings.shape[0]}.')
 
+    # Cast to float32 since dot product with float32 is 40-50x faster than float16 and 2.5x faster
+    # than float64.
+    embeddings = embeddings.astype(np.float32)
     dim = embeddings.shape[1]
-    with DebugTimer('hnswlib index creation'):
-      index = hnswlib.Index(space=SPACE, dim=dim)
-      index.set_num_threads(multiprocessing.cpu_count())
-      index.init_index(max_elements=len(keys), ef_construction=CONSTRUCTION_EF, M=M)
-
-      # Cast to float32 since dot product with float32 is 40-50x faster than float16 and 2.5x faster
-      # than float64.
-      embeddings = embeddings.astype(np.float32)
-      row_indices = np.arange(len(keys), dtype=np.int32)
-      self._key_to_label = pd.Series(row_indices, index=keys, dtype=np.int32)
-      self._key_to_label.name = str(dim)
-      index.add_items(embeddings, row_indices)
-      self._index = index
-      self._index.set_ef(min(QUERY_EF, self.size()))
+    if self._index is None or self._key_index is None:
+      with DebugTimer('hnswlib index creation'):
+        index = hnswlib.Index(space=SPACE, dim=dim)
+        index.set_num_threads(multiprocessing.cpu_count())
+        index.init_index(max_elements=len(keys), ef_construction=CONSTRUCTION_EF, M=M)
+        labels = np.arange(len(keys))
+        self._key_index = VectorKeyIndex()
+        self._key_index.add(keys, labels)
+        index.add_items(embeddings, labels)
+        self._index = index
+        self._index.set_ef(min(QUERY_EF, self.size()))
+      return
+
+    if dim != self._index.dim:
+      raise ValueError(f'Embedding dimension ({dim}) does not match the dimension of the store '
+                       f'({self._index.dim}).')
+    # Existing keys keep their label, and hnswlib updates their vector in place. New keys get new
+    # labels, which are never reused, so deleted labels stay deleted.
+    positions = self._key_index.find(keys)
+    labels = self._key_index.values[np.maximum(positions, 0)]
+    is_new = positions < 0
+    num_new_keys = int(is_new.sum())
+    next_label = self._index.element_count
+    labels[is_new] = np.arange(next_label, next_label + num_new_keys)
+
+    with DebugTimer('hnswlib index update'):
+      if next_label + num_new_keys > self._index.max_elements:
+        # Grow geometrically so a stream of small adds doesn't resize the index each time.
+        self._index.resize_index(max(next_label + num_new_keys, 2 * self._index.max_elements))
+      self._index.add_items(embeddings, labels)
+    self._key_index.add(keys, labels)
+    self._label_positions = None
+    self._index.set_ef(min(QUERY_EF, self.size()))
+
+  @override
+  def delete(self, keys: Iterable[VectorKey]) -> None:
+    assert self._index is not None and self._key_index is not None, (
+      'No embeddings exist in this store.')
+    keys = list(keys)
+    positions = self._key_index.find(keys)
+    for label in self._key_index.values[positions[positions >= 0]].tolist():
+      self._index.mark_deleted(label)
+    self._key_index.delete(keys)
+    self._label_positions = None
 
   @override
   def get(self, keys: Optional[Iterable[VectorKey]] = None) -> np.ndarray:
-    assert self._index is not None and self._key_to_label is not None, (
+    assert self._index is not None and self._key_index is not None, (
       'No embeddings exist in this store.')
     if not keys:
-      return np.array(self._index.get_items(self._key_to_label.values), dtype=np.float32)
-    locs = self._key_to_label.loc[cast(list[str], keys)].values
+      return np.array(self._index.get_items(self._key_index.values), dtype=np.float32)
+    locs = self._key_index.lookup(keys)
     return np.array(self._index.get_items(locs), dtype=np.float32)
 
   @override
@@ -94,26 +144,47 @@ class HNSWVectorStore(VectorStore):
            query: np.ndarray,
            k: int,
            keys: Optional[Iterable[VectorKey]] = None) -> list[tuple[VectorKey, float]]:
-    assert self._index is not None and self._key_to_label is not None, (
+    return self.topk_batch(np.expand_dims(query, axis=0), k, keys)[0]
+
+  @override
+  def topk_batch(self,
+                 queries: np.ndarray,
+                 k: int,
+                 keys: Optional[Iterable[VectorKey]] = None) -> list[list[tuple[VectorKey, float]]]:
+    assert self._index is not None and self._key_index is not None, (
       'No embeddings exist in this store.')
-    labels: Set[int] = set()
+    filter_func: Optional[Callable[[int], int]] = None
     if keys is not None:
-      labels = set(self._key_to_label.loc[cast(list[str], keys)].tolist())
+      labels = self._key_index.lookup(keys)
       k = min(k, len(labels))
+      # hnswlib calls the filter for every visited node. Indexing a bitmap of the allowed labels
+      # runs in C, unlike a Python function.
+      label_mask = np.zeros(self._index.element_count, dtype=np.uint8)
+      label_mask[labels] = 1
+      filter_func = bytearray(label_mask).__getitem__
 
     k = min(k, self.size())
+    if k <= 0 or not len(queries):
+      return [[] for _ in range(len(queries))]
 
-    def filter_func(label: int) -> bool:
-      return label in labels
-
-    query = np.expand_dims(query.astype(np.float32), axis=0)
     try:
-      locs, dists = self._index.knn_query(query, k=k, filter=filter_func if labels else None)
+      # hnswlib searches the queries in parallel, with the threads set by `set_num_threads`.
+      locs, dists = self._index.knn_query(queries.astype(np.float32), k=k, filter=filter_func)
     except RuntimeError:
       # If K is too large compared to M and construction-time ef, HNSW will throw an error.
       # In this case we return no results, which is ok for the caller of this method (VectorIndex).
-      return []
-    locs = locs[0]
-    dists = dists[0]
-    topk_keys = self._key_to_label.index.values[locs]
-    return [(key, 1 - dist) for key, dist in zip(topk_keys, dists)]
+      return [[] for _ in range(len(queries))]
+    topk_keys = self._key_index.keys(self._label_key_positions()[locs.reshape(-1)])
+    return [
+      list(zip(topk_keys[i * k:(i + 1) * k], (1 - query_dists).tolist()))
+      for i, query_dists in enumerate(dists)
+    ]
+
+  def _label_key_positions(self) -> np.ndarray:
+    """Return the position of the key of each label in `_key_index`."""
+    if self._label_positions is None:
+      assert self._index is not None and self._key_index is not None
+      label_positions = np.full(self._index.element_count, -1, dtype=np.int64)
+      label_positions[self._key_index.values] = np.arange(len(self._key_index))
+      self._label_positions = label_positions
+    return self._label_positions
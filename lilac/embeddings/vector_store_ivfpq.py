@@ -0,0 +1,421 @@
+"""IVF-PQ vector store, in pure numpy."""
+
+import math
+import os
+import tempfile
+from typing import Iterable, Optional, cast
+
+import numpy as np
+from typing_extensions import override
+
+from ..schema import VectorKey
+from ..utils import DebugTimer
+from .vector_key_index import VectorKeyIndex
+from .vector_store_numpy import save_rows
+from .vector_store_numpy_mmap import NumpyMmapVectorStore, chunked_topk
+
+_IVFPQ_SUFFIX = '.ivfpq.npz'
+_CODES_SUFFIX = '.ivfpq_codes.npy'
+
+# The number of inverted lists is NUM_LISTS_FACTOR * sqrt(number of vectors), with at least
+# TRAIN_SAMPLES_PER_LIST training vectors per list.
+NUM_LISTS_FACTOR = 4
+MAX_NUM_LISTS = 16_384
+# The number of inverted lists scanned by a query. Higher is slower, with better recall.
+NPROBE = 16
+# The target number of dimensions of each product quantization subspace.
+PQ_SUBSPACE_DIM = 8
+PQ_NUM_CENTROIDS = 256
+# The centroids are trained with mini-batch k-means on a random sample of the vectors. The sample
+# grows with the number of lists, up to TRAIN_SAMPLES_PER_LIST * MAX_NUM_LISTS vectors.
+TRAIN_SAMPLE_SIZE = 100_000
+TRAIN_SAMPLES_PER_LIST = 32
+# The quantizers are retrained when the store has grown enough for this many times more lists.
+RETRAIN_LIST_GROWTH = 2
+KMEANS_BATCH_SIZE = 10_000
+KMEANS_ITERATIONS = 20
+# The number of candidates re-ranked with the exact vectors, as a multiple of k. Product
+# quantization is coarser than scalar quantization, so more candidates are re-ranked.
+RERANK_MULTIPLIER = 16
+# The number of vectors encoded, or copied to the spill files, at a time.
+ENCODE_CHUNK_SIZE = 65_536
+# Vectors are assigned to their nearest centroid in blocks, so the distance matrix of a block has at
+# most this many entries.
+ASSIGN_BLOCK_MAX_DISTANCES = 1 << 22
+
+
+class IVFPQVectorStore(NumpyMmapVectorStore):
+  """Stores vectors in an inverted file index with product-quantized residuals.
+
+  Each vector is assigned to the nearest of a set of coarse centroids, and its residual to the
+  centroid is encoded with one byte per subspace. A query only scans the `nprobe` lists with the
+  closest centroids, scoring codes with lookup tables, and optionally re-ranks the best candidates
+  with the exact vectors, which are memory-mapped like the `numpy_mmap` store.
+
+  Added vectors and their codes are appended to spill files in the system temporary directory (see
+  `TMPDIR`), so an index larger than RAM can be built. A save groups the codes by list. When the
+  store outgrows its lists, the quantizers are retrained and every vector is encoded again.
+  """
+  name = 'ivfpq'
+  # Only the probed lists are scanned, so batched and grouped searches use `topk`.
+  exact_scan = False
+
+  def __init__(self) -> None:
+    super().__init__()
+    self.nprobe = NPROBE
+    self.rerank = True
+    self._centroids: Optional[np.ndarray] = None
+    # The codebooks of each subspace, with shape (num_subspaces, PQ_NUM_CENTROIDS, subspace_dim).
+    self._codebooks: Optional[np.ndarray] = None
+    # The rows of the vectors, grouped by list. List `i` is `_list_rows[_list_offsets[i]:
+    # _list_offsets[i + 1]]`. Built when first needed after an add.
+    self._list_offsets: Optional[np.ndarray] = None
+    self._list_rows: Optional[np.ndarray] = None
+    # The codes are in the order of `_list_rows` when loaded, and in row order after an add, when
+    # they are mapped from the spill files.
+    self._codes: Optional[np.ndarray] = None
+    self._spill: Optional[_SpillFiles] = None
+    # Maps a row to its list, and to its position in `_codes` when the codes are grouped by list.
+    self._row_lists: Optional[np.ndarray] = None
+    self._row_positions: Optional[np.ndarray] = None
+    # The position of each row in `_key_index`, when some rows are dead. Built when first needed.
+    self._row_keys: Optional[np.ndarray] = None
+
+  @override
+  def save(self, base_path: str) -> None:
+    super().save(base_path)
+    assert self._centroids is not None and self._codebooks is not None and self._codes is not None
+    list_offsets, list_rows = self._groups()
+    np.savez(
+      base_path + _IVFPQ_SUFFIX,
+      centroids=self._centroids,
+      codebooks=self._codebooks,
+      list_offsets=list_offsets,
+      list_rows=list_rows)
+    code_positions = list_rows if self._spill is not None else None
+    save_rows(base_path + _CODES_SUFFIX, [self._codes], code_positions)
+
+  @override
+  def load(self, base_path: str) -> None:
+    super().load(base_path)
+    with np.load(base_path + _IVFPQ_SUFFIX, allow_pickle=False) as index:
+      self._centroids = index['centroids']
+      self._codebooks = index['codebooks']
+      self._list_offsets = index['list_offsets']
+      self._list_rows = index['list_rows']
+    self._codes = np.load(base_path + _CODES_SUFFIX, mmap_mode='r', allow_pickle=False)
+    self._spill = None
+    self._row_lists = None
+    self._row_positions = None
+    self._row_keys = None
+
+  @override
+  def add(self, keys: list[VectorKey], embeddings: np.ndarray) -> None:
+    if len(keys) != embeddings.shape[0]:
+      raise ValueError(
+        f'Length of keys ({len(keys)}) does not match number of embeddings {embeddings.shape[0]}.')
+    embeddings = embeddings.astype(np.float32, copy=False)
+    if self._centroids is None:
+      self._train(embeddings)
+    centroids = cast(np.ndarray, self._centroids)
+    if embeddings.shape[1] != centroids.shape[1]:
+      raise ValueError(f'Embedding dimension ({embeddings.shape[1]}) does not match the dimension '
+                       f'of the store ({centroids.shape[1]}).')
+
+    if self._spill is None:
+      # The loaded rows are copied to the spill files, which new rows are appended to.
+      self._spill_rows()
+    spill = cast(_SpillFiles, self._spill)
+    num_rows = spill.num_rows
+    # Only the new rows are encoded, with the current quantizers.
+    for start in range(0, len(embeddings), ENCODE_CHUNK_SIZE):
+      chunk = embeddings[start:start + ENCODE_CHUNK_SIZE]
+      spill.append(chunk, *self._encode(chunk))
+    self._map_spill()
+    if _num_lists(spill.num_rows) >= RETRAIN_LIST_GROWTH * len(centroids):
+      self._retrain()
+
+    if self._key_index is None:
+      self._key_index = VectorKeyIndex()
+    # Upserted keys point to their new rows, and their old rows become dead.
+    self._key_index.add(keys, np.arange(num_rows, num_rows + len(embeddings)))
+
+  @override
+  def delete(self, keys: Iterable[VectorKey]) -> None:
+    super().delete(keys)
+    self._row_keys = None
+
+  @override
+  def _take_rows(self, rows: np.ndarray) -> None:
+    self._spill_rows(rows)
+
+  def _spill_rows(self, rows: Optional[np.ndarray] = None) -> None:
+    """Copy the given rows, or every row, to new spill files, with the codes in row order."""
+    assert self._centroids is not None and self._codebooks is not None
+    spill = _SpillFiles(dim=self._centroids.shape[1], num_subspaces=len(self._codebooks))
+    if self._codes is not None:
+      embeddings = cast(np.ndarray, self._embeddings)
+      row_lists, row_positions = self._row_lookup()
+      num_rows = len(rows) if rows is not None else len(row_lists)
+      for start in range(0, num_rows, ENCODE_CHUNK_SIZE):
+        end = min(start + ENCODE_CHUNK_SIZE, num_rows)
+        chunk_rows = rows[start:end] if rows is not None else np.arange(start, end)
+        code_positions = row_positions[chunk_rows] if row_positions is not None else chunk_rows
+        spill.append(embeddings[chunk_rows], row_lists[chunk_rows], self._codes[code_positions])
+    self._spill = spill
+    self._map_spill()
+
+  def _retrain(self) -> None:
+    """Retrain the quantizers on every row, and encode the rows again."""
+    embeddings = cast(np.ndarray, self._embeddings)
+    self._train(embeddings)
+    assert self._centroids is not None and self._codebooks is not None
+    spill = _SpillFiles(dim=self._centroids.shape[1], num_subspaces=len(self._codebooks))
+    for start in range(0, len(embeddings), ENCODE_CHUNK_SIZE):
+      chunk = np.asarray(embeddings[start:start + ENCODE_CHUNK_SIZE])
+      spill.append(chunk, *self._encode(chunk))
+    self._spill = spill
+    self._map_spill()
+
+  def _map_spill(self) -> None:
+    """Read the vectors, lists and codes from the spill files."""
+    spill = cast(_SpillFiles, self._spill)
+    self._embeddings = spill.vectors()
+    self._row_lists = spill.lists()
+    self._codes = spill.codes()
+    self._row_positions = None
+    self._list_offsets = None
+    self._list_rows = None
+    self._row_keys = None
+
+  def _train(self, embeddings: np.ndarray) -> None:
+    """Train the coarse centroids and the product quantization codebooks."""
+    num_vectors, dim = embeddings.shape
+    num_lists = _num_lists(num_vectors)
+    sample_size = min(num_vectors, max(TRAIN_SAMPLE_SIZE, TRAIN_SAMPLES_PER_LIST * num_lists))
+    rng = np.random.default_rng(42)
+    sample = embeddings[np.sort(rng.choice(num_vectors, sample_size, replace=False))]
+
+    with DebugTimer('ivfpq training'):
+      centroids = _minibatch_kmeans(sample, num_lists, rng)
+      sample_residuals = sample - centroids[_nearest_centroids(sample, centroids)]
+
+      num_subspaces = max(
+        d for d in range(1, dim + 1) if dim % d == 0 and d <= max(1, dim // PQ_SUBSPACE_DIM))
+      subspace_residuals = sample_residuals.reshape(len(sample), num_subspaces, -1)
+      num_codes = min(PQ_NUM_CENTROIDS, len(sample))
+      codebooks = np.stack(
+        [_minibatch_kmeans(subspace_residuals[:, i], num_codes, rng) for i in range(num_subspaces)])
+    self._centroids = centroids
+    self._codebooks = codebooks
+
+  def _encode(self, embeddings: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Return the list and the codes of each embedding."""
+    assert self._centroids is not None and self._codebooks is not None
+    centroids, codebooks = self._centroids, self._codebooks
+    num_subspaces = len(codebooks)
+    lists = _nearest_centroids(embeddings, centroids).astype(np.int32)
+    residuals = (embeddings - centroids[lists]).reshape(len(embeddings), num_subspaces, -1)
+    codes = np.empty((len(embeddings), num_subspaces), dtype=np.uint8)
+    for i in range(num_subspaces):
+      codes[:, i] = _nearest_centroids(residuals[:, i], codebooks[i])
+    return lists, codes
+
+  @override
+  def topk(self,
+           query: np.ndarray,
+           k: int,
+           keys: Optional[Iterable[VectorKey]] = None) -> list[tuple[VectorKey, float]]:
+    assert self._embeddings is not None and self._key_index is not None, (
+      'The vector store has no embeddings. Call load() or add() first.')
+    assert self._centroids is not None and self._codebooks is not None
+    codes = cast(np.ndarray, self._codes)
+    query = query.astype(np.float32).reshape(-1)
+    centroid_scores = self._centroids.dot(query)
+    # The score of a code in each subspace, with shape (num_subspaces, PQ_NUM_CENTROIDS).
+    num_subspaces = self._codebooks.shape[0]
+    lookup_table = np.einsum('mcd,md->mc', self._codebooks, query.reshape(num_subspaces, -1))
+    subspaces = np.arange(num_subspaces)
+
+    if keys is not None:
+      # Scan all the restricted rows, wherever their list is.
+      keys = list(keys)
+      rows = self._key_index.lookup(keys)
+      row_lists, row_positions = self._row_lookup()
+      positions = row_positions[rows] if row_positions is not None else rows
+      row_centroid_scores = centroid_scores[row_lists[rows]]
+    else:
+      list_offsets, list_rows = self._groups()
+      num_lists = len(self._centroids)
+      probed = np.argsort(centroid_scores)[::-1][:min(self.nprobe, num_lists)]
+      ranges = [(list_offsets[i], list_offsets[i + 1]) for i in probed]
+      positions = np.concatenate([np.arange(start, end) for start, end in ranges])
+      row_centroid_scores = np.concatenate(
+        [np.full(end - start, centroid_scores[i]) for i, (start, end) in zip(probed, ranges)])
+      rows = list_rows[positions]
+      if self._spill is not None:
+        # The codes are in row order.
+        positions = rows
+      if self._has_dead_rows():
+        live = self._row_key_positions()[rows] >= 0
+        positions, rows = positions[live], rows[live]
+        row_centroid_scores = row_centroid_scores[live]
+
+    k = min(k, len(rows))
+    if k <= 0:
+      return []
+
+    def score_rows(start: int, end: int) -> np.ndarray:
+      chunk_codes = codes[positions[start:end]]
+      # Asymmetric distance: the query is exact, and each subspace of a code is a table lookup.
+      return row_centroid_scores[start:end] + lookup_table[subspaces, chunk_codes].sum(axis=1)
+
+    num_candidates = min(k * RERANK_MULTIPLIER, len(rows)) if self.rerank else k
+    candidates, scores = chunked_topk(score_rows, len(rows), num_candidates)
+
+    if self.rerank:
+      # Reading rows in order is faster from a memory-mapped file.
+      candidate_rows = rows[candidates]
+      order = np.argsort(candidate_rows)
+      scores = np.empty(len(candidates), dtype=np.float32)
+      scores[order] = np.dot(self._embeddings[candidate_rows[order]], query).reshape(-1)
+      best = np.argsort(scores)[::-1][:k]
+      candidates, scores = candidates[best], scores[best]
+
+    if keys is not None:
+      topk_keys = [keys[candidate] for candidate in candidates]
+    elif self._has_dead_rows():
+      topk_keys = self._key_index.keys(self._row_key_positions()[rows[candidates]])
+    else:
+      topk_keys = self._key_index.keys(rows[candidates])
+    return list(zip(topk_keys, scores))
+
+  def _row_key_positions(self) -> np.ndarray:
+    """Return the position of each row in the key lookup, or -1 for dead rows."""
+    if self._row_keys is None:
+      assert self._embeddings is not None and self._key_index is not None
+      row_keys = np.full(len(self._embeddings), -1, dtype=np.int64)
+      row_keys[self._key_index.values] = np.arange(len(self._key_index))
+      self._row_keys = row_keys
+    return self._row_keys
+
+  def _groups(self) -> tuple[np.ndarray, np.ndarray]:
+    """Return the list offsets, and the rows grouped by list."""
+    if self._list_offsets is None or self._list_rows is None:
+      assert self._centroids is not None and self._row_lists is not None
+      row_lists = np.asarray(self._row_lists)
+      list_sizes = np.bincount(row_lists, minlength=len(self._centroids))
+      self._list_offsets = np.concatenate([[0], np.cumsum(list_sizes)]).astype(np.int64)
+      self._list_rows = np.argsort(row_lists, kind='stable').astype(np.uint32)
+    return cast(np.ndarray, self._list_offsets), cast(np.ndarray, self._list_rows)
+
+  def _row_lookup(self) -> tuple[np.ndarray, Optional[np.ndarray]]:
+    """Return the list of each row, and its position in the codes, or None for row order."""
+    if self._row_lists is None:
+      list_offsets, list_rows = self._groups()
+      num_rows = len(list_rows)
+      row_positions = np.empty(num_rows, dtype=np.int64)
+      row_positions[list_rows] = np.arange(num_rows)
+      row_lists = np.empty(num_rows, dtype=np.int32)
+      row_lists[list_rows] = np.repeat(np.arange(len(list_offsets) - 1), np.diff(list_offsets))
+      self._row_lists, self._row_positions = row_lists, row_positions
+    return self._row_lists, self._row_positions
+
+
+class _SpillFiles:
+  """Append-only files with the vectors, lists and codes of the rows, in row order.
+
+  The files are raw arrays that are read through memory maps, so the rows are not held in memory.
+  The files are deleted with this object.
+  """
+
+  def __init__(self, dim: int, num_subspaces: int) -> None:
+    self._dir = tempfile.TemporaryDirectory(prefix='lilac_ivfpq_')
+    self._vectors = _SpillFile(os.path.join(self._dir.name, 'vectors'), np.float32, (dim,))
+    self._lists = _SpillFile(os.path.join(self._dir.name, 'lists'), np.int32, ())
+    self._codes = _SpillFile(os.path.join(self._dir.name, 'codes'), np.uint8, (num_subspaces,))
+    self.num_rows = 0
+
+  def append(self, vectors: np.ndarray, lists: np.ndarray, codes: np.ndarray) -> None:
+    """Append rows to the files."""
+    self._vectors.append(vectors)
+    self._lists.append(lists)
+    self._codes.append(codes)
+    self.num_rows += len(vectors)
+
+  def vectors(self) -> np.ndarray:
+    """Map the vectors of the rows."""
+    return self._vectors.map(self.num_rows)
+
+  def lists(self) -> np.ndarray:
+    """Map the lists of the rows."""
+    return self._lists.map(self.num_rows)
+
+  def codes(self) -> np.ndarray:
+    """Map the codes of the rows."""
+    return self._codes.map(self.num_rows)
+
+
+class _SpillFile:
+  """An append-only file with an array of rows with the given dtype and row shape."""
+
+  def __init__(self, path: str, dtype: type, row_shape: tuple[int, ...]) -> None:
+    self.path = path
+    self.dtype: np.dtype = np.dtype(dtype)
+    self.row_shape = row_shape
+    open(path, 'wb').close()
+
+  def append(self, rows: np.ndarray) -> None:
+    with open(self.path, 'ab') as f:
+      np.ascontiguousarray(rows, dtype=self.dtype).tofile(f)
+
+  def map(self, num_rows: int) -> np.ndarray:
+    shape = (num_rows, *self.row_shape)
+    if not num_rows:
+      # An empty file can't be memory-mapped.
+      return np.empty(shape, dtype=self.dtype)
+    return np.memmap(self.path, dtype=self.dtype, mode='r', shape=shape)
+
+
+def _num_lists(num_vectors: int) -> int:
+  """Return the number of lists of a store with the given number of vectors."""
+  # Each list needs enough training vectors, so small stores have fewer lists.
+  return max(
+    1,
+    min(MAX_NUM_LISTS, num_vectors // TRAIN_SAMPLES_PER_LIST,
+        int(NUM_LISTS_FACTOR * math.sqrt(num_vectors))))
+
+
+def _nearest_centroids(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+  """Return the index of the nearest centroid, in euclidean distance, of each vector."""
+  # |v - c|^2 = |v|^2 - 2 v.c + |c|^2, and |v|^2 doesn't change the nearest centroid.
+  squared_norms = np.square(centroids).sum(axis=1)
+  nearest = np.empty(len(vectors), dtype=np.int64)
+  block_size = max(1, ASSIGN_BLOCK_MAX_DISTANCES // len(centroids))
+  for start in range(0, len(vectors), block_size):
+    block = vectors[start:start + block_size]
+    nearest[start:start + len(block)] = np.argmin(
+      squared_norms - 2 * block.dot(centroids.T), axis=1)
+  return nearest
+
+
+def _minibatch_kmeans(vectors: np.ndarray, num_centroids: int,
+                      rng: np.random.Generator) -> np.ndarray:
+  """Train k-means centroids with mini-batches, as in Sculley, "Web-scale k-means clustering"."""
+  vectors = vectors.astype(np.float32, copy=False)
+  centroids = vectors[rng.choice(len(vectors), num_centroids, replace=False)].copy()
+  counts = np.zeros(num_centroids, dtype=np.int64)
+  batch_size = min(KMEANS_BATCH_SIZE, len(vectors))
+  for _ in range(KMEANS_ITERATIONS):
+    batch = vectors[rng.choice(len(vectors), batch_size, replace=False)]
+    assignments = _nearest_centroids(batch, centroids)
+    batch_counts = np.bincount(assignments, minlength=num_centroids)
+    sums = np.zeros_like(centroids)
+    np.add.at(sums, assignments, batch)
+    assigned = batch_counts > 0
+    counts += batch_counts
+    # Move each centroid towards the mean of its members, with a decaying learning rate.
+    learning_rates = (batch_counts[assigned] / counts[assigned])[:, np.newaxis]
+    means = sums[assigned] / batch_counts[assigned][:, np.newaxis]
+    centroids[assigned] += learning_rates * (means - centroids[assigned])
+  return centroids
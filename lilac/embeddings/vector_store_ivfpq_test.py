@@ -0,0 +1,153 @@
+"""Tests for the IVF-PQ vector store."""
+
+import pathlib
+from typing import cast
+
+import numpy as np
+import pytest
+from pytest_mock import MockerFixture
+from sklearn.preprocessing import normalize
+
+from ..schema import VectorKey
+from . import vector_store_ivfpq
+from .vector_store_ivfpq import (
+  RETRAIN_LIST_GROWTH,
+  TRAIN_SAMPLES_PER_LIST,
+  IVFPQVectorStore,
+  _nearest_centroids,
+  _num_lists,
+)
+from .vector_store_numpy import NumpyVectorStore
+
+
+def _clustered_embeddings(num_vectors: int, dim: int) -> np.ndarray:
+  rng = np.random.default_rng(42)
+  centers = rng.standard_normal((50, dim))
+  embeddings = centers[rng.integers(0, len(centers), num_vectors)]
+  return normalize(embeddings + 0.3 * rng.standard_normal((num_vectors, dim))).astype(np.float32)
+
+
+def test_recall_against_numpy(tmp_path: pathlib.Path) -> None:
+  embeddings = _clustered_embeddings(5000, 32)
+  keys: list[VectorKey] = [(f'row{i}', 0) for i in range(len(embeddings))]
+  queries = embeddings[:20] + 0.01
+
+  numpy_store = NumpyVectorStore()
+  numpy_store.add(keys, embeddings)
+  store = IVFPQVectorStore()
+  store.add(keys, embeddings)
+  store.save(str(tmp_path / 'store'))
+  store = IVFPQVectorStore()
+  store.load(str(tmp_path / 'store'))
+
+  num_hits = 0
+  for query in queries:
+    expected = numpy_store.topk(query, 10)
+    result = store.topk(query, 10)
+    num_hits += len({key for key, _ in expected} & {key for key, _ in result})
+    # The scores are re-ranked with the exact vectors.
+    expected_scores = {key: score for key, score in expected}
+    for key, score in result:
+      if key in expected_scores:
+        assert score == pytest.approx(expected_scores[key], abs=1e-6)
+  assert num_hits / (10 * len(queries)) >= 0.9
+
+
+def test_nprobe_and_rerank() -> None:
+  embeddings = _clustered_embeddings(2000, 16)
+  keys: list[VectorKey] = [(f'row{i}', 0) for i in range(len(embeddings))]
+  store = IVFPQVectorStore()
+  store.add(keys, embeddings)
+  query = embeddings[0]
+
+  # Probing every list and re-ranking is exact for the top result.
+  store.nprobe = len(store._centroids)  # type: ignore
+  assert store.topk(query, 1)[0][0] == ('row0', 0)
+
+  # Without re-ranking, the scores are approximated from the codes.
+  store.rerank = False
+  [(_, score)] = store.topk(query, 1)
+  assert score == pytest.approx(1.0, abs=0.2)
+
+
+def test_topk_with_keys_outside_probed_lists() -> None:
+  embeddings = _clustered_embeddings(2000, 16)
+  keys: list[VectorKey] = [(f'row{i}', 0) for i in range(len(embeddings))]
+  store = IVFPQVectorStore()
+  store.add(keys, embeddings)
+  store.nprobe = 1
+
+  # The restricted keys are scanned even when their lists are not probed.
+  farthest = np.argsort(embeddings.dot(embeddings[0]))[:3]
+  restricted: list[VectorKey] = [keys[i] for i in farthest]
+  result = store.topk(embeddings[0], 10, keys=restricted)
+  assert sorted(key for key, _ in result) == sorted(restricted)
+  for key, score in result:
+    row = int(str(key[0])[3:])
+    assert score == pytest.approx(float(embeddings[row].dot(embeddings[0])), abs=1e-6)
+
+
+def test_add_spills_rows_to_disk(tmp_path: pathlib.Path) -> None:
+  embeddings = _clustered_embeddings(3000, 16)
+  keys: list[VectorKey] = [(f'row{i}', 0) for i in range(len(embeddings))]
+  queries = embeddings[::100] + 0.01
+
+  store = IVFPQVectorStore()
+  for start in range(0, len(embeddings), 1000):
+    store.add(keys[start:start + 1000], embeddings[start:start + 1000])
+  store.delete([keys[2999]])
+  # The vectors and codes are memory-mapped from the spill files, not held in memory.
+  assert isinstance(store._embeddings, np.memmap)
+  assert isinstance(store._codes, np.memmap)
+  expected = [store.topk(query, 10) for query in queries]
+
+  # Rows added after a load are appended to the loaded rows.
+  store = IVFPQVectorStore()
+  store.add(keys[:1000], embeddings[:1000])
+  store.save(str(tmp_path / 'store'))
+  store = IVFPQVectorStore()
+  store.load(str(tmp_path / 'store'))
+  store.add(keys[1000:], embeddings[1000:])
+  store.delete([keys[2999]])
+  assert [store.topk(query, 10) for query in queries] == expected
+
+  store.save(str(tmp_path / 'store'))
+  store = IVFPQVectorStore()
+  store.load(str(tmp_path / 'store'))
+  assert store.size() == 2999
+  np.testing.assert_array_equal(store.get([keys[100], keys[2600]]), embeddings[[100, 2600]])
+  assert [store.topk(query, 10) for query in queries] == expected
+
+
+def test_nearest_centroids_in_blocks(mocker: MockerFixture) -> None:
+  rng = np.random.default_rng(0)
+  vectors = rng.standard_normal((100, 8))
+  centroids = rng.standard_normal((10, 8))
+  expected = np.argmin(((vectors[:, np.newaxis] - centroids)**2).sum(axis=2), axis=1)
+
+  # Each block has 3 vectors.
+  mocker.patch.object(vector_store_ivfpq, 'ASSIGN_BLOCK_MAX_DISTANCES', 30)
+  np.testing.assert_array_equal(_nearest_centroids(vectors, centroids), expected)
+
+
+def test_num_lists_is_capped_by_the_training_vectors() -> None:
+  embeddings = _clustered_embeddings(1000, 16)
+  store = IVFPQVectorStore()
+  store.add([(f'row{i}', 0) for i in range(len(embeddings))], embeddings)
+  assert len(store._centroids) == 1000 // TRAIN_SAMPLES_PER_LIST  # type: ignore
+
+
+def test_retrains_when_the_store_outgrows_its_lists() -> None:
+  embeddings = _clustered_embeddings(20_000, 16)
+  keys: list[VectorKey] = [(f'row{i}', 0) for i in range(len(embeddings))]
+  store = IVFPQVectorStore()
+  store.add(keys[:40], embeddings[:40])
+  assert len(store._centroids) == 1  # type: ignore
+
+  for start in range(40, len(embeddings), 2000):
+    store.add(keys[start:start + 2000], embeddings[start:start + 2000])
+  num_lists = len(store._centroids)  # type: ignore
+  assert num_lists > _num_lists(len(embeddings)) // RETRAIN_LIST_GROWTH
+  # Every row was encoded again with the retrained quantizers.
+  list_sizes = np.bincount(cast(np.ndarray, store._row_lists), minlength=num_lists)
+  assert list_sizes.max() < len(embeddings) // 10
@@ -1,67 +1,186 @@
 """NumpyVectorStore class for storing vectors in numpy arrays."""
 
-from typing import Iterable, Optional, cast
+import glob
+import os
+from typing import Iterable, Iterator, Optional, Sequence, cast
 
 import numpy as np
 import pandas as pd
 from typing_extensions import override
 
 from ..schema import VectorKey
-from .vector_store import VectorStore
+from .vector_key_index import VectorKeyIndex, save_array
+from .vector_store import VectorStore, topk_per_row
 
 _EMBEDDINGS_SUFFIX = '.matrix.npy'
+# Stores saved before `VectorKeyIndex` have a pickled `pd.Series` from keys to rows.
 _LOOKUP_SUFFIX = '.lookup.pkl'
+# Rows appended after the matrix was written are saved in delta segments, `<base>.delta.<i>.npy`.
+_DELTA_SUFFIX = '.delta'
+
+# Saves are compacted into a single matrix when there would be more delta segments than this, or
+# when more than COMPACTION_DEAD_FRACTION of the rows are deleted or overwritten.
+MAX_DELTA_SEGMENTS = 16
+COMPACTION_DEAD_FRACTION = 0.25
+
+# Batched searches score the queries in blocks, so the score matrix of a block has at most this many
+# entries.
+TOPK_BATCH_MAX_SCORES = 1 << 24
+# The number of rows written at a time by `save_rows`.
+SAVE_CHUNK_SIZE = 65_536
 
 
 class NumpyVectorStore(VectorStore):
-  """Stores vectors as in-memory np arrays."""
+  """Stores vectors as in-memory np arrays.
+
+  Rows are append-only: upserted keys point to a new row, and deleted keys are dropped from the
+  lookup, leaving dead rows behind until the matrix is compacted. A save only writes the rows added
+  since the last save, as a delta segment, so saving a growing store costs time proportional to the
+  new rows.
+  """
   name = 'numpy'
 
+  # Whether saves can write delta segments. When False, every save writes the whole matrix.
+  supports_delta_segments = True
+  # Whether batched and grouped searches score every row exactly in a single pass. When False, they
+  # are built from `topk`.
+  exact_scan = True
+  # Gathering rows from an in-memory matrix is fast, so large filters are still scored exactly.
+  exact_search_max_spans = 1_000_000
+
   def __init__(self) -> None:
-    self._embeddings: Optional[np.ndarray] = None
-    # Maps a `VectorKey` to a row index in `_embeddings`.
-    self._key_to_index: Optional[pd.Series] = None
+    self._matrix: Optional[np.ndarray] = None
+    # Rows added since the matrix was last read. They are concatenated to the matrix lazily, so a
+    # stream of small adds doesn't copy the whole matrix every time.
+    self._appended: list[np.ndarray] = []
+    # Maps a `VectorKey` to a row index in `_embeddings`. When every row is live, the rows are in
+    # the order of the keys.
+    self._key_index: Optional[VectorKeyIndex] = None
+    # The path the store was last saved to or loaded from, and the number of rows and delta
+    # segments on disk.
+    self._saved_path: Optional[str] = None
+    self._num_saved_rows = 0
+    self._num_delta_segments = 0
+
+  @property
+  def _embeddings(self) -> Optional[np.ndarray]:
+    """The matrix of every row, dead or alive."""
+    if self._appended:
+      self._matrix = np.concatenate([cast(np.ndarray, self._matrix), *self._appended])
+      self._appended = []
+    return self._matrix
+
+  @_embeddings.setter
+  def _embeddings(self, embeddings: Optional[np.ndarray]) -> None:
+    self._matrix = embeddings
+    self._appended = []
+
+  def _num_rows(self) -> int:
+    """The number of rows, dead or alive, without concatenating the appended rows."""
+    num_rows = len(self._matrix) if self._matrix is not None else 0
+    return num_rows + sum(len(rows) for rows in self._appended)
+
+  def _segments(self) -> list[np.ndarray]:
+    """The matrix and the rows appended to it, in row order."""
+    assert self._matrix is not None
+    return [self._matrix, *self._appended]
+
+  def _gather(self, rows: np.ndarray) -> np.ndarray:
+    """Return the given rows, without concatenating the appended rows to the matrix."""
+    return gather_rows(self._segments(), rows)
 
   @override
   def size(self) -> int:
-    assert self._embeddings is not None, (
+    assert self._key_index is not None, (
       'The vector store has no embeddings. Call load() or add() first.')
-    return len(self._embeddings)
+    return len(self._key_index)
 
   @override
   def save(self, base_path: str) -> None:
-    assert self._embeddings is not None and self._key_to_index is not None, (
+    assert self._matrix is not None and self._key_index is not None, (
       'The vector store has no embeddings. Call load() or add() first.')
-    np.save(base_path + _EMBEDDINGS_SUFFIX, self._embeddings, allow_pickle=False)
-    self._key_to_index.to_pickle(base_path + _LOOKUP_SUFFIX)
+    compact = not (self.supports_delta_segments and self._saved_path == base_path and
+                   self._num_delta_segments < MAX_DELTA_SEGMENTS and not self._needs_compaction())
+    if not compact:
+      if self._num_rows() > self._num_saved_rows:
+        np.save(
+          _delta_path(base_path, self._num_delta_segments),
+          self._unsaved_rows(),
+          allow_pickle=False)
+        self._num_delta_segments += 1
+    else:
+      self._compact()
+      save_array(base_path + _EMBEDDINGS_SUFFIX, cast(np.ndarray, self._embeddings))
+      self._num_delta_segments = 0
+    # The key index is written after the rows, so rows from a partially written save are dead rows.
+    self._key_index.save(base_path)
+    if compact:
+      # The delta segments are removed last. Until then, the old files stay loadable.
+      for delta_path in _delta_paths(base_path):
+        os.remove(delta_path)
+    self._saved_path = base_path
+    self._num_saved_rows = self._num_rows()
+
+  def _unsaved_rows(self) -> np.ndarray:
+    """The rows added since the last save."""
+    if len(cast(np.ndarray, self._matrix)) == self._num_saved_rows and self._appended:
+      # Only the appended rows are new, so the matrix is not copied.
+      return np.concatenate(self._appended) if len(self._appended) > 1 else self._appended[0]
+    return cast(np.ndarray, self._embeddings)[self._num_saved_rows:]
 
   @override
   def load(self, base_path: str) -> None:
-    self._embeddings = np.load(base_path + _EMBEDDINGS_SUFFIX, allow_pickle=False)
-    self._key_to_index = pd.read_pickle(base_path + _LOOKUP_SUFFIX)
+    segments = [np.load(base_path + _EMBEDDINGS_SUFFIX, allow_pickle=False)]
+    segments.extend(np.load(path, allow_pickle=False) for path in _delta_paths(base_path))
+    self._embeddings = np.concatenate(segments) if len(segments) > 1 else segments[0]
+    self._key_index = load_key_index(base_path)
+    self._loaded(base_path, num_delta_segments=len(segments) - 1)
+
+  def _loaded(self, base_path: str, num_delta_segments: int) -> None:
+    """Record that the store matches the files at `base_path`."""
+    self._saved_path = base_path
+    self._num_saved_rows = self._num_rows()
+    self._num_delta_segments = num_delta_segments
 
   @override
   def add(self, keys: list[VectorKey], embeddings: np.ndarray) -> None:
-    if self._embeddings or self._key_to_index:
-      raise ValueError('Embeddings already exist in this store. Upsert is not yet supported.')
-
     if len(keys) != embeddings.shape[0]:
       raise ValueError(
         f'Length of keys ({len(keys)}) does not match number of embeddings {embeddings.shape[0]}.')
 
     # Cast to float32 since dot product with float32 is 40-50x faster than float16 and 2.5x faster
     # than float64.
-    self._embeddings = embeddings.astype(np.float32)
-    row_indices = np.arange(len(embeddings), dtype=np.uint32)
-    self._key_to_index = pd.Series(row_indices, index=keys, dtype=np.uint32)
+    embeddings = embeddings.astype(np.float32)
+    if self._matrix is None or self._key_index is None:
+      self._embeddings = embeddings
+      self._key_index = VectorKeyIndex()
+      self._key_index.add(keys, np.arange(len(embeddings)))
+      return
+
+    dim = self._matrix.shape[1]
+    if embeddings.shape[1] != dim:
+      raise ValueError(f'Embedding dimension ({embeddings.shape[1]}) does not match the dimension '
+                       f'of the store ({dim}).')
+    num_rows = self._num_rows()
+    self._appended.append(embeddings)
+    # Upserted keys point to their new rows, and their old rows become dead.
+    self._key_index.add(keys, np.arange(num_rows, num_rows + len(embeddings)))
+
+  @override
+  def delete(self, keys: Iterable[VectorKey]) -> None:
+    assert self._key_index is not None, (
+      'The vector store has no embeddings. Call load() or add() first.')
+    self._key_index.delete(keys)
 
   @override
   def get(self, keys: Optional[Iterable[VectorKey]] = None) -> np.ndarray:
-    assert self._embeddings is not None and self._key_to_index is not None, (
+    assert self._embeddings is not None and self._key_index is not None, (
       'The vector store has no embeddings. Call load() or add() first.')
     if not keys:
+      if self._has_dead_rows():
+        return self._embeddings.take(self._key_index.values, axis=0)
       return self._embeddings
-    locs = self._key_to_index.loc[cast(list[str], keys)]
+    locs = self._key_index.lookup(keys)
     return self._embeddings.take(locs, axis=0)
 
   @override
@@ -69,18 +188,22 @@ class NumpyVectorStore(VectorStore):
            query: np.ndarray,
            k: int,
            keys: Optional[Iterable[VectorKey]] = None) -> list[tuple[VectorKey, float]]:
-    assert self._embeddings is not None and self._key_to_index is not None, (
+    assert self._embeddings is not None and self._key_index is not None, (
       'The vector store has no embeddings. Call load() or add() first.')
     if keys is not None:
-      row_indices = self._key_to_index.loc[cast(list[str], keys)]
-      embeddings = self._embeddings.take(row_indices, axis=0)
       keys = list(keys)
+      embeddings = self._embeddings.take(self._key_index.lookup(keys), axis=0)
+    elif self._has_dead_rows():
+      embeddings = self._embeddings.take(self._key_index.values, axis=0)
     else:
-      keys, embeddings = cast(list[VectorKey], self._key_to_index.index.tolist()), self._embeddings
+      # Every row is live, so the rows are in the order of the keys.
+      embeddings = self._embeddings
 
     query = query.astype(embeddings.dtype)
     similarities: np.ndarray = np.dot(embeddings, query).reshape(-1)
     k = min(k, len(similarities))
+    if k <= 0:
+      return []
 
     # We do a partition + sort only top K to save time: O(n + klogk) instead of O(nlogn).
     indices = np.argpartition(similarities, -k)[-k:]
@@ -88,5 +211,190 @@ class NumpyVectorStore(VectorStore):
     indices = indices[np.argsort(similarities[indices])][::-1]
 
     topk_similarities = similarities[indices]
-    topk_keys = [keys[idx] for idx in indices]
+    if keys is not None:
+      topk_keys = [keys[idx] for idx in indices]
+    else:
+      topk_keys = self._key_index.keys(indices)
     return list(zip(topk_keys, topk_similarities))
+
+  @override
+  def topk_batch(self,
+                 queries: np.ndarray,
+                 k: int,
+                 keys: Optional[Iterable[VectorKey]] = None) -> list[list[tuple[VectorKey, float]]]:
+    if not self.exact_scan:
+      return super().topk_batch(queries, k, keys)
+    assert self._matrix is not None and self._key_index is not None, (
+      'The vector store has no embeddings. Call load() or add() first.')
+    rows: Optional[np.ndarray] = None
+    if keys is not None:
+      keys = list(keys)
+      rows = self._key_index.lookup(keys)
+    elif self._has_dead_rows():
+      rows = self._key_index.values
+    num_rows = len(rows) if rows is not None else self._num_rows()
+    k = min(k, num_rows)
+    if k <= 0:
+      return [[] for _ in range(len(queries))]
+
+    results: list[list[tuple[VectorKey, float]]] = []
+    for query_block in _query_blocks(queries, num_rows):
+      # Without keys, the scored rows are in the order of the keys.
+      for positions, scores in zip(*topk_per_row(self._score_rows(query_block, rows), k)):
+        if keys is not None:
+          topk_keys = [keys[position] for position in positions]
+        else:
+          topk_keys = self._key_index.keys(np.array(positions, dtype=np.int64))
+        results.append(list(zip(topk_keys, scores)))
+    return results
+
+  @override
+  def topk_groups_batch(
+      self,
+      queries: np.ndarray,
+      k: int,
+      keys: Optional[Iterable[VectorKey]] = None) -> list[list[tuple[VectorKey, float]]]:
+    if not self.exact_scan:
+      return super().topk_groups_batch(queries, k, keys)
+    assert self._matrix is not None and self._key_index is not None, (
+      'The vector store has no embeddings. Call load() or add() first.')
+    key_positions: Optional[np.ndarray] = None
+    if keys is not None:
+      key_positions = self._key_index.find(list(keys))
+      key_positions = key_positions[key_positions >= 0]
+    positions, group_starts = self._key_index.groups(key_positions)
+    k = min(k, len(group_starts))
+    if k <= 0:
+      return [[] for _ in range(len(queries))]
+
+    rows = self._key_index.values[positions]
+    results: list[list[tuple[VectorKey, float]]] = []
+    for query_block in _query_blocks(queries, len(rows)):
+      if keys is None:
+        # Score every row in the order it is stored, so the matrix is not copied.
+        scores = self._score_rows(query_block)[:, rows]
+      else:
+        scores = self._score_rows(query_block, rows)
+      # The score of a group is the score of its best key.
+      group_scores = np.maximum.reduceat(scores, group_starts, axis=1)
+      for groups, top_scores in zip(*topk_per_row(group_scores, k)):
+        group_keys = [key[:-1] for key in self._key_index.keys(positions[group_starts[groups]])]
+        results.append(list(zip(group_keys, top_scores)))
+    return results
+
+  def _score_rows(self, queries: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
+    """Return the dot product of each query with the given rows, or with every row.
+
+    Returns
+      A matrix with one row of scores per query.
+    """
+    assert self._embeddings is not None
+    embeddings = self._embeddings if rows is None else self._embeddings.take(rows, axis=0)
+    return np.dot(queries.astype(np.float32), embeddings.T)
+
+  def _has_dead_rows(self) -> bool:
+    """Whether some rows were deleted or overwritten, and are not pointed to by any key."""
+    assert self._key_index is not None
+    return len(self._key_index) < self._num_rows()
+
+  def _needs_compaction(self) -> bool:
+    assert self._key_index is not None
+    num_dead_rows = self._num_rows() - len(self._key_index)
+    return num_dead_rows > COMPACTION_DEAD_FRACTION * self._num_rows()
+
+  def _compact(self) -> None:
+    """Drop the dead rows, and put the rows in the order of the keys."""
+    assert self._matrix is not None and self._key_index is not None
+    if not self._has_dead_rows():
+      return
+    self._take_rows(self._key_index.values)
+    self._key_index.set_values(np.arange(len(self._key_index)))
+
+  def _take_rows(self, rows: np.ndarray) -> None:
+    """Keep only the given rows, in the given order."""
+    assert self._embeddings is not None
+    self._embeddings = self._embeddings.take(rows, axis=0)
+
+
+def _query_blocks(queries: np.ndarray, num_rows: int) -> Iterator[np.ndarray]:
+  """Split the queries into blocks whose score matrix has at most TOPK_BATCH_MAX_SCORES entries."""
+  block_size = max(1, TOPK_BATCH_MAX_SCORES // max(num_rows, 1))
+  for start in range(0, len(queries), block_size):
+    yield queries[start:start + block_size]
+
+
+def gather_rows(segments: Sequence[np.ndarray], rows: np.ndarray) -> np.ndarray:
+  """Return the given rows of the concatenation of `segments`, without concatenating them."""
+  if len(segments) == 1:
+    return segments[0].take(rows, axis=0)
+  starts = np.cumsum([0] + [len(segment) for segment in segments])
+  segment_ids = np.searchsorted(starts, rows, side='right') - 1
+  result = np.empty((len(rows), *segments[0].shape[1:]), dtype=segments[0].dtype)
+  for i in np.unique(segment_ids):
+    in_segment = segment_ids == i
+    result[in_segment] = segments[i].take(rows[in_segment] - starts[i], axis=0)
+  return result
+
+
+def slice_rows(segments: Sequence[np.ndarray], start: int, end: int) -> np.ndarray:
+  """Return the rows [start, end) of the concatenation of `segments`, without concatenating them."""
+  parts: list[np.ndarray] = []
+  offset = 0
+  for segment in segments:
+    segment_start, segment_end = max(start - offset, 0), min(end - offset, len(segment))
+    if segment_start < segment_end:
+      parts.append(segment[segment_start:segment_end])
+    offset += len(segment)
+  if len(parts) == 1:
+    return parts[0]
+  if not parts:
+    return segments[0][:0]
+  return np.concatenate(parts)
+
+
+def save_rows(path: str, segments: Sequence[np.ndarray], rows: Optional[np.ndarray] = None) -> None:
+  """Save the given rows, or every row, of the concatenation of `segments` to a .npy file.
+
+  The rows are written SAVE_CHUNK_SIZE at a time, so the segments can be memory-mapped arrays that
+  are larger than memory. Like `save_array`, the rows are written to a temporary file that then
+  replaces `path`.
+  """
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  num_rows = len(rows) if rows is not None else sum(len(segment) for segment in segments)
+  header = {
+    'descr': segments[0].dtype.str,
+    'fortran_order': False,
+    'shape': (num_rows, *segments[0].shape[1:])
+  }
+  tmp_path = path + '.tmp'
+  with open(tmp_path, 'wb') as f:
+    np.lib.format.write_array_header_1_0(f, header)  # type: ignore
+    for start in range(0, num_rows, SAVE_CHUNK_SIZE):
+      end = min(start + SAVE_CHUNK_SIZE, num_rows)
+      if rows is not None:
+        chunk = gather_rows(segments, rows[start:end])
+      else:
+        chunk = slice_rows(segments, start, end)
+      np.ascontiguousarray(chunk).tofile(f)
+  os.replace(tmp_path, path)
+
+
+def load_key_index(base_path: str, mmap: bool = False) -> VectorKeyIndex:
+  """Load the key index of a store, including stores saved with a pickled lookup."""
+  key_index = VectorKeyIndex()
+  if VectorKeyIndex.exists(base_path):
+    key_index.load(base_path, mmap=mmap)
+  else:
+    key_to_index: pd.Series = pd.read_pickle(base_path + _LOOKUP_SUFFIX)
+    key_index.add(key_to_index.index.tolist(), key_to_index.to_numpy())
+  return key_index
+
+
+def _delta_path(base_path: str, segment: int) -> str:
+  return f'{base_path}{_DELTA_SUFFIX}.{segment}.npy'
+
+
+def _delta_paths(base_path: str) -> list[str]:
+  """Return the paths of the delta segments of a store, in the order they were written."""
+  paths = glob.glob(f'{glob.escape(base_path)}{_DELTA_SUFFIX}.*.npy')
+  return sorted(paths, key=lambda path: int(path[:-len('.npy')].rsplit('.', 1)[1]))
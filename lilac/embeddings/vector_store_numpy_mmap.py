@@ -0,0 +1,147 @@
+"""NumpyMmapVectorStore class for storing vectors in memory-mapped numpy arrays."""
+
+from typing import Callable, Iterable, Optional
+
+import numpy as np
+from typing_extensions import override
+
+from ..schema import VectorKey
+from .vector_store_numpy import (
+  _EMBEDDINGS_SUFFIX,
+  NumpyVectorStore,
+  load_key_index,
+  save_rows,
+  slice_rows,
+)
+
+# The number of rows scored at a time by `topk`, which bounds the memory used by a scan.
+TOPK_CHUNK_SIZE = 65_536
+
+
+class NumpyMmapVectorStore(NumpyVectorStore):
+  """Stores vectors as np arrays that are memory-mapped from disk.
+
+  Loading maps the matrix without reading it, so opening a store is near-instant and the page cache
+  is shared by every process that loads the same store. `topk` scans the matrix in chunks, which
+  allows matrices larger than RAM. Added rows are kept in memory next to the mapped matrix, and are
+  scanned as separate segments. A memory map needs a single file, so every save writes the whole
+  matrix, a chunk at a time, and maps the written file.
+  """
+  name = 'numpy_mmap'
+  supports_delta_segments = False
+  # Gathering rows may read them from disk.
+  exact_search_max_spans = 250_000
+
+  @override
+  def save(self, base_path: str) -> None:
+    assert self._matrix is not None and self._key_index is not None, (
+      'The vector store has no embeddings. Call load() or add() first.')
+    matrix_path = base_path + _EMBEDDINGS_SUFFIX
+    # Only the live rows are written, in the order of the keys.
+    live_rows = self._key_index.values if self._has_dead_rows() else None
+    save_rows(matrix_path, self._segments(), live_rows)
+    self._compact()
+    self._embeddings = np.load(matrix_path, mmap_mode='r', allow_pickle=False)
+    # The key index is written last, so rows from a partially written save are dead rows.
+    self._key_index.save(base_path)
+    self._loaded(base_path, num_delta_segments=0)
+
+  @override
+  def load(self, base_path: str) -> None:
+    self._embeddings = np.load(base_path + _EMBEDDINGS_SUFFIX, mmap_mode='r', allow_pickle=False)
+    self._key_index = load_key_index(base_path, mmap=True)
+    self._loaded(base_path, num_delta_segments=0)
+
+  @override
+  def get(self, keys: Optional[Iterable[VectorKey]] = None) -> np.ndarray:
+    assert self._matrix is not None and self._key_index is not None, (
+      'The vector store has no embeddings. Call load() or add() first.')
+    if keys:
+      return self._gather(self._key_index.lookup(keys))
+    if self._has_dead_rows():
+      return self._gather(self._key_index.values)
+    if self._appended:
+      # The rows are copied, but the mapped matrix is kept.
+      return np.concatenate(self._segments())
+    return self._matrix
+
+  @override
+  def topk(self,
+           query: np.ndarray,
+           k: int,
+           keys: Optional[Iterable[VectorKey]] = None) -> list[tuple[VectorKey, float]]:
+    assert self._matrix is not None and self._key_index is not None, (
+      'The vector store has no embeddings. Call load() or add() first.')
+    row_indices: Optional[np.ndarray] = None
+    if keys is not None:
+      keys = list(keys)
+      row_indices = self._key_index.lookup(keys)
+    elif self._has_dead_rows():
+      row_indices = self._key_index.values
+    num_rows = len(row_indices) if row_indices is not None else self._num_rows()
+    k = min(k, num_rows)
+    if k <= 0:
+      return []
+
+    segments = self._segments()
+    query = query.astype(np.float32)
+
+    def score_rows(start: int, end: int) -> np.ndarray:
+      if row_indices is None:
+        chunk = slice_rows(segments, start, end)
+      else:
+        chunk = self._gather(row_indices[start:end])
+      return np.dot(chunk, query).reshape(-1)
+
+    top_positions, top_similarities = chunked_topk(score_rows, num_rows, k)
+    if keys is not None:
+      topk_keys = [keys[position] for position in top_positions]
+    else:
+      topk_keys = self._key_index.keys(top_positions)
+    return list(zip(topk_keys, top_similarities))
+
+  @override
+  def _score_rows(self, queries: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
+    segments = self._segments()
+    queries = queries.astype(np.float32)
+    num_rows = len(rows) if rows is not None else self._num_rows()
+    scores = np.empty((len(queries), num_rows), dtype=np.float32)
+    for start in range(0, num_rows, TOPK_CHUNK_SIZE):
+      end = min(start + TOPK_CHUNK_SIZE, num_rows)
+      if rows is None:
+        chunk = slice_rows(segments, start, end)
+      else:
+        chunk = self._gather(rows[start:end])
+      scores[:, start:end] = np.dot(queries, chunk.T)
+    return scores
+
+  @override
+  def _take_rows(self, rows: np.ndarray) -> None:
+    # `save` writes the given rows to disk and maps them, so the matrix is not gathered in memory.
+    pass
+
+
+def chunked_topk(score_rows: Callable[[int, int], np.ndarray], num_rows: int,
+                 k: int) -> tuple[np.ndarray, np.ndarray]:
+  """Return the positions and scores of the k best rows, sorted from largest to smallest score.
+
+  Args:
+    score_rows: Returns the scores of the rows in [start, end).
+    num_rows: The number of rows to score.
+    k: The number of rows to return.
+  """
+  # The positions of the best k rows seen so far.
+  top_positions = np.empty(0, dtype=np.int64)
+  top_scores = np.empty(0, dtype=np.float32)
+  for start in range(0, num_rows, TOPK_CHUNK_SIZE):
+    end = min(start + TOPK_CHUNK_SIZE, num_rows)
+    scores = np.concatenate([top_scores, score_rows(start, end)])
+    positions = np.concatenate([top_positions, np.arange(start, end)])
+    if len(scores) > k:
+      best = np.argpartition(scores, -k)[-k:]
+      scores, positions = scores[best], positions[best]
+    top_scores, top_positions = scores, positions
+
+  # Sorted by value from largest to smallest.
+  order = np.argsort(top_scores)[::-1]
+  return top_positions[order], top_scores[order]
@@ -0,0 +1,65 @@
+"""Tests for the memory-mapped numpy vector store."""
+
+import pathlib
+
+import numpy as np
+from pytest_mock import MockerFixture
+
+from ..schema import VectorKey
+from . import vector_store_numpy_mmap
+from .vector_store_numpy import NumpyVectorStore
+from .vector_store_numpy_mmap import NumpyMmapVectorStore
+
+
+def test_load_maps_the_matrix(tmp_path: pathlib.Path) -> None:
+  store = NumpyMmapVectorStore()
+  store.add([('a',), ('b',), ('c',)], np.array([[1, 2], [3, 4], [5, 6]]))
+  store.save(str(tmp_path / 'store'))
+
+  loaded = NumpyMmapVectorStore()
+  loaded.load(str(tmp_path / 'store'))
+  assert isinstance(loaded.get(), np.memmap)
+  assert loaded.size() == 3
+  np.testing.assert_array_equal(loaded.get([('c',), ('a',)]), np.array([[5, 6], [1, 2]]))
+
+
+def test_topk_scans_in_chunks(tmp_path: pathlib.Path, mocker: MockerFixture) -> None:
+  mocker.patch.object(vector_store_numpy_mmap, 'TOPK_CHUNK_SIZE', 7)
+  rng = np.random.default_rng(42)
+  embeddings = rng.standard_normal((100, 8)).astype(np.float32)
+  keys: list[VectorKey] = [(f'row{i}', 0) for i in range(100)]
+  query = rng.standard_normal(8).astype(np.float32)
+
+  expected_store = NumpyVectorStore()
+  expected_store.add(keys, embeddings)
+  store = NumpyMmapVectorStore()
+  store.add(keys, embeddings)
+  store.save(str(tmp_path / 'store'))
+  store = NumpyMmapVectorStore()
+  store.load(str(tmp_path / 'store'))
+
+  assert store.topk(query, 10) == expected_store.topk(query, 10)
+  restricted_keys = keys[::3]
+  assert store.topk(query, 10, restricted_keys) == expected_store.topk(query, 10, restricted_keys)
+
+
+def test_add_keeps_the_matrix_mapped(tmp_path: pathlib.Path) -> None:
+  base_path = str(tmp_path / 'store')
+  store = NumpyMmapVectorStore()
+  store.add([('a',), ('b',)], np.array([[1.0, 0.0], [0.0, 1.0]]))
+  store.save(base_path)
+  store = NumpyMmapVectorStore()
+  store.load(base_path)
+  store.add([('c',)], np.array([[0.5, 0.75]]))
+  store.add([('b',)], np.array([[0.0, 2.0]]))
+
+  # The added rows are scanned as segments next to the mapped matrix.
+  assert [key for key, _ in store.topk(np.array([0.0, 1.0]), k=3)] == [('b',), ('c',), ('a',)]
+  assert store.topk_batch(np.array([[1.0, 0.0]]), k=1)[0][0][0] == ('a',)
+  np.testing.assert_array_equal(store.get([('c',), ('b',)]), np.array([[0.5, 0.75], [0.0, 2.0]]))
+  assert isinstance(store._matrix, np.memmap)
+
+  # Saving writes the live rows, and maps the written file.
+  store.save(base_path)
+  assert isinstance(store._matrix, np.memmap)
+  np.testing.assert_array_equal(store.get(), np.array([[1.0, 0.0], [0.5, 0.75], [0.0, 2.0]]))
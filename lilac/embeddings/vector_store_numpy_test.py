@@ -0,0 +1,107 @@
+"""Tests for the numpy vector store."""
+
+import os
+import pathlib
+
+import numpy as np
+import pytest
+from pytest_mock import MockerFixture
+
+from . import vector_store_numpy
+from .vector_store_numpy import NumpyVectorStore
+
+
+def test_save_writes_delta_segments(tmp_path: pathlib.Path) -> None:
+  base_path = str(tmp_path / 'store')
+  store = NumpyVectorStore()
+  store.add([('a',), ('b',)], np.array([[1.0, 0.0], [0.0, 1.0]]))
+  store.save(base_path)
+  matrix_mtime = os.stat(base_path + '.matrix.npy').st_mtime_ns
+
+  store = NumpyVectorStore()
+  store.load(base_path)
+  store.add([('c',)], np.array([[0.5, 0.25]]))
+  store.save(base_path)
+  store.add([('d',)], np.array([[0.25, 0.5]]))
+  store.save(base_path)
+
+  # Only the new rows are written.
+  assert os.stat(base_path + '.matrix.npy').st_mtime_ns == matrix_mtime
+  np.testing.assert_array_equal(np.load(base_path + '.delta.0.npy'), np.array([[0.5, 0.25]]))
+  np.testing.assert_array_equal(np.load(base_path + '.delta.1.npy'), np.array([[0.25, 0.5]]))
+
+  store = NumpyVectorStore()
+  store.load(base_path)
+  np.testing.assert_array_equal(store.get(),
+                                np.array([[1.0, 0.0], [0.0, 1.0], [0.5, 0.25], [0.25, 0.5]]))
+
+
+def test_save_compacts(tmp_path: pathlib.Path, mocker: MockerFixture) -> None:
+  mocker.patch.object(vector_store_numpy, 'MAX_DELTA_SEGMENTS', 2)
+  base_path = str(tmp_path / 'store')
+  store = NumpyVectorStore()
+  store.add([('a',)], np.array([[1.0, 0.0]]))
+  store.save(base_path)
+  for i in range(3):
+    store.add([(f'new{i}',)], np.array([[0.0, float(i)]]))
+    store.save(base_path)
+
+  # The third save has too many delta segments, and rewrites the matrix.
+  assert not list(tmp_path.glob('store.delta.*'))
+  assert np.load(base_path + '.matrix.npy').shape == (4, 2)
+
+  # Deleting more than a quarter of the rows compacts the next save.
+  store.delete([('a',), ('new0',)])
+  store.add([('a',)], np.array([[0.5, 0.5]]))
+  store.save(base_path)
+  np.testing.assert_array_equal(
+    np.load(base_path + '.matrix.npy'), np.array([[0.0, 1.0], [0.0, 2.0], [0.5, 0.5]]))
+
+  store = NumpyVectorStore()
+  store.load(base_path)
+  np.testing.assert_array_equal(store.get([('a',), ('new2',)]), np.array([[0.5, 0.5], [0.0, 2.0]]))
+
+
+def test_add_concatenates_lazily(tmp_path: pathlib.Path) -> None:
+  base_path = str(tmp_path / 'store')
+  store = NumpyVectorStore()
+  store.add([('a',)], np.array([[1.0, 0.0]]))
+  store.save(base_path)
+  for i in range(3):
+    store.add([(f'new{i}',)], np.array([[0.0, float(i)]]))
+  assert store.size() == 4
+
+  # Saving writes the appended rows without growing the matrix.
+  store.save(base_path)
+  assert store._matrix is not None and len(store._matrix) == 1
+  np.testing.assert_array_equal(
+    np.load(base_path + '.delta.0.npy'), np.array([[0.0, 0.0], [0.0, 1.0], [0.0, 2.0]]))
+
+  # The first scan concatenates the appended rows.
+  assert store.topk(np.array([0.0, 1.0]), k=1)[0][0] == ('new2',)
+  assert len(store._matrix) == 4
+  assert store.topk(np.array([1.0, 0.0]), k=1)[0][0] == ('a',)
+
+
+def test_compaction_keeps_the_delta_segments_until_the_key_index_is_written(
+    tmp_path: pathlib.Path, mocker: MockerFixture) -> None:
+  base_path = str(tmp_path / 'store')
+  store = NumpyVectorStore()
+  store.add([('a',), ('b',)], np.array([[1.0, 0.0], [0.0, 1.0]]))
+  store.save(base_path)
+  store.add([('c',)], np.array([[0.5, 0.5]]))
+  store.save(base_path)
+
+  # The process dies while removing the delta segments of a compacting save.
+  store.delete([('a',)])
+  mocker.patch.object(vector_store_numpy.os, 'remove', side_effect=KeyboardInterrupt)
+  with pytest.raises(KeyboardInterrupt):
+    store.save(base_path)
+  mocker.stopall()
+
+  # The stale delta segment is loaded as dead rows.
+  store = NumpyVectorStore()
+  store.load(base_path)
+  assert store.size() == 2
+  np.testing.assert_array_equal(store.get([('b',), ('c',)]), np.array([[0.0, 1.0], [0.5, 0.5]]))
+  assert [key for key, _ in store.topk(np.array([1.0, 1.0]), k=3)] == [('c',), ('b',)]
@@ -0,0 +1,172 @@
+"""Vector stores that scan scalar-quantized codes and re-rank with the exact vectors."""
+
+from typing import Iterable, Iterator, Optional
+
+import numpy as np
+from typing_extensions import override
+
+from ..schema import VectorKey
+from .vector_key_index import save_array
+from .vector_store_numpy_mmap import TOPK_CHUNK_SIZE, NumpyMmapVectorStore, chunked_topk
+
+_CODES_SUFFIX = '.codes.npy'
+_QUANTIZER_SUFFIX = '.quantizer.npz'
+
+# The number of candidates from the quantized scan that are re-ranked, as a multiple of k.
+RERANK_MULTIPLIER = 4
+
+
+class QuantizedVectorStore(NumpyMmapVectorStore):
+  """Stores vectors as quantized codes in memory, and the exact vectors memory-mapped from disk.
+
+  `topk` scans the codes, which take 2-4x less memory than float32, and re-ranks the best
+  candidates with exact float32 dot products. The exact vectors are the same files as the
+  `numpy_mmap` store, so only the rows of the candidates are read from disk.
+
+  Added rows are encoded with the current quantizer, which is only refit to the live rows when a
+  save compacts the store.
+  """
+  # The numpy dtype of the codes.
+  code_dtype: type[np.generic]
+  # Scores from the codes are approximate, so batched and grouped searches use `topk`.
+  exact_scan = False
+
+  def __init__(self) -> None:
+    super().__init__()
+    # The codes of the rows, in blocks that are concatenated when they are first scanned.
+    self._code_blocks: list[np.ndarray] = []
+    # Maps codes back to vectors with `codes * scale + offset`, per dimension.
+    self._scale: Optional[np.ndarray] = None
+    self._offset: Optional[np.ndarray] = None
+
+  @override
+  def save(self, base_path: str) -> None:
+    super().save(base_path)
+    assert self._scale is not None and self._offset is not None
+    save_array(base_path + _CODES_SUFFIX, self._codes())
+    np.savez(base_path + _QUANTIZER_SUFFIX, scale=self._scale, offset=self._offset)
+
+  @override
+  def load(self, base_path: str) -> None:
+    super().load(base_path)
+    self._code_blocks = [np.load(base_path + _CODES_SUFFIX, allow_pickle=False)]
+    with np.load(base_path + _QUANTIZER_SUFFIX, allow_pickle=False) as quantizer:
+      self._scale = quantizer['scale']
+      self._offset = quantizer['offset']
+
+  @override
+  def add(self, keys: list[VectorKey], embeddings: np.ndarray) -> None:
+    super().add(keys, embeddings)
+    embeddings = embeddings.astype(np.float32)
+    if self._scale is None or self._offset is None:
+      self._scale, self._offset = self._fit(embeddings.shape[1], [embeddings])
+    # Only the new rows are encoded.
+    self._code_blocks.append(self._encode(embeddings))
+
+  @override
+  def _take_rows(self, rows: np.ndarray) -> None:
+    super()._take_rows(rows)
+    assert self._matrix is not None
+    dim = self._matrix.shape[1]
+    if len(rows):
+      # The quantizer is refit to the live rows, which are read a chunk at a time.
+      self._scale, self._offset = self._fit(dim, self._row_chunks(rows))
+    code_chunks = [self._encode(chunk) for chunk in self._row_chunks(rows)]
+    self._code_blocks = [
+      np.concatenate(code_chunks) if code_chunks else np.empty((0, dim), dtype=self.code_dtype)
+    ]
+
+  def _row_chunks(self, rows: np.ndarray) -> Iterator[np.ndarray]:
+    """Yield the given rows, TOPK_CHUNK_SIZE at a time."""
+    for start in range(0, len(rows), TOPK_CHUNK_SIZE):
+      yield self._gather(rows[start:start + TOPK_CHUNK_SIZE])
+
+  def _codes(self) -> np.ndarray:
+    """The codes of every row, dead or alive."""
+    if len(self._code_blocks) > 1:
+      self._code_blocks = [np.concatenate(self._code_blocks)]
+    return self._code_blocks[0]
+
+  def _fit(self, dim: int, chunks: Iterable[np.ndarray]) -> tuple[np.ndarray, np.ndarray]:
+    """Return the scale and offset that map the codes of the embeddings back to them."""
+    return np.ones(dim, dtype=np.float32), np.zeros(dim, dtype=np.float32)
+
+  def _encode(self, embeddings: np.ndarray) -> np.ndarray:
+    """Return the codes of the embeddings."""
+    return embeddings.astype(self.code_dtype)
+
+  @override
+  def topk(self,
+           query: np.ndarray,
+           k: int,
+           keys: Optional[Iterable[VectorKey]] = None) -> list[tuple[VectorKey, float]]:
+    assert self._matrix is not None and self._key_index is not None, (
+      'The vector store has no embeddings. Call load() or add() first.')
+    assert self._scale is not None and self._offset is not None
+    codes = self._codes()
+    if keys is not None:
+      keys = list(keys)
+      row_indices = self._key_index.lookup(keys)
+    elif self._has_dead_rows():
+      row_indices = self._key_index.values
+    else:
+      row_indices = np.arange(len(codes))
+    k = min(k, len(row_indices))
+    if k <= 0:
+      return []
+
+    query = query.astype(np.float32)
+    # The dot product with the dequantized codes is `codes . (query * scale) + query . offset`.
+    code_query = query * self._scale
+    query_offset = np.dot(query, self._offset)
+
+    def score_rows(start: int, end: int) -> np.ndarray:
+      chunk = codes.take(row_indices[start:end], axis=0).astype(np.float32)
+      return np.dot(chunk, code_query).reshape(-1) + query_offset
+
+    num_candidates = min(k * RERANK_MULTIPLIER, len(row_indices))
+    candidates, _ = chunked_topk(score_rows, len(row_indices), num_candidates)
+
+    # Re-rank with the exact vectors. Reading rows in order is faster from a memory-mapped file.
+    candidate_rows = row_indices[candidates]
+    order = np.argsort(candidate_rows)
+    exact = np.empty(len(candidates), dtype=np.float32)
+    exact[order] = np.dot(self._gather(candidate_rows[order]), query).reshape(-1)
+    best = np.argsort(exact)[::-1][:k]
+
+    if keys is not None:
+      topk_keys = [keys[position] for position in candidates[best]]
+    else:
+      topk_keys = self._key_index.keys(candidates[best])
+    return list(zip(topk_keys, exact[best]))
+
+
+class Float16VectorStore(QuantizedVectorStore):
+  """Scans float16 codes, with 2x less memory than float32."""
+  name = 'numpy_float16'
+  code_dtype = np.float16
+
+
+class Int8VectorStore(QuantizedVectorStore):
+  """Scans int8 codes with a per-dimension scale and offset, with 4x less memory than float32."""
+  name = 'numpy_int8'
+  code_dtype = np.int8
+
+  @override
+  def _fit(self, dim: int, chunks: Iterable[np.ndarray]) -> tuple[np.ndarray, np.ndarray]:
+    min_vals = np.full(dim, np.inf, dtype=np.float32)
+    max_vals = np.full(dim, -np.inf, dtype=np.float32)
+    for chunk in chunks:
+      np.minimum(min_vals, chunk.min(axis=0), out=min_vals)
+      np.maximum(max_vals, chunk.max(axis=0), out=max_vals)
+    # Map [min, max] of each dimension to the 256 int8 values.
+    scale = (max_vals - min_vals) / 255
+    scale[scale == 0] = 1
+    offset = min_vals + 128 * scale
+    return scale.astype(np.float32), offset.astype(np.float32)
+
+  @override
+  def _encode(self, embeddings: np.ndarray) -> np.ndarray:
+    # Rows added after the quantizer was fit may be out of its range, and are clipped.
+    codes = np.round((embeddings - self._offset) / self._scale)
+    return np.clip(codes, -128, 127).astype(np.int8)
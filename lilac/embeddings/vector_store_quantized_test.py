@@ -0,0 +1,77 @@
+"""Tests for the quantized vector stores."""
+
+import pathlib
+from typing import Type
+
+import numpy as np
+import pytest
+from sklearn.preprocessing import normalize
+
+from ..schema import VectorKey
+from .vector_store_numpy import NumpyVectorStore
+from .vector_store_quantized import Float16VectorStore, Int8VectorStore, QuantizedVectorStore
+
+
+@pytest.mark.parametrize('store_cls', [Float16VectorStore, Int8VectorStore])
+def test_recall_against_numpy(tmp_path: pathlib.Path,
+                              store_cls: Type[QuantizedVectorStore]) -> None:
+  rng = np.random.default_rng(42)
+  embeddings = normalize(rng.standard_normal((2000, 32))).astype(np.float32)
+  keys: list[VectorKey] = [(f'row{i}', 0) for i in range(len(embeddings))]
+  queries = normalize(rng.standard_normal((20, 32))).astype(np.float32)
+
+  numpy_store = NumpyVectorStore()
+  numpy_store.add(keys, embeddings)
+  store = store_cls()
+  store.add(keys, embeddings)
+  store.save(str(tmp_path / 'store'))
+  store = store_cls()
+  store.load(str(tmp_path / 'store'))
+
+  num_hits = 0
+  for query in queries:
+    expected = numpy_store.topk(query, 10)
+    result = store.topk(query, 10)
+    num_hits += len({key for key, _ in expected} & {key for key, _ in result})
+    # The scores are re-ranked with the exact vectors.
+    expected_scores = {key: score for key, score in expected}
+    for key, score in result:
+      if key in expected_scores:
+        assert score == pytest.approx(expected_scores[key], abs=1e-6)
+  assert num_hits / (10 * len(queries)) >= 0.95
+
+
+def test_int8_codes(tmp_path: pathlib.Path) -> None:
+  store = Int8VectorStore()
+  store.add([('a',), ('b',), ('c',)], np.array([[1.0, -2.0], [3.0, 0.0], [5.0, 2.0]]))
+  store.save(str(tmp_path / 'store'))
+
+  codes = np.load(str(tmp_path / 'store') + '.codes.npy')
+  assert codes.dtype == np.int8
+  assert codes.min() == -128 and codes.max() == 127
+  # The exact vectors are returned by `get`.
+  np.testing.assert_array_equal(store.get([('b',)]), np.array([[3.0, 0.0]]))
+
+
+def test_add_encodes_only_the_new_rows(tmp_path: pathlib.Path) -> None:
+  base_path = str(tmp_path / 'store')
+  store = Int8VectorStore()
+  store.add([('a',), ('b',), ('c',)], np.array([[1.0, -2.0], [3.0, 0.0], [5.0, 2.0]]))
+  store.save(base_path)
+  store = Int8VectorStore()
+  store.load(base_path)
+  scale = store._scale
+
+  store.add([('d',)], np.array([[4.0, 1.0]]))
+  assert [key for key, _ in store.topk(np.array([1.0, 0.0]), k=2)] == [('c',), ('d',)]
+  # The stored quantizer encodes the new row, and the mapped matrix is not read into memory.
+  assert store._scale is scale
+  assert isinstance(store._matrix, np.memmap)
+
+  # A compacting save refits the quantizer to the live rows.
+  store.delete([('c',)])
+  store.save(base_path)
+  np.testing.assert_allclose(store._scale, np.array([3.0, 3.0]) / 255)
+  store = Int8VectorStore()
+  store.load(base_path)
+  assert [key for key, _ in store.topk(np.array([1.0, 0.0]), k=3)] == [('d',), ('b',), ('a',)]
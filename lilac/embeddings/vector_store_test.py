@@ -1,16 +1,24 @@
 """Tests the vector store interface."""
 
+import pathlib
 from typing import Type, cast
 
 import numpy as np
 import pytest
+from pytest_mock import MockerFixture
 from sklearn.preprocessing import normalize
 
-from .vector_store import VectorStore
+from .vector_store import VectorDBIndex, VectorStore
 from .vector_store_hnsw import HNSWVectorStore
+from .vector_store_ivfpq import IVFPQVectorStore
 from .vector_store_numpy import NumpyVectorStore
+from .vector_store_numpy_mmap import NumpyMmapVectorStore
+from .vector_store_quantized import Float16VectorStore, Int8VectorStore
 
-ALL_STORES = [NumpyVectorStore, HNSWVectorStore]
+ALL_STORES = [
+  NumpyVectorStore, HNSWVectorStore, NumpyMmapVectorStore, Float16VectorStore, Int8VectorStore,
+  IVFPQVectorStore
+]
 
 
 @pytest.mark.parametrize('store_cls', ALL_STORES)
@@ -70,3 +78,145 @@ class VectorStoreSuite:
 
     result = store.topk(query, k=10, keys=[('b', 0), ('a', 1), ('a', 0)])
     assert result == [(('a', 1), 9.0), (('a', 0), 8.0), (('b', 0), 3.0)]
+
+  def test_topk_groups(self, store_cls: Type[VectorStore]) -> None:
+    store = store_cls()
+    embedding = normalize(np.array([[1, 0], [1, 0.1], [1, 0.2], [0.5, 1], [0, 1], [1, 1]]))
+    store.add([('a', 0, 0), ('a', 0, 1), ('a', 0, 2), ('b', 0, 0), ('b', 1, 0), ('c', 0, 0)],
+              cast(np.ndarray, embedding))
+    query = np.array([1, 0])
+
+    result = store.topk_groups(query, 2)
+    assert [key for key, _ in result] == [('a', 0), ('c', 0)]
+    assert [score for _, score in result] == pytest.approx([1, 0.707], abs=1e-3)
+
+    result = store.topk_groups(query, 10, keys=[('a', 0, 2), ('b', 0, 0), ('b', 1, 0)])
+    assert [key for key, _ in result] == [('a', 0), ('b', 0), ('b', 1)]
+    assert [score for _, score in result] == pytest.approx([0.981, 0.447, 0], abs=1e-3)
+
+  def test_topk_batch(self, store_cls: Type[VectorStore]) -> None:
+    store = store_cls()
+    embedding = cast(np.ndarray, normalize(np.array([[1, 0], [0, 1], [1, 1], [1, 0.5]])))
+    store.add([('a', 0), ('a', 1), ('b', 0), ('c', 0)], embedding)
+    queries = cast(np.ndarray, normalize(np.array([[0.9, 1], [1, 0], [0, 1]])))
+
+    assert store.topk_batch(queries, 2) == [store.topk(query, 2) for query in queries]
+    keys = [('a', 0), ('c', 0)]
+    assert store.topk_batch(queries, 1, keys) == [store.topk(query, 1, keys) for query in queries]
+    groups = [store.topk_groups(query, 2) for query in queries]
+    assert store.topk_groups_batch(queries, 2) == groups
+
+  def test_upsert(self, store_cls: Type[VectorStore]) -> None:
+    store = store_cls()
+    store.add([('a',), ('b',)], np.array([[1, 0], [0, 1]]))
+    store.add([('b',), ('c',)], np.array([[0.6, 0.8], [0.8, 0.6]]))
+
+    assert store.size() == 3
+    np.testing.assert_allclose(
+      store.get([('a',), ('b',), ('c',)]), np.array([[1, 0], [0.6, 0.8], [0.8, 0.6]]))
+    result = store.topk(np.array([0, 1]), 3)
+    assert [key for key, _ in result] == [('b',), ('c',), ('a',)]
+    assert [score for _, score in result] == pytest.approx([0.8, 0.6, 0], abs=1e-6)
+
+  def test_delete(self, store_cls: Type[VectorStore]) -> None:
+    store = store_cls()
+    store.add([('a',), ('b',), ('c',)], np.array([[1, 0], [0, 1], [0.6, 0.8]]))
+    store.delete([('b',), ('d',)])
+
+    assert store.size() == 2
+    np.testing.assert_allclose(store.get(), np.array([[1, 0], [0.6, 0.8]]))
+    result = store.topk(np.array([0, 1]), 3)
+    assert [key for key, _ in result] == [('c',), ('a',)]
+
+  def test_add_to_loaded_store(self, store_cls: Type[VectorStore], tmp_path: pathlib.Path) -> None:
+    base_path = str(tmp_path / 'store')
+    store = store_cls()
+    store.add([('a',), ('b',)], np.array([[1, 0], [0, 1]]))
+    store.save(base_path)
+
+    for i in range(3):
+      store = store_cls()
+      store.load(base_path)
+      store.add([(f'new{i}',), ('b',)], np.array([[0.6, 0.8], [0.8, 0.6]]))
+      store.delete([('a',)])
+      store.save(base_path)
+
+    store = store_cls()
+    store.load(base_path)
+    assert store.size() == 4
+    np.testing.assert_allclose(
+      store.get([('new0',), ('new2',), ('b',)]), np.array([[0.6, 0.8], [0.6, 0.8], [0.8, 0.6]]))
+    result = store.topk(np.array([1, 0]), 1)
+    assert [key for key, _ in result] == [('b',)]
+
+
+def test_vector_db_index_upsert_and_delete() -> None:
+  vector_index = VectorDBIndex('numpy')
+  vector_index.add([(('1',), [(0, 1), (1, 2)]), (('2',), [(0, 1)])],
+                   np.array([[1, 0], [0, 1], [0.6, 0.8]]))
+  # Replacing a path key with fewer spans deletes its old span vectors.
+  vector_index.add([(('1',), [(0, 2)]), (('3',), [(0, 3)])], np.array([[0.8, 0.6], [0, 1]]))
+  vector_index.delete([('2',)])
+
+  assert sorted(vector_index.path_keys()) == [('1',), ('3',)]
+  assert vector_index.get_vector_store().size() == 2
+  [spans] = list(vector_index.get([('1',)]))
+  assert spans[0]['span'] == (0, 2)
+  np.testing.assert_allclose(spans[0]['vector'], [0.8, 0.6])
+  assert [key for key, _ in vector_index.topk(np.array([1, 0]), 3)] == [('1',), ('3',)]
+
+
+def test_vector_db_index_save_and_load(tmp_path: pathlib.Path) -> None:
+  vector_index = VectorDBIndex('numpy')
+  vector_index.add([(('1',), [(0, 1), (1, 2)]), (('2',), [(0, 1)])],
+                   np.array([[1, 0], [0, 1], [0.6, 0.8]]))
+  vector_index.add([(('1',), [(0, 2)])], np.array([[0.8, 0.6]]))
+  vector_index.save(str(tmp_path))
+
+  loaded_index = VectorDBIndex('numpy')
+  loaded_index.load(str(tmp_path))
+
+  assert sorted(loaded_index.path_keys()) == [('1',), ('2',)]
+  spans = list(loaded_index.get([('2',), ('1',), ('4',)]))
+  assert [[span['span'] for span in path_spans] for path_spans in spans] == [[(0, 1)], [(0, 2)], []]
+  np.testing.assert_allclose(spans[0][0]['vector'], [0.6, 0.8])
+  assert [key for key, _ in loaded_index.topk(np.array([1, 0]), 1, [('2',)])] == [('2',)]
+
+  # Saving the loaded index again overwrites the files it reads from.
+  loaded_index.add([(('3',), [(0, 3)])], np.array([[0, 1]]))
+  loaded_index.save(str(tmp_path))
+  reloaded_index = VectorDBIndex('numpy')
+  reloaded_index.load(str(tmp_path))
+  assert sorted(reloaded_index.path_keys()) == [('1',), ('2',), ('3',)]
+
+
+def test_vector_db_index_get_gathers_once(mocker: MockerFixture) -> None:
+  vector_index = VectorDBIndex('numpy')
+  vector_index.add([(('1',), [(0, 1), (1, 2)]), (('2',), [(0, 1)])],
+                   np.array([[1, 0], [0, 1], [0.6, 0.8]]))
+  get_spy = mocker.spy(vector_index.get_vector_store(), 'get')
+
+  spans = list(vector_index.get([('2',), ('3',), ('1',)]))
+
+  assert get_spy.call_count == 1
+  span_offsets = [[span['span'] for span in path_spans] for path_spans in spans]
+  assert span_offsets == [[(0, 1)], [], [(0, 1), (1, 2)]]
+  np.testing.assert_allclose([span['vector'] for span in spans[2]], [[1, 0], [0, 1]])
+
+
+@pytest.mark.parametrize('vector_store_name', ['numpy', 'hnsw'])
+@pytest.mark.parametrize('exact', [True, False])
+def test_vector_db_index_filtered_topk(vector_store_name: str, exact: bool,
+                                       mocker: MockerFixture) -> None:
+  vector_index = VectorDBIndex(vector_store_name)
+  if not exact:
+    mocker.patch.object(vector_index.get_vector_store(), 'exact_search_max_spans', 0)
+  vector_index.add([(('1',), [(0, 1), (1, 2)]), (('2',), [(0, 1)]), (('3',), [(0, 1)]),
+                    (('4',), [])], np.array([[1, 0], [0, 1], [0.6, 0.8], [0.8, 0.6]]))
+  topk_spy = mocker.spy(vector_index.get_vector_store(), 'topk_groups_batch')
+
+  topk = vector_index.topk(np.array([0, 1]), 2, [('1',), ('2',), ('4',)])
+
+  assert [key for key, _ in topk] == [('1',), ('2',)]
+  np.testing.assert_allclose([score for _, score in topk], [1, 0.8], atol=1e-6)
+  assert topk_spy.call_count == (0 if exact else 1)
@@ -43,6 +43,24 @@ class LilacEnvironment(BaseModel):
     description='Whether DuckDB uses views (1), or DuckDB tables (0). Views allow for much less '
     'RAM consumption, with a runtime query penalty. When using DuckDB tables (0), demos will '
     'take more RAM but be much faster during query time.')
+  DUCKDB_PERSIST: str = PydanticField(
+    description='Whether DuckDB persists the joined dataset table to a database file inside the '
+    'dataset directory (1), or rebuilds it in memory every time a dataset is opened (0). The '
+    'persisted table is reused across server restarts and only rebuilt when signals change.')
+
+  # Vector indices.
+  VECTOR_INDEX_CACHE_GB: str = PydanticField(
+    description='The memory budget, in GB, of the vector indices that the server keeps loaded. '
+    'The least recently used indices are evicted when the budget is exceeded. Defaults to 4.')
+
+  # Embeddings.
+  EMBEDDING_CACHE_GB: str = PydanticField(
+    description='The disk budget, in GB, of the cache of computed embeddings, which is shared by '
+    'all datasets and concepts in the data path. The oldest embeddings are evicted when the '
+    'budget is exceeded. Set to 0 to disable the cache. Defaults to 10.')
+  MODEL_CACHE_GB: str = PydanticField(
+    description='The memory budget, in GB, of the on-device embedding models that are kept loaded. '
+    'The least recently used models are unloaded when the budget is exceeded. Defaults to 4.')
 
   # Authentication.
   LILAC_AUTH_ENABLED: str = PydanticField(
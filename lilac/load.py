@@ -17,7 +17,7 @@ import psutil
 from distributed import Client
 
 from .concepts.db_concept import DiskConceptDB, DiskConceptModelDB
-from .config import EmbeddingConfig, SignalConfig, read_config
+from .config import EmbeddingConfig, SignalConfig, get_dataset_embeddings, read_config
 from .data.dataset_duckdb import DatasetDuckDB
 from .data_loader import process_source
 from .db_manager import get_dataset, list_datasets, remove_dataset_from_cache
@@ -121,16 +121,9 @@ def load(output_dir: str,
     for d in config.datasets:
       dataset = DatasetDuckDB(d.namespace, d.name)
 
-      # If embeddings are explicitly set, use only those.
-      embeddings = d.embeddings or []
       # If embeddings are not explicitly set, use the media paths and preferred embedding from
       # settings.
-      if not embeddings:
-        if d.settings and d.settings.ui:
-          for path in d.settings.ui.media_paths or []:
-            if d.settings.preferred_embedding:
-              embeddings.append(
-                EmbeddingConfig(path=path, embedding=d.settings.preferred_embedding))
+      embeddings = get_dataset_embeddings(d)
       for e in embeddings:
         if e not in dataset.config().embeddings:
           print('scheduling', e)
@@ -1,5 +1,5 @@
 """A Parquet file writer that wraps the pyarrow writer."""
-from typing import IO, Optional
+from typing import IO, Callable, Optional
 
 import pyarrow as pa
 import pyarrow.parquet as pq
@@ -14,7 +14,8 @@ class ParquetWriter:
                schema: Schema,
                codec: str = 'snappy',
                row_group_buffer_size: int = 128 * 1024 * 1024,
-               record_batch_size: int = 10_000):
+               record_batch_size: int = 10_000,
+               on_record_batch: Optional[Callable[[pa.RecordBatch], None]] = None):
     self._schema = schema_to_arrow_schema(schema)
     self._codec = codec
     self._row_group_buffer_size = row_group_buffer_size
@@ -23,6 +24,8 @@ class ParquetWriter:
     self._record_batches: list[pa.RecordBatch] = []
     self._record_batches_byte_size = 0
     self.writer: pq.ParquetWriter = None
+    # Called with every record batch before it is written.
+    self._on_record_batch = on_record_batch
 
   def open(self, file_handle: IO) -> None:
     """Open the destination file for writing."""
@@ -61,6 +64,8 @@ class ParquetWriter:
       arrays[x] = pa.array(y, type=self._schema.types[x])
       self._buffer[x] = []
     rb = pa.RecordBatch.from_arrays(arrays, schema=self._schema)
+    if self._on_record_batch:
+      self._on_record_batch(rb)
     self._record_batches.append(rb)
     size = 0
     for x in arrays:
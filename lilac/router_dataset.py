@@ -2,9 +2,12 @@
 from typing import Annotated, Literal, Optional, Sequence, Union, cast
 from urllib.parse import unquote
 
+import pandas as pd
+import pyarrow as pa
 from fastapi import APIRouter, HTTPException, Response
 from fastapi.params import Depends
 from fastapi.responses import ORJSONResponse
+from pandas.api.types import is_datetime64_any_dtype
 from pydantic import BaseModel, validator
 
 from .auth import UserInfo, get_session_user, get_user_access
@@ -18,6 +21,7 @@ from .data.dataset import (
   ListOp,
   Search,
   SelectGroupsResult,
+  SelectRowsResult,
   SelectRowsSchemaResult,
   SortOrder,
   StatsResult,
@@ -189,6 +193,8 @@ class SelectRowsOptions(BaseModel):
   sort_order: Optional[SortOrder] = SortOrder.DESC
   limit: Optional[int] = None
   offset: Optional[int] = None
+  # The `next_cursor` of the previous page. When defined, `offset` is ignored.
+  cursor: Optional[str] = None
   combine_columns: Optional[bool] = None
 
 
@@ -205,6 +211,8 @@ class SelectRowsResponse(BaseModel):
   """The response for the select rows endpoint."""
   rows: list[dict]
   total_num_rows: int
+  # The cursor of the next page, or None when this is the last page.
+  next_cursor: Optional[str] = None
 
 
 @router.get('/{namespace}/{dataset_name}/select_rows_download', response_model=None)
@@ -221,24 +229,102 @@ def select_rows(
     namespace: str, dataset_name: str, options: SelectRowsOptions,
     user: Annotated[Optional[UserInfo], Depends(get_session_user)]) -> SelectRowsResponse:
   """Select rows from the dataset database."""
-  dataset = get_dataset(namespace, dataset_name)
+  res = _select_rows(namespace, dataset_name, options, user)
+  return SelectRowsResponse(
+    rows=list(res), total_num_rows=res.total_num_rows, next_cursor=res.next_cursor)
 
-  sanitized_filters = [
-    PyFilter(path=normalize_path(f.path), op=f.op, value=f.value) for f in (options.filters or [])
-  ]
 
-  res = dataset.select_rows(
+class SelectRowsColumnarResponse(BaseModel):
+  """The response for the columnar select rows endpoint."""
+  # Maps a column name to its values, one per row.
+  columns: dict[str, list]
+  total_num_rows: int
+  next_cursor: Optional[str] = None
+
+
+@router.post('/{namespace}/{dataset_name}/select_rows_columnar')
+def select_rows_columnar(
+    namespace: str, dataset_name: str, options: SelectRowsOptions,
+    user: Annotated[Optional[UserInfo], Depends(get_session_user)]) -> SelectRowsColumnarResponse:
+  """Select rows from the dataset database, returned column by column."""
+  res = _select_rows(namespace, dataset_name, options, user)
+  df = res.df()
+  columns = {str(name): _column_values(df[name]) for name in df.columns}
+  # Serialize the columns directly to skip validating and encoding every value.
+  return cast(
+    SelectRowsColumnarResponse,
+    ORJSONResponse({
+      'columns': columns,
+      'total_num_rows': res.total_num_rows,
+      'next_cursor': res.next_cursor
+    }))
+
+
+ARROW_STREAM_MEDIA_TYPE = 'application/vnd.apache.arrow.stream'
+
+
+@router.post(
+  '/{namespace}/{dataset_name}/select_rows_arrow',
+  response_class=Response,
+  responses={200: {
+    'content': {
+      ARROW_STREAM_MEDIA_TYPE: {}
+    }
+  }})
+def select_rows_arrow(namespace: str, dataset_name: str, options: SelectRowsOptions,
+                      user: Annotated[Optional[UserInfo],
+                                      Depends(get_session_user)]) -> Response:
+  """Select rows from the dataset database, returned as an Arrow IPC stream.
+
+  The total number of rows is stored in the `total_num_rows` key of the schema metadata, and the
+  cursor of the next page in the `next_cursor` key.
+  """
+  res = get_dataset(namespace, dataset_name).select_rows_arrow(
+    columns=options.columns,
+    searches=options.searches or [],
+    filters=_sanitize_filters(options.filters),
+    sort_by=options.sort_by,
+    sort_order=options.sort_order,
+    limit=options.limit,
+    offset=options.offset,
+    cursor=options.cursor,
+    combine_columns=options.combine_columns or False,
+    user=user)
+  metadata = {'total_num_rows': str(res.total_num_rows)}
+  if res.next_cursor:
+    metadata['next_cursor'] = res.next_cursor
+  table = res.table.replace_schema_metadata(metadata)
+  sink = pa.BufferOutputStream()
+  with pa.ipc.new_stream(sink, table.schema) as writer:
+    writer.write_table(table)
+  return Response(content=sink.getvalue().to_pybytes(), media_type=ARROW_STREAM_MEDIA_TYPE)
+
+
+def _column_values(series: pd.Series) -> list:
+  if is_datetime64_any_dtype(series):
+    # Timestamps are converted to native datetimes so they can be serialized.
+    return [None if pd.isnull(val) else val.to_pydatetime() for val in series]
+  return series.tolist()
+
+
+def _select_rows(namespace: str, dataset_name: str, options: SelectRowsOptions,
+                 user: Optional[UserInfo]) -> SelectRowsResult:
+  dataset = get_dataset(namespace, dataset_name)
+  return dataset.select_rows(
     columns=options.columns,
     searches=options.searches or [],
-    filters=sanitized_filters,
+    filters=_sanitize_filters(options.filters),
     sort_by=options.sort_by,
     sort_order=options.sort_order,
     limit=options.limit,
     offset=options.offset,
+    cursor=options.cursor,
     combine_columns=options.combine_columns or False,
     user=user)
 
-  return SelectRowsResponse(rows=list(res), total_num_rows=res.total_num_rows)
+
+def _sanitize_filters(filters: Optional[Sequence[Filter]]) -> list[PyFilter]:
+  return [PyFilter(path=normalize_path(f.path), op=f.op, value=f.value) for f in (filters or [])]
 
 
 @router.post('/{namespace}/{dataset_name}/select_rows_schema', response_model_exclude_none=True)
@@ -33,9 +33,10 @@ from .auth import (
   get_session_user,
   get_user_access,
 )
+from .db_manager import preload_embeddings
 from .env import data_path, env
 from .load import load
-from .project import PROJECT_CONFIG_FILENAME, create_project_and_set_env
+from .project import PROJECT_CONFIG_FILENAME, create_project_and_set_env, read_project_config
 from .router_utils import RouteErrorHandler
 from .sources.default_sources import register_default_sources
 from .sources.source_registry import registered_sources
@@ -213,7 +214,8 @@ def start_server(host: str = '127.0.0.1',
                  port: int = 5432,
                  open: bool = False,
                  project_path: str = '',
-                 skip_load: bool = False) -> None:
+                 skip_load: bool = False,
+                 preload: bool = True) -> None:
   """Starts the Lilac web server.
 
   Args:
@@ -223,6 +225,8 @@ def start_server(host: str = '127.0.0.1',
     project_path: The path to the Lilac project path. If not specified, the LILAC_DATA_PATH
       will be used. If LILAC_DATA_PATH is not defined, will start in the current directory.
     skip_load: Whether to skip loading from the lilac.yml when the server boots up.
+    preload: Whether to load the indices of the embeddings in the lilac.yml in the background when
+      the server boots up, so the first search after a deploy is fast.
   """
   create_project_and_set_env(project_path)
 
@@ -230,6 +234,15 @@ def start_server(host: str = '127.0.0.1',
   if SERVER:
     raise ValueError('Server is already running')
 
+  if preload:
+
+    @app.on_event('startup')
+    def preload_vector_indices() -> None:
+      if not os.path.exists(os.path.join(data_path(), PROJECT_CONFIG_FILENAME)):
+        return
+      loop = asyncio.get_running_loop()
+      loop.run_in_executor(None, preload_embeddings, read_project_config(data_path()))
+
   config = uvicorn.Config(
     app,
     host=host,
@@ -2,6 +2,7 @@
 import os
 from typing import Iterable, Optional, Type
 
+import pyarrow as pa
 import pytest
 from fastapi.testclient import TestClient
 from pytest_mock import MockerFixture
@@ -17,9 +18,11 @@ from .data.dataset_test_utils import (
   make_dataset,
 )
 from .router_dataset import (
+  ARROW_STREAM_MEDIA_TYPE,
   Column,
   ComputeSignalOptions,
   DeleteSignalOptions,
+  SelectRowsColumnarResponse,
   SelectRowsOptions,
   SelectRowsResponse,
   SelectRowsSchemaOptions,
@@ -132,12 +135,22 @@ def test_select_rows_with_cols_and_limit() -> None:
     offset=1)
   response = client.post(url, json=options.dict())
   assert response.status_code == 200
+  expected_rows = [{
+    'people.*.zipcode': [1, 2],
+    'people.*.locations.*.city': [['city3', 'city4', 'city5'], ['city1']]
+  }]
+  assert SelectRowsResponse.parse_obj(response.json()).rows == expected_rows
+  assert SelectRowsResponse.parse_obj(response.json()).total_num_rows == 3
+
+  # The cursor of the first page continues right after its last row.
+  options = SelectRowsOptions(columns=options.columns, limit=1)
+  first_page = SelectRowsResponse.parse_obj(client.post(url, json=options.dict()).json())
+  assert first_page.next_cursor
+  options = SelectRowsOptions(columns=options.columns, limit=1, cursor=first_page.next_cursor)
+  response = client.post(url, json=options.dict())
+  assert response.status_code == 200
   assert SelectRowsResponse.parse_obj(response.json()) == SelectRowsResponse(
-    rows=[{
-      'people.*.zipcode': [1, 2],
-      'people.*.locations.*.city': [['city3', 'city4', 'city5'], ['city1']]
-    }],
-    total_num_rows=3)
+    rows=expected_rows, total_num_rows=3, next_cursor=response.json()['next_cursor'])
 
 
 def test_select_rows_with_cols_and_combine() -> None:
@@ -179,6 +192,76 @@ def test_select_rows_with_cols_and_combine() -> None:
     total_num_rows=3)
 
 
+def test_select_rows_columnar() -> None:
+  url = f'/api/v1/datasets/{TEST_NAMESPACE}/{TEST_DATASET_NAME}/select_rows_columnar'
+  options = SelectRowsOptions(columns=['erased', ('people', '*', 'zipcode')], limit=2)
+  response = client.post(url, json=options.dict())
+  assert response.status_code == 200
+  res = SelectRowsColumnarResponse.parse_obj(response.json())
+  assert res == SelectRowsColumnarResponse(
+    columns={
+      'erased': [False, True],
+      'people.*.zipcode': [[0], [1, 2]]
+    },
+    total_num_rows=3,
+    next_cursor=res.next_cursor)
+  assert res.next_cursor
+
+
+def test_select_rows_arrow() -> None:
+  url = f'/api/v1/datasets/{TEST_NAMESPACE}/{TEST_DATASET_NAME}/select_rows_arrow'
+  options = SelectRowsOptions(columns=['erased', ('people', '*', 'zipcode')], limit=2)
+  response = client.post(url, json=options.dict())
+  assert response.status_code == 200
+  assert response.headers['content-type'] == ARROW_STREAM_MEDIA_TYPE
+
+  table = pa.ipc.open_stream(response.content).read_all()
+  assert table.schema.metadata[b'total_num_rows'] == b'3'
+  assert table.schema.metadata[b'next_cursor']
+  assert table.to_pylist() == [{
+    'erased': False,
+    'people.*.zipcode': [0]
+  }, {
+    'erased': True,
+    'people.*.zipcode': [1, 2]
+  }]
+
+
+def test_select_rows_arrow_uses_the_dataset_schema() -> None:
+  url = f'/api/v1/datasets/{TEST_NAMESPACE}/{TEST_DATASET_NAME}/select_rows_arrow'
+  udf = Column(path=('people', '*', 'name'), alias='len', signal_udf=LengthSignal())
+  options = SelectRowsOptions(columns=[('people', '*', 'zipcode'), udf])
+  response = client.post(url, json=options.dict())
+  assert response.status_code == 200
+
+  table = pa.ipc.open_stream(response.content).read_all()
+  # The types come from the schema, not from the pandas dtypes of the rows.
+  assert table.schema.field('people.*.zipcode').type == pa.list_(pa.int32())
+  assert table.schema.field('len').type == pa.list_(pa.int32())
+  assert table.column('len').to_pylist() == [[1], [1, 1], None]
+
+
+def test_select_rows_arrow_with_combine_columns() -> None:
+  url = f'/api/v1/datasets/{TEST_NAMESPACE}/{TEST_DATASET_NAME}/select_rows_arrow'
+  options = SelectRowsOptions(columns=[('people', '*', 'zipcode')], combine_columns=True, limit=2)
+  response = client.post(url, json=options.dict())
+  assert response.status_code == 200
+
+  table = pa.ipc.open_stream(response.content).read_all()
+  assert table.schema.field('people').type == pa.list_(pa.struct([('zipcode', pa.int32())]))
+  assert table.to_pylist() == [{
+    'people': [{
+      'zipcode': 0
+    }]
+  }, {
+    'people': [{
+      'zipcode': 1
+    }, {
+      'zipcode': 2
+    }]
+  }]
+
+
 class LengthSignal(TextSignal):
   name = 'length_signal'
 
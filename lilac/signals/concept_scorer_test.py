@@ -26,7 +26,7 @@ from .concept_scorer import ConceptSignal
 
 ALL_CONCEPT_DBS = [DiskConceptDB]
 ALL_CONCEPT_MODEL_DBS = [DiskConceptModelDB]
-ALL_VECTOR_STORES = ['numpy', 'hnsw']
+ALL_VECTOR_STORES = ['numpy', 'hnsw', 'numpy_mmap', 'numpy_float16', 'numpy_int8', 'ivfpq']
 
 
 @pytest.fixture(autouse=True)
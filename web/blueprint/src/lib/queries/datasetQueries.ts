@@ -156,20 +156,23 @@ export const infiniteQuerySelectRows = (
 ): CreateInfiniteQueryResult<Awaited<ReturnType<typeof DatasetsService.selectRows>>, ApiError> =>
   createInfiniteQuery({
     queryKey: [DATASETS_TAG, 'selectRows', namespace, datasetName, selectRowOptions],
-    queryFn: ({pageParam = 0}) =>
+    // Each page continues from the cursor of the previous page, so deep pages are as fast as the
+    // first one.
+    queryFn: ({pageParam}) =>
       DatasetsService.selectRows(namespace, datasetName, {
         ...selectRowOptions,
         limit: selectRowOptions.limit || DEFAULT_SELECT_ROWS_LIMIT,
-        offset: pageParam * (selectRowOptions.limit || DEFAULT_SELECT_ROWS_LIMIT)
+        cursor: pageParam
       }),
     select: data => ({
       ...data,
       pages: data.pages.map(page => ({
         rows: page.rows.map(row => deserializeRow(row, schema!)),
-        total_num_rows: page.total_num_rows
+        total_num_rows: page.total_num_rows,
+        next_cursor: page.next_cursor
       }))
     }),
-    getNextPageParam: (_, pages) => pages.length,
+    getNextPageParam: lastPage => lastPage.next_cursor,
     enabled: !!schema
   });
 
@@ -51,6 +51,7 @@ export type { ScoreExample } from './models/ScoreExample';
 export type { SearchResultInfo } from './models/SearchResultInfo';
 export type { SelectGroupsOptions } from './models/SelectGroupsOptions';
 export type { SelectGroupsResult } from './models/SelectGroupsResult';
+export type { SelectRowsColumnarResponse } from './models/SelectRowsColumnarResponse';
 export type { SelectRowsOptions } from './models/SelectRowsOptions';
 export type { SelectRowsResponse } from './models/SelectRowsResponse';
 export type { SelectRowsSchemaOptions } from './models/SelectRowsSchemaOptions';
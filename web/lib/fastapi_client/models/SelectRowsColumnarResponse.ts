@@ -0,0 +1,13 @@
+/* istanbul ignore file */
+/* tslint:disable */
+/* eslint-disable */
+
+/**
+ * The response for the columnar select rows endpoint.
+ */
+export type SelectRowsColumnarResponse = {
+    columns: Record<string, Array<any>>;
+    total_num_rows: number;
+    next_cursor?: string;
+};
+
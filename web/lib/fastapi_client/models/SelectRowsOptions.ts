@@ -22,6 +22,7 @@ export type SelectRowsOptions = {
     sort_order?: SortOrder;
     limit?: number;
     offset?: number;
+    cursor?: string;
     combine_columns?: boolean;
 };
 
@@ -8,5 +8,6 @@
 export type SelectRowsResponse = {
     rows: Array<Record<string, any>>;
     total_num_rows: number;
+    next_cursor?: string;
 };
 
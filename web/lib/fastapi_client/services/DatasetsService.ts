@@ -10,6 +10,7 @@ import type { DeleteSignalResponse } from '../models/DeleteSignalResponse';
 import type { GetStatsOptions } from '../models/GetStatsOptions';
 import type { SelectGroupsOptions } from '../models/SelectGroupsOptions';
 import type { SelectGroupsResult } from '../models/SelectGroupsResult';
+import type { SelectRowsColumnarResponse } from '../models/SelectRowsColumnarResponse';
 import type { SelectRowsOptions } from '../models/SelectRowsOptions';
 import type { SelectRowsResponse } from '../models/SelectRowsResponse';
 import type { SelectRowsSchemaOptions } from '../models/SelectRowsSchemaOptions';
@@ -232,6 +233,66 @@ export class DatasetsService {
         });
     }
 
+    /**
+     * Select Rows Columnar
+     * Select rows from the dataset database, returned column by column.
+     * @param namespace
+     * @param datasetName
+     * @param requestBody
+     * @returns SelectRowsColumnarResponse Successful Response
+     * @throws ApiError
+     */
+    public static selectRowsColumnar(
+        namespace: string,
+        datasetName: string,
+        requestBody: SelectRowsOptions,
+    ): CancelablePromise<SelectRowsColumnarResponse> {
+        return __request(OpenAPI, {
+            method: 'POST',
+            url: '/api/v1/datasets/{namespace}/{dataset_name}/select_rows_columnar',
+            path: {
+                'namespace': namespace,
+                'dataset_name': datasetName,
+            },
+            body: requestBody,
+            mediaType: 'application/json',
+            errors: {
+                422: `Validation Error`,
+            },
+        });
+    }
+
+    /**
+     * Select Rows Arrow
+     * Select rows from the dataset database, returned as an Arrow IPC stream.
+     *
+     * The total number of rows is stored in the `total_num_rows` key of the schema metadata.
+     * @param namespace
+     * @param datasetName
+     * @param requestBody
+     * @returns any Successful Response
+     * @throws ApiError
+     */
+    public static selectRowsArrow(
+        namespace: string,
+        datasetName: string,
+        requestBody: SelectRowsOptions,
+    ): CancelablePromise<any> {
+        return __request(OpenAPI, {
+            method: 'POST',
+            url: '/api/v1/datasets/{namespace}/{dataset_name}/select_rows_arrow',
+            path: {
+                'namespace': namespace,
+                'dataset_name': datasetName,
+            },
+            body: requestBody,
+            mediaType: 'application/json',
+            errors: {
+                422: `Validation Error`,
+            },
+        });
+    }
+
     /**
      * Select Rows Schema
      * Select rows from the dataset database.